@@ -0,0 +1,138 @@
+"""
+Caption pool benchmark
+Throughput of folder captioning on CPU against the number of worker
+processes and torch threads per worker, next to a single process with
+torch's default threading (the pre-pool batch mode).
+
+Worker start-up (spawning, imports, model load) is reported separately and
+excluded from throughput; every configuration first captions one warm-up
+chunk per worker, then times the whole image set with the cache off.
+
+Examples:
+  python3 benchmarks/bench_caption_pool.py                       # tiny offline model, every fitting layout
+  python3 benchmarks/bench_caption_pool.py --model base --workers 1 2 4 --threads 1 2 4
+  python3 benchmarks/bench_caption_pool.py --model base --preset greedy-fast --json pool.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench_pipeline import build_tiny_model, make_images
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+
+def powers_of_two(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    return values
+
+
+def bench_single(model, images, style, max_length, preset, batch_size):
+    """One process, torch's default thread count: what batch mode did before the pool."""
+    import torch
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    start = time.perf_counter()
+    blip = AppleSiliconBLIP(model, device="cpu", decoding=preset)
+    startup_s = time.perf_counter() - start
+    list(blip.iter_captions(images[:batch_size], [style], max_length, batch_size=batch_size))  # warm-up
+    start = time.perf_counter()
+    list(blip.iter_captions(images, [style], max_length, batch_size=batch_size))
+    elapsed = time.perf_counter() - start
+    return {"workers": 1, "threads": torch.get_num_threads(), "startup_s": startup_s, "seconds": elapsed,
+            "images_per_s": len(images) / elapsed}
+
+
+def bench_pool(model, images, style, max_length, preset, workers, threads, chunk_size):
+    from caption_pool import CaptionPool
+
+    start = time.perf_counter()
+    pool = CaptionPool(model, workers=workers, threads_per_worker=threads, decoding=preset)
+    startup_s = time.perf_counter() - start
+    with pool:
+        list(pool.iter_captions(images[:workers * chunk_size], [style], max_length, chunk_size=chunk_size))
+        start = time.perf_counter()
+        results = list(pool.iter_captions(images, [style], max_length, chunk_size=chunk_size))
+        elapsed = time.perf_counter() - start
+    return {"workers": workers, "threads": threads, "startup_s": startup_s, "seconds": elapsed,
+            "images_per_s": len(images) / elapsed, "failed": sum(1 for r in results if r["error"])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark captioning throughput per worker/thread layout")
+    parser.add_argument("--model", default="tiny",
+                        help="tiny (random offline model, default), base, large, or a local checkpoint directory")
+    parser.add_argument("--images", nargs="*", help="Image files or one directory (default: generated images)")
+    parser.add_argument("--num-images", type=int, default=48, help="How many images to generate")
+    parser.add_argument("--workers", type=int, nargs="+", help="Worker counts (default: powers of two up to cores)")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        help="Threads per worker (default: powers of two up to cores)")
+    parser.add_argument("--oversubscribe", action="store_true",
+                        help="Also run layouts where workers x threads exceeds the physical cores")
+    parser.add_argument("--preset", default="beam-4-quality", help="Decoding preset (beam search by default)")
+    parser.add_argument("--style", default="detailed")
+    parser.add_argument("--max-length", type=int, default=40)
+    parser.add_argument("--chunk-size", type=int, default=4, help="Images per task sent to a worker")
+    parser.add_argument("--skip-single", action="store_true", help="Skip the single-process baseline")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["PROMPT_BUILDER_CACHE_DIR"] = os.path.join(tmp, "cache")
+        # Workers are spawned processes: they find the app modules through PYTHONPATH, not sys.path
+        os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [args.app_dir, os.environ.get("PYTHONPATH")]))
+        model = args.model
+        if model == "tiny":
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            model = build_tiny_model(os.path.join(tmp, "tiny_blip"))
+
+        sys.path.insert(0, args.app_dir)
+        from blip1_m1_optimized import iter_image_paths
+        from caption_pool import physical_cores
+
+        images = list(iter_image_paths(args.images)) if args.images else make_images(tmp, args.num_images)
+        cores = physical_cores()
+        layouts = [(w, t) for w in (args.workers or powers_of_two(cores))
+                   for t in (args.threads or powers_of_two(cores))
+                   if args.oversubscribe or w * t <= cores]
+
+        print(f"Captioning {len(images)} images with {args.model} ({args.preset}) on {cores} physical cores: "
+              f"{len(layouts)} layouts...")
+        results = {"model": args.model, "preset": args.preset, "images": len(images), "cores": cores, "runs": []}
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            if not args.skip_single:
+                results["single"] = bench_single(model, images, args.style, args.max_length, args.preset,
+                                                 args.chunk_size)
+            for workers, threads in layouts:
+                results["runs"].append(bench_pool(model, images, args.style, args.max_length, args.preset,
+                                                  workers, threads, args.chunk_size))
+
+    reference = results.get("single")
+    print(f"\n{'layout':<26} {'startup s':>10} {'seconds':>9} {'images/s':>9} {'vs single':>10}")
+    rows = ([("single process (default)", reference)] if reference else [])
+    rows += [(f"{r['workers']} workers x {r['threads']} threads", r) for r in results["runs"]]
+    for label, row in rows:
+        speedup = f"{row['images_per_s'] / reference['images_per_s']:.2f}x" if reference else "-"
+        print(f"{label:<26} {row['startup_s']:>10.1f} {row['seconds']:>9.2f} {row['images_per_s']:>9.2f} "
+              f"{speedup:>10}")
+    if results["runs"]:
+        best = max(results["runs"], key=lambda r: r["images_per_s"])
+        print(f"\nBest: --workers {best['workers']} --threads-per-worker {best['threads']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Image decode benchmark
+Compares full-resolution decoding (Image.open().convert('RGB')) against
+image_loader.load_image, which decodes close to BLIP's 384px input size.
+
+Each (method, image) measurement runs in a fresh child process so peak RSS
+is not polluted by earlier runs. Both methods finish with the same 384x384
+bicubic resize the BLIP processor performs, so timings are end-to-end.
+The generated set includes a 16-bit grayscale TIFF; a child that fails to
+load an image stops the run, so mode regressions show up here too.
+
+Examples:
+  python3 benchmarks/bench_image_decode.py
+  python3 benchmarks/bench_image_decode.py --images ~/Pictures/*.jpg --json decode.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+
+def peak_rss_bytes():
+    # VmHWM is reset on exec; ru_maxrss on Linux would carry over the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS reports bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+
+
+def make_test_images(out_dir, megapixels=40):
+    """Write photo-like test images in the formats that hurt most at full size."""
+    import numpy as np
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    # Smooth gradients plus mild noise compress like real photos, unlike pure noise
+    y, x = np.mgrid[0:height // 8, 0:width // 8].astype(np.float32)
+    rng = np.random.RandomState(0)
+    small = np.stack([
+        128 + 100 * np.sin(x / 37.0) * np.cos(y / 53.0),
+        128 + 100 * np.sin((x + y) / 71.0),
+        128 + 100 * np.cos(x / 29.0 - y / 41.0)
+    ], axis=-1) + rng.normal(0, 12, (height // 8, width // 8, 3))
+    base = Image.fromarray(np.clip(small, 0, 255).astype("uint8")).resize((width, height), Image.BICUBIC)
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees, as phone cameras write it
+    paths = {
+        "jpeg_exif_rotated": os.path.join(out_dir, "camera.jpg"),
+        "jpeg_cmyk": os.path.join(out_dir, "print_cmyk.jpg"),
+        "tiff": os.path.join(out_dir, "scan.tif"),
+        "tiff_16bit_gray": os.path.join(out_dir, "scan_16bit.tif"),  # mode I;16: older Pillow can't resample it
+        "png_palette": os.path.join(out_dir, "palette.png"),
+    }
+    base.save(paths["jpeg_exif_rotated"], quality=92, exif=exif)
+    base.convert("CMYK").save(paths["jpeg_cmyk"], quality=92)
+    base.save(paths["tiff"])
+    Image.fromarray(np.asarray(base.convert("L"), dtype=np.uint16) * 257).save(paths["tiff_16bit_gray"])
+    base.quantize(256).save(paths["png_palette"])
+    return paths
+
+
+def child(method, image_path, app_dir, repeats):
+    """Measure one method on one image inside this (fresh) process."""
+    sys.path.insert(0, app_dir)
+    from PIL import Image
+    from image_loader import load_image
+
+    baseline_rss = peak_rss_bytes()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        if method == "full":
+            image = Image.open(image_path).convert("RGB")
+        else:
+            image = load_image(image_path)
+        decoded_size = image.size
+        image = image.resize((384, 384), Image.BICUBIC)
+        timings.append((time.perf_counter() - start) * 1000)
+        del image
+    timings.sort()
+    print(json.dumps({
+        "median_ms": timings[len(timings) // 2],
+        "min_ms": timings[0],
+        "peak_rss_delta_mb": (peak_rss_bytes() - baseline_rss) / (1024 * 1024),
+        "decoded_size": decoded_size
+    }))
+
+
+def run(images, app_dir, repeats):
+    results = []
+    for label, path in images.items():
+        row = {"image": label, "path": path}
+        for method in ("full", "draft"):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", method, path,
+                 "--app-dir", app_dir, "--repeats", str(repeats)],
+                capture_output=True, text=True, check=True
+            )
+            row[method] = json.loads(out.stdout.strip().splitlines()[-1])
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decode-time downscaling of large images")
+    parser.add_argument("--images", nargs="*", help="Images to measure (default: generated 40 MP test set)")
+    parser.add_argument("--megapixels", type=float, default=40, help="Size of generated test images")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing image_loader.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--child", nargs=2, metavar=("METHOD", "IMAGE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.app_dir, args.repeats)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            images = {os.path.basename(p): p for p in args.images}
+        else:
+            print(f"Generating {args.megapixels:g} MP test images...")
+            images = make_test_images(tmp, args.megapixels)
+        results = run(images, args.app_dir, args.repeats)
+
+    print(f"\n{'image':<20} {'full ms':>9} {'draft ms':>9} {'speedup':>8} {'full MB':>9} {'draft MB':>9}")
+    for row in results:
+        full, draft = row["full"], row["draft"]
+        speedup = full["median_ms"] / draft["median_ms"] if draft["median_ms"] else 0.0
+        print(f"{row['image']:<20} {full['median_ms']:>9.1f} {draft['median_ms']:>9.1f} {speedup:>7.1f}x "
+              f"{full['peak_rss_delta_mb']:>9.1f} {draft['peak_rss_delta_mb']:>9.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Model load benchmark
+Compares the old BLIP loader (fp32 weights built in RAM, then moved with
+.to(device)) against the low-memory loader (memory-mapped safetensors,
+weights materialised once in their final dtype and device), in fp32 and
+half precision.
+
+Each mode loads in a fresh child process and captions one image, so peak
+RSS covers the load plus the first forward pass (memory-mapped weights only
+become resident once they are touched); torch and transformers are imported
+before the baseline is taken. rss MB is what stays resident afterwards.
+
+Examples:
+  python3 benchmarks/bench_model_load.py --model large
+  python3 benchmarks/bench_model_load.py --model base --device mps --json load.json
+  python3 benchmarks/bench_model_load.py --model tiny   # offline smoke test
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_image_decode import peak_rss_bytes
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+# mode -> AppleSiliconBLIP options
+MODES = {
+    "legacy": {"low_memory": False, "dtype": "float32"},
+    "low-memory": {"low_memory": True, "dtype": "float32"},
+    "float16": {"low_memory": True, "dtype": "float16"},
+    "bfloat16": {"low_memory": True, "dtype": "bfloat16"}
+}
+
+
+def current_rss_bytes():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return peak_rss_bytes()
+
+
+def child(mode, model, device, app_dir, image_path):
+    """Load the model once in this (fresh) process, caption one image and print the measurements as JSON."""
+    sys.path.insert(0, app_dir)
+    import torch  # noqa: F401 - imported before the baseline so only the load itself is measured
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    baseline_peak = peak_rss_bytes()
+    baseline_rss = current_rss_bytes()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        blip = AppleSiliconBLIP(model, device=device, **MODES[mode])
+        load_s = time.perf_counter() - start
+        start = time.perf_counter()
+        caption = blip.generate_caption(image_path, "simple", max_length=20, decoding="greedy-fast")
+        first_caption_s = time.perf_counter() - start
+    print(json.dumps({
+        "load_s": load_s,
+        "first_caption_s": first_caption_s,
+        "peak_rss_delta_mb": (peak_rss_bytes() - baseline_peak) / (1024 * 1024),
+        "rss_delta_mb": (current_rss_bytes() - baseline_rss) / (1024 * 1024),
+        "weights_mb": blip.memory_bytes() / (1024 * 1024),
+        "device": blip.device,
+        "caption": caption
+    }))
+
+
+def make_image(out_dir):
+    from PIL import Image
+
+    path = os.path.join(out_dir, "load_test.jpg")
+    Image.new("RGB", (640, 480), (120, 160, 200)).save(path)
+    return path
+
+
+def run(modes, model, device, app_dir, repeats, image_path):
+    results = {}
+    for mode in modes:
+        runs = []
+        for _ in range(repeats):
+            command = [sys.executable, os.path.abspath(__file__), "--child", mode, "--model", model,
+                       "--app-dir", app_dir, "--image", image_path]
+            if device:
+                command += ["--device", device]
+            out = subprocess.run(command, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f"❌ {mode} failed:\n{out.stderr.strip()[-2000:]}")
+                break
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        if runs:
+            runs.sort(key=lambda r: r["load_s"])
+            best = dict(runs[len(runs) // 2])
+            best["peak_rss_delta_mb"] = max(r["peak_rss_delta_mb"] for r in runs)
+            best["rss_delta_mb"] = max(r["rss_delta_mb"] for r in runs)
+            results[mode] = best
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BLIP load time and peak RSS per loading mode")
+    parser.add_argument("--model", default="base",
+                        help="base, large, a local checkpoint directory, or tiny (random offline model)")
+    parser.add_argument("--device", help="cpu, mps or cuda (default: best available)")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--repeats", type=int, default=3, help="Loads per mode; the median load time is reported")
+    parser.add_argument("--image", help="Image captioned after loading (default: a generated one)")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--child", choices=list(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.model, args.device, args.app_dir, args.image)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model = args.model
+        if model == "tiny":
+            from bench_pipeline import build_tiny_model
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            model = build_tiny_model(os.path.join(tmp, "tiny_blip"))
+        image_path = args.image or make_image(tmp)
+        print(f"Loading {args.model} {args.repeats}x per mode ({', '.join(args.modes)})...")
+        results = run(args.modes, model, args.device, args.app_dir, args.repeats, image_path)
+
+    reference = results.get("legacy")
+    print(f"\n{'mode':<12} {'device':<7} {'load s':>8} {'caption s':>10} {'peak MB':>9} {'rss MB':>8} "
+          f"{'weights MB':>11} {'peak vs legacy':>15}")
+    for mode, row in results.items():
+        ratio = (f"{row['peak_rss_delta_mb'] / reference['peak_rss_delta_mb']:.2f}x"
+                 if reference and reference["peak_rss_delta_mb"] else "-")
+        print(f"{mode:<12} {row['device']:<7} {row['load_s']:>8.2f} {row['first_caption_s']:>10.2f} "
+              f"{row['peak_rss_delta_mb']:>9.1f} {row['rss_delta_mb']:>8.1f} {row['weights_mb']:>11.1f} {ratio:>15}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"model": args.model, "results": results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
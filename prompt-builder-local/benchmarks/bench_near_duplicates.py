@@ -0,0 +1,204 @@
+"""
+Near-duplicate benchmark
+Captions a set of images that contains resized copies, re-encoded JPEGs and
+burst-like shots (a slight crop and rotation) of a smaller number of scenes,
+once with the near-duplicate index off and once with it on, and reports how
+many images actually went through the model, the wall time of both runs and
+the Hamming distances at which captions were reused.
+
+A second table shows pHash and dHash distances per variant next to the
+distances between different scenes, which is what the threshold has to
+separate.
+
+Examples:
+  python3 benchmarks/bench_near_duplicates.py
+  python3 benchmarks/bench_near_duplicates.py --scenes 40 --variants 4 --distance 6
+  python3 benchmarks/bench_near_duplicates.py --model base --images ~/Pictures/shoot
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench_pipeline import build_tiny_model
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+VARIANTS = ["resized", "jpeg-q40", "burst", "brighter"]
+
+
+def make_scene(seed, size=(800, 600)):
+    """A smooth background with overlapping shapes: enough low-frequency structure for a perceptual hash."""
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = np.random.RandomState(seed)
+    image = Image.new("RGB", size, tuple(int(c) for c in rng.randint(0, 255, 3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randint(0, size[0] - 100), rng.randint(0, size[1] - 100)
+        w, h = rng.randint(30, 250, 2)
+        color = tuple(int(c) for c in rng.randint(0, 255, 3))
+        if rng.rand() < 0.5:
+            draw.ellipse([x, y, x + w, y + h], fill=color)
+        else:
+            draw.rectangle([x, y, x + w, y + h], fill=color)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def make_variant(image, variant):
+    from PIL import ImageEnhance
+
+    width, height = image.size
+    if variant == "resized":
+        return image.resize((width * 2 // 5, height * 2 // 5)), 90
+    if variant == "jpeg-q40":
+        return image, 40
+    if variant == "burst":
+        return image.crop((8, 6, width, height)).rotate(0.7).resize((width, height)), 90
+    if variant == "brighter":
+        return ImageEnhance.Brightness(image).enhance(1.15), 90
+    raise ValueError(variant)
+
+
+def make_images(out_dir, scenes, variants):
+    """Write scenes originals plus their variants; returns (paths in shuffled order, path -> (scene, variant))."""
+    import random
+
+    labels = {}
+    for seed in range(scenes):
+        scene = make_scene(seed)
+        path = os.path.join(out_dir, f"scene_{seed:03d}.jpg")
+        scene.save(path, quality=90)
+        labels[path] = (seed, "original")
+        for variant in VARIANTS[:variants]:
+            image, quality = make_variant(scene, variant)
+            path = os.path.join(out_dir, f"scene_{seed:03d}_{variant}.jpg")
+            image.save(path, quality=quality)
+            labels[path] = (seed, variant)
+    paths = list(labels)
+    random.Random(0).shuffle(paths)  # near-duplicates are rarely adjacent in a real folder
+    return paths, labels
+
+
+def hash_distances(paths, labels):
+    from near_duplicates import dhash, hamming_distance, phash
+    from image_loader import load_image
+
+    originals = {labels[p][0]: p for p in paths if labels[p][1] == "original"}
+    hashes = {}
+    for path in paths:
+        image = load_image(path, 64)
+        hashes[path] = (phash(image), dhash(image))
+
+    rows = {}
+    for path in paths:
+        scene, variant = labels[path]
+        if variant != "original":
+            original = hashes[originals[scene]]
+            rows.setdefault(variant, []).append([hamming_distance(a, b) for a, b in zip(hashes[path], original)])
+    scenes = sorted(originals)
+    for a, b in zip(scenes, scenes[1:]):
+        rows.setdefault("different scenes", []).append(
+            [hamming_distance(x, y) for x, y in zip(hashes[originals[a]], hashes[originals[b]])])
+    return {name: {"phash": sorted(r[0] for r in values), "dhash": sorted(r[1] for r in values)}
+            for name, values in rows.items()}
+
+
+def caption_run(model, paths, near_duplicates, batch_size, max_length):
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    blip = AppleSiliconBLIP(model, device="cpu", near_duplicates=near_duplicates)
+    model_images = []
+    generate_batch = blip._generate_batch
+
+    def counting_generate_batch(images, *args, **kwargs):
+        model_images.append(len(images))
+        return generate_batch(images, *args, **kwargs)
+
+    blip._generate_batch = counting_generate_batch
+    start = time.perf_counter()
+    blip.generate_captions_batch(paths, "simple", max_length=max_length, batch_size=batch_size,
+                                 decoding="greedy-fast")
+    elapsed = time.perf_counter() - start
+    return {"images": len(paths), "model_images": sum(model_images), "seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark caption reuse for near-duplicate images")
+    parser.add_argument("--model", default="tiny",
+                        help="tiny (random offline model, default), base, large, or a local checkpoint directory")
+    parser.add_argument("--images", nargs="*", help="Image files or one directory (default: generated scenes)")
+    parser.add_argument("--scenes", type=int, default=20, help="Distinct scenes to generate")
+    parser.add_argument("--variants", type=int, default=len(VARIANTS), choices=range(len(VARIANTS) + 1),
+                        help="Near-duplicate variants per generated scene")
+    parser.add_argument("--distance", type=int, help="Max Hamming distance (default: the app default)")
+    parser.add_argument("--method", default="phash", choices=["phash", "dhash"])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=30)
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["PROMPT_BUILDER_CACHE_DIR"] = os.path.join(tmp, "cache")
+        model = args.model
+        if model == "tiny":
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            model = build_tiny_model(os.path.join(tmp, "tiny_blip"))
+
+        sys.path.insert(0, args.app_dir)
+        from blip1_m1_optimized import iter_image_paths
+        from near_duplicates import DEFAULT_MAX_DISTANCE, NearDuplicateIndex
+
+        if args.images:
+            paths, labels = list(iter_image_paths(args.images)), {}
+        else:
+            image_dir = os.path.join(tmp, "images")
+            os.makedirs(image_dir)
+            paths, labels = make_images(image_dir, args.scenes, args.variants)
+        distance = DEFAULT_MAX_DISTANCE if args.distance is None else args.distance
+
+        print(f"Captioning {len(paths)} images with {args.model}, {args.method} distance <= {distance}...")
+        results = {"model": args.model, "method": args.method, "max_distance": distance}
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            if labels:
+                results["distances"] = hash_distances(paths, labels)
+            results["baseline"] = caption_run(model, paths, None, args.batch_size, args.max_length)
+            index = NearDuplicateIndex(os.path.join(tmp, "near_duplicates.sqlite3"), max_distance=distance,
+                                       method=args.method)
+            results["near_duplicates"] = caption_run(model, paths, index, args.batch_size,
+                                                     args.max_length)
+            results["index"] = index.stats()
+            index.close()
+
+    if "distances" in results:
+        print(f"\n{'variant':<18} {'pHash distances (median / max)':>32} {'dHash (median / max)':>22}")
+        for name, values in results["distances"].items():
+            cells = [f"{v[len(v) // 2]} / {v[-1]}" for v in (values["phash"], values["dhash"])]
+            if name == "different scenes":
+                cells = [f"{v[len(v) // 2]} / min {v[0]}" for v in (values["phash"], values["dhash"])]
+            print(f"{name:<18} {cells[0]:>32} {cells[1]:>22}")
+
+    base, near = results["baseline"], results["near_duplicates"]
+    skipped = 1 - near["model_images"] / base["model_images"] if base["model_images"] else 0.0
+    print(f"\n{'run':<18} {'images':>7} {'through model':>14} {'seconds':>9}")
+    for name, row in (("index off", base), ("index on", near)):
+        print(f"{name:<18} {row['images']:>7} {row['model_images']:>14} {row['seconds']:>9.2f}")
+    stats = results["index"]
+    print(f"\nModel calls skipped: {skipped:.0%} ({stats['batch_reuses']} within batches, "
+          f"{stats['hits']} from the index; distances {stats['hit_distances']}, hashing {stats['hash_ms']:.0f}ms)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+ONNX Runtime backend benchmark
+Captions the same fixed image set with the torch backend (on CPU) and the
+ONNX Runtime backend, checks that both produce the same captions, and
+compares load time and per-image latency for each decoding preset.
+
+Greedy decoding should match the torch path token for token; beam search
+can very rarely flip between near-tied beams due to float rounding, so it
+is held to --min-beam-agreement instead. With --check-parity the script
+exits with status 1 when either check fails, so it can gate a release.
+
+Examples:
+  python3 benchmarks/bench_onnx.py --images ~/Pictures/eval_set
+  python3 benchmarks/bench_onnx.py --check-parity --presets greedy-fast beam-4-quality --json onnx.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_pipeline import make_images, percentile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+DEFAULT_IMAGE_COUNT = 8
+
+
+def run_backend(backend, model_size, images, presets, prompt_type, max_length):
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        # No caption cache: every call must really run the model
+        blip = AppleSiliconBLIP(model_size, device="cpu", backend=backend)
+        load_s = time.perf_counter() - start
+
+        results = {"backend": backend, "load_s": load_s, "presets": {}}
+        for preset in presets:
+            blip.generate_caption(images[0], prompt_type, max_length, decoding=preset)  # warm-up
+            captions = []
+            latencies = []
+            for path in images:
+                start = time.perf_counter()
+                captions.append(blip.generate_caption(path, prompt_type, max_length, decoding=preset) or "")
+                latencies.append((time.perf_counter() - start) * 1000)
+            results["presets"][preset] = {
+                "latency_ms_p50": percentile(latencies, 50),
+                "latency_ms_p90": percentile(latencies, 90),
+                "latency_ms_mean": statistics.mean(latencies),
+                "captions": captions
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the torch and ONNX Runtime BLIP backends on CPU")
+    parser.add_argument("--images", nargs="*", help="Image files or one directory (default: generated images)")
+    parser.add_argument("--model-size", choices=["base", "large"], default="base")
+    parser.add_argument("--presets", nargs="+", default=["greedy-fast", "beam-4-quality"])
+    parser.add_argument("--prompt-type", default="detailed")
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--check-parity", action="store_true", help="Exit with status 1 if captions diverge")
+    parser.add_argument("--min-beam-agreement", type=float, default=0.9,
+                        help="Fraction of beam-search captions that must match exactly")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.app_dir)
+    from blip1_m1_optimized import iter_image_paths, resolve_decoding
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = list(iter_image_paths(args.images)) if args.images else make_images(tmp, DEFAULT_IMAGE_COUNT)
+        if not images:
+            parser.error("no images found")
+        print(f"Captioning {len(images)} images with torch and onnx ({args.model_size})...")
+        torch_run = run_backend("torch", args.model_size, images, args.presets, args.prompt_type, args.max_length)
+        onnx_run = run_backend("onnx", args.model_size, images, args.presets, args.prompt_type, args.max_length)
+
+    print(f"\nload s: torch {torch_run['load_s']:.2f}, onnx {onnx_run['load_s']:.2f}")
+    print(f"\n{'preset':<16} {'backend':<8} {'p50 ms':>9} {'p90 ms':>9} {'mean ms':>9}")
+    parity_ok = True
+    summary = {}
+    for preset in args.presets:
+        for run in (torch_run, onnx_run):
+            row = run["presets"][preset]
+            print(f"{preset:<16} {run['backend']:<8} {row['latency_ms_p50']:>9.1f} "
+                  f"{row['latency_ms_p90']:>9.1f} {row['latency_ms_mean']:>9.1f}")
+
+        reference = torch_run["presets"][preset]["captions"]
+        candidate = onnx_run["presets"][preset]["captions"]
+        agreement = sum(a == b for a, b in zip(reference, candidate)) / len(images)
+        greedy = resolve_decoding(preset).get("num_beams", 1) == 1
+        required = 1.0 if greedy else args.min_beam_agreement
+        speedup = (torch_run["presets"][preset]["latency_ms_mean"] / onnx_run["presets"][preset]["latency_ms_mean"]
+                   if onnx_run["presets"][preset]["latency_ms_mean"] else 0.0)
+        summary[preset] = {"agreement": agreement, "required": required, "speedup": speedup}
+        status = "ok" if agreement >= required else "FAIL"
+        print(f"{'':<16} onnx speedup {speedup:.2f}x, caption agreement {agreement:.0%} "
+              f"(need {required:.0%}) {status}")
+        if agreement < required:
+            parity_ok = False
+            for path, a, b in [(p, a, b) for p, a, b in zip(images, reference, candidate) if a != b][:3]:
+                print(f"  {os.path.basename(path)}\n    torch: {a}\n    onnx:  {b}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"images": images, "torch": torch_run, "onnx": onnx_run, "summary": summary}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    if args.check_parity and not parity_ok:
+        print("\n❌ ONNX backend captions diverge from the torch backend")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
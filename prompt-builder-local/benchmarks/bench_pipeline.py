@@ -0,0 +1,292 @@
+"""
+Captioning pipeline benchmark
+Times every stage of the captioning pipeline: model load, image decode,
+preprocessing, generate() per batch size and decoding preset, streamed
+captions (time to first text vs. the whole caption), and the end-to-end
+generate_prompts_from_image call the GUI makes.
+
+By default it runs fully offline: a tiny randomly initialised BLIP (a few
+hundred KB, built on the fly) and generated test images, so it works on a
+CPU-only CI box without downloading weights. Absolute numbers from the tiny
+model only show relative changes in the pipeline around the model; use
+--model base/large on a real machine to measure the model itself.
+
+Results are reported as p50/p90/p99/mean per stage and can be written as
+JSON for comparing runs.
+
+Examples:
+  python3 benchmarks/bench_pipeline.py --json pipeline.json
+  python3 benchmarks/bench_pipeline.py --batch-sizes 1 8 --presets greedy-fast --repeats 20
+  python3 benchmarks/bench_pipeline.py --model base --images ~/Pictures/eval_set
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+# Words the captioning prompts use, so the tiny tokenizer never maps them to [UNK]
+_TINY_WORDS = ["a", "detailed", "description", "of", "an", "artistic", "describe", "this", "image",
+               "for", "ai", "art", "generation", ":", "dog", "cat", "photo", "on", "the", "with"]
+
+
+def build_tiny_model(out_dir, seed=0):
+    """Save a randomly initialised BLIP captioner with a toy vocabulary to out_dir."""
+    import torch
+    from transformers import (BertTokenizerFast, BlipConfig, BlipForConditionalGeneration,
+                              BlipImageProcessor, BlipProcessor)
+
+    os.makedirs(out_dir, exist_ok=True)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"]
+    vocab += [chr(c) for c in range(ord("a"), ord("z") + 1)] + _TINY_WORDS
+    vocab_path = os.path.join(out_dir, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(dict.fromkeys(vocab)))
+    tokenizer = BertTokenizerFast(vocab_path, bos_token="[DEC]", model_max_length=512)
+    tokenizer.add_special_tokens({"bos_token": "[DEC]"})
+    processor = BlipProcessor(image_processor=BlipImageProcessor(size={"height": 32, "width": 32}),
+                              tokenizer=tokenizer)
+
+    config = BlipConfig(
+        vision_config=dict(hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+                           image_size=32, patch_size=8),
+        text_config=dict(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+                         num_attention_heads=4, max_position_embeddings=128,
+                         bos_token_id=tokenizer.bos_token_id, pad_token_id=tokenizer.pad_token_id,
+                         sep_token_id=tokenizer.sep_token_id),
+        projection_dim=32
+    )
+    torch.manual_seed(seed)
+    BlipForConditionalGeneration(config).save_pretrained(out_dir)
+    processor.save_pretrained(out_dir)
+    return out_dir
+
+
+def make_images(out_dir, count, size=(640, 480)):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(count):
+        pixels = (rng.rand(size[1], size[0], 3) * 255).astype("uint8")
+        path = os.path.join(out_dir, f"bench_{i:03d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    ordered = sorted(values)
+    return {
+        "n": len(ordered),
+        "p50_ms": round(percentile(ordered, 50), 3),
+        "p90_ms": round(percentile(ordered, 90), 3),
+        "p99_ms": round(percentile(ordered, 99), 3),
+        "mean_ms": round(statistics.mean(ordered), 3),
+        "min_ms": round(ordered[0], 3),
+        "max_ms": round(ordered[-1], 3)
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def bench_load(model, repeats):
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    timings = []
+    blip = None
+    for _ in range(repeats):
+        blip = None  # drop the previous copy before loading the next one
+        elapsed, blip = timed(AppleSiliconBLIP, model, device="cpu")
+        timings.append(elapsed)
+    return blip, summarize(timings)
+
+
+def bench_decode(blip, images, repeats):
+    decode, preprocess = [], []
+    for _ in range(repeats):
+        for path in images:
+            elapsed, image = timed(blip._load_image, path)
+            decode.append(elapsed)
+            elapsed, _ = timed(blip._preprocess, [image])
+            preprocess.append(elapsed)
+    return {"decode": summarize(decode), "preprocess": summarize(preprocess)}
+
+
+def bench_generate(blip, images, batch_sizes, presets, prompt_type, max_length, repeats):
+    from blip1_m1_optimized import CAPTION_PROMPTS, resolve_decoding
+
+    prompt = CAPTION_PROMPTS.get(prompt_type, "")
+    loaded = [blip._load_image(path) for path in images]
+    results = []
+    for preset in presets:
+        decoding = resolve_decoding(preset)
+        for batch_size in batch_sizes:
+            batch = (loaded * (batch_size // len(loaded) + 1))[:batch_size]
+            blip._generate_batch(batch, prompt, max_length, decoding)  # warm-up
+            per_batch = []
+            for _ in range(repeats):
+                elapsed, _ = timed(blip._generate_batch, batch, prompt, max_length, decoding)
+                per_batch.append(elapsed)
+            results.append({
+                "preset": preset,
+                "batch_size": batch_size,
+                "per_batch": summarize(per_batch),
+                "per_image": summarize([t / batch_size for t in per_batch]),
+                "images_per_s": round(batch_size * 1000 / statistics.median(per_batch), 2)
+            })
+    return results
+
+
+def bench_stream(blip, images, prompt_type, max_length, repeats):
+    """Time stream_caption: how long until the first text shows, and until the caption is done."""
+    first, total = [], []
+    list(blip.stream_caption(images[0], prompt_type, max_length))  # warm-up
+    for _ in range(repeats):
+        for path in images:
+            start = time.perf_counter()
+            first_ms = None
+            for _ in blip.stream_caption(path, prompt_type, max_length):
+                if first_ms is None:
+                    first_ms = (time.perf_counter() - start) * 1000
+            total.append((time.perf_counter() - start) * 1000)
+            first.append(first_ms if first_ms is not None else total[-1])
+    return {"first_text": summarize(first), "full_caption": summarize(total)}
+
+
+def bench_end_to_end(model, images, presets):
+    """Time generate_prompts_from_image: cold (new images) and again with the caption cache warm."""
+    import generate_prompts_from_image as gp
+
+    results = {}
+    for preset in presets:
+        if gp.model_manager is not None:
+            gp.model_manager.close()
+        gp.model_manager = None  # fresh captioner and cache per preset
+        gp.caption_cache = None
+        gp.generate_prompts_from_image(images[0], model, preset)  # loads the model; not counted
+        cold = [timed(gp.generate_prompts_from_image, path, model, preset)[0] for path in images[1:]]
+        warm = [timed(gp.generate_prompts_from_image, path, model, preset)[0] for path in images[1:]]
+        results[preset] = {"cold": summarize(cold), "cached": summarize(warm)}
+    return results
+
+
+def environment_info(model):
+    import torch
+    import transformers
+
+    return {
+        "model": model,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "transformers": transformers.__version__
+    }
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"  {'':<34} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for label, stats in rows:
+        print(f"  {label:<34} {stats['p50_ms']:>9.2f} {stats['p90_ms']:>9.2f} "
+              f"{stats['p99_ms']:>9.2f} {stats['mean_ms']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the captioning pipeline")
+    parser.add_argument("--model", default="tiny",
+                        help="tiny (random offline model, default), base, large, or a local checkpoint directory")
+    parser.add_argument("--images", nargs="*", help="Image files or one directory (default: generated images)")
+    parser.add_argument("--num-images", type=int, default=8, help="How many images to generate")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--presets", nargs="+", default=["greedy-fast", "beam-2", "beam-4-quality"])
+    parser.add_argument("--prompt-type", default="detailed")
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=10, help="Timed repetitions per measurement")
+    parser.add_argument("--load-repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for stable numbers")
+    parser.add_argument("--skip-e2e", action="store_true", help="Skip the generate_prompts_from_image stage")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Isolate from the user's caption cache and any running caption server
+        os.environ["PROMPT_BUILDER_CACHE_DIR"] = os.path.join(tmp, "cache")
+        os.environ["PROMPT_BUILDER_CAPTION_SERVER"] = "off"
+        model = args.model
+        if model == "tiny":
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            model = build_tiny_model(os.path.join(tmp, "tiny_blip"))
+
+        sys.path.insert(0, args.app_dir)
+        import torch
+        from blip1_m1_optimized import iter_image_paths
+
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        torch.manual_seed(0)
+
+        if args.images:
+            images = list(iter_image_paths(args.images))
+        else:
+            images = make_images(tmp, max(args.num_images, 2))
+        if len(images) < 2:
+            parser.error("need at least two images")
+
+        print(f"Benchmarking {args.model} on {len(images)} images "
+              f"(batch sizes {args.batch_sizes}, presets {args.presets})...")
+        results = {"environment": environment_info(args.model), "images": len(images)}
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            blip, results["load"] = bench_load(model, args.load_repeats)
+            results.update(bench_decode(blip, images, args.repeats))
+            results["generate"] = bench_generate(blip, images, args.batch_sizes, args.presets,
+                                                 args.prompt_type, args.max_length, args.repeats)
+            results["stream"] = bench_stream(blip, images, args.prompt_type, args.max_length, args.repeats)
+            del blip
+            if not args.skip_e2e:
+                results["end_to_end"] = bench_end_to_end(model, images, args.presets)
+
+    print_table("Stages", [("model load", results["load"]), ("image decode", results["decode"]),
+                           ("preprocess", results["preprocess"])])
+    print_table("generate() per image", [
+        (f"{row['preset']} x{row['batch_size']} ({row['images_per_s']:.1f} img/s)", row["per_image"])
+        for row in results["generate"]
+    ])
+    print_table("stream_caption (greedy)", [("first text", results["stream"]["first_text"]),
+                                            ("full caption", results["stream"]["full_caption"])])
+    if "end_to_end" in results:
+        rows = []
+        for preset, stats in results["end_to_end"].items():
+            rows += [(f"{preset} cold", stats["cold"]), (f"{preset} cached", stats["cached"])]
+        print_table("generate_prompts_from_image", rows)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Int8 quantization benchmark
+Loads the BLIP captioner in fp32 and with quantize="int8" on CPU, captions
+the same fixed image set with both, and reports load time, per-image latency
+and how far the int8 captions drift from the fp32 ones.
+
+Caption quality is measured against the fp32 output (exact-match rate and
+word-level F1), so pass a representative folder of real photos with
+--images; the generated fallback images only exercise the timing path.
+
+Examples:
+  python3 benchmarks/bench_quantization.py --images ~/Pictures/eval_set
+  python3 benchmarks/bench_quantization.py --images eval/*.jpg --model-size large --json quant.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+
+def word_f1(candidate, reference):
+    cand = candidate.lower().split()
+    ref = reference.lower().split()
+    if not cand or not ref:
+        return float(cand == ref)
+    common = 0
+    remaining = list(ref)
+    for word in cand:
+        if word in remaining:
+            remaining.remove(word)
+            common += 1
+    if common == 0:
+        return 0.0
+    precision = common / len(cand)
+    recall = common / len(ref)
+    return 2 * precision * recall / (precision + recall)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_images(out_dir, count=8):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(count):
+        pixels = (rng.rand(480, 640, 3) * 255).astype("uint8")
+        path = os.path.join(out_dir, f"fixed_{i:02d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run_variant(quantize, model_size, images, prompt_type, max_length):
+    from blip1_m1_optimized import AppleSiliconBLIP
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        # Compare like with like: the int8 path always runs on CPU
+        blip = AppleSiliconBLIP(model_size, quantize=quantize, device="cpu")
+        load_s = time.perf_counter() - start
+
+        blip.generate_caption(images[0], prompt_type, max_length)  # warm-up
+        captions = []
+        latencies = []
+        for path in images:
+            start = time.perf_counter()
+            captions.append(blip.generate_caption(path, prompt_type, max_length) or "")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "quantize": quantize or "none",
+        "device": blip.device,
+        "load_s": load_s,
+        "latency_ms_p50": percentile(latencies, 50),
+        "latency_ms_p90": percentile(latencies, 90),
+        "latency_ms_mean": statistics.mean(latencies),
+        "captions": captions
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32 and dynamic int8 BLIP captioning on CPU")
+    parser.add_argument("--images", nargs="*", help="Image files or one directory (default: generated images)")
+    parser.add_argument("--model-size", choices=["base", "large"], default="base")
+    parser.add_argument("--prompt-type", default="detailed")
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing blip1_m1_optimized.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.app_dir)
+    from blip1_m1_optimized import iter_image_paths
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = list(iter_image_paths(args.images)) if args.images else make_images(tmp)
+        if not images:
+            parser.error("no images found")
+        print(f"Captioning {len(images)} images with fp32 and int8 ({args.model_size})...")
+        fp32 = run_variant(None, args.model_size, images, args.prompt_type, args.max_length)
+        int8 = run_variant("int8", args.model_size, images, args.prompt_type, args.max_length)
+
+    exact = sum(a == b for a, b in zip(fp32["captions"], int8["captions"])) / len(images)
+    f1 = statistics.mean(word_f1(b, a) for a, b in zip(fp32["captions"], int8["captions"]))
+
+    print(f"\n{'':<8} {'load s':>8} {'p50 ms':>9} {'p90 ms':>9} {'mean ms':>9}")
+    for row in (fp32, int8):
+        print(f"{row['quantize']:<8} {row['load_s']:>8.2f} {row['latency_ms_p50']:>9.1f} "
+              f"{row['latency_ms_p90']:>9.1f} {row['latency_ms_mean']:>9.1f}")
+    speedup = fp32["latency_ms_mean"] / int8["latency_ms_mean"] if int8["latency_ms_mean"] else 0.0
+    print(f"\nint8 speedup: {speedup:.2f}x")
+    print(f"Caption agreement with fp32: exact {exact:.0%}, word F1 {f1:.3f}")
+
+    changed = [(p, a, b) for p, a, b in zip(images, fp32["captions"], int8["captions"]) if a != b]
+    for path, a, b in changed[:5]:
+        print(f"\n{os.path.basename(path)}\n  fp32: {a}\n  int8: {b}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"images": images, "fp32": fp32, "int8": int8,
+                       "exact_match": exact, "word_f1": f1, "speedup": speedup}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
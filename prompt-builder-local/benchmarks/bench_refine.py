@@ -0,0 +1,120 @@
+"""
+Refine benchmark
+Latency of prompt refinement with the local LLM, with and without the
+cached instruction prefix (prompt_refiner.PREFIX_CACHE).
+
+Three situations are timed per mode, each as time to the first refined text
+shown and time to the finished refinement (generation is capped at
+--max-tokens so prompt evaluation dominates, as it does on CPU):
+  first        the first refinement after the model loads
+  repeat       a refinement right after another one; llama.cpp reuses
+               the shared token prefix of consecutive prompts by itself
+  interleaved  a refinement after the model was used for another
+               prompt, which evicts the instruction from the KV cache
+
+Examples:
+  python3 benchmarks/bench_refine.py --model models/phi-3-mini-4k-instruct-q4.gguf
+  python3 benchmarks/bench_refine.py --model model.gguf --threads 8 --repeats 5 --json refine.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+
+PROMPTS = [
+    "a red fox in fresh snow",
+    "portrait of an old fisherman, harbour at dawn",
+    "futuristic city skyline at night, neon signs, rain",
+    "a bowl of ramen on a wooden table",
+    "mountain lake with reflections, autumn trees"
+]
+OTHER_PROMPT = "List three colours that go well with teal:"
+
+
+def timed_refine(llm, prompt, max_tokens):
+    """(seconds to the first refined text, seconds to the finished refinement)"""
+    from prompt_refiner import stream_refinement
+
+    start = time.perf_counter()
+    first = None
+    for _ in stream_refinement(llm, prompt, max_tokens=max_tokens, temperature=0.0):
+        if first is None:
+            first = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return first if first is not None else total, total
+
+
+def bench_mode(model_path, prefix_cache, args):
+    import prompt_refiner
+
+    prompt_refiner.PREFIX_CACHE = prefix_cache
+    start = time.perf_counter()
+    llm = prompt_refiner.load_llm(model_path, n_ctx=args.n_ctx, n_threads=args.threads)
+    load_s = time.perf_counter() - start
+
+    cases = {"first": [], "repeat": [], "interleaved": []}
+    for repeat in range(args.repeats):
+        if repeat:  # every "first" starts from a freshly loaded model
+            del llm
+            llm = prompt_refiner.load_llm(model_path, n_ctx=args.n_ctx, n_threads=args.threads)
+        prompts = PROMPTS[repeat % len(PROMPTS):] + PROMPTS[:repeat % len(PROMPTS)]
+        cases["first"].append(timed_refine(llm, prompts[0], args.max_tokens))
+        cases["repeat"].append(timed_refine(llm, prompts[1], args.max_tokens))
+        llm(OTHER_PROMPT, max_tokens=8)
+        cases["interleaved"].append(timed_refine(llm, prompts[2], args.max_tokens))
+
+    cached_tokens = len(prompt_refiner._prefix_states[llm][0]) if llm in prompt_refiner._prefix_states else 0
+    return {
+        "prefix_cache": prefix_cache,
+        "cached_tokens": cached_tokens,
+        "load_s": load_s,
+        "cases": {name: {"first_text_s": statistics.median(r[0] for r in runs),
+                         "total_s": statistics.median(r[1] for r in runs)}
+                  for name, runs in cases.items()}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark refinement latency with and without the prefix cache")
+    parser.add_argument("--model", required=True, help="GGUF model file")
+    parser.add_argument("--threads", type=int, default=4, help="llama.cpp threads (the app uses 4)")
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--max-tokens", type=int, default=16, help="Tokens generated per refinement")
+    parser.add_argument("--repeats", type=int, default=3, help="Rounds per mode; medians are reported")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing prompt_refiner.py")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.app_dir)
+    print(f"Refining {args.repeats}x3 prompts per mode with {os.path.basename(args.model)} "
+          f"({args.threads} threads, {args.max_tokens} tokens each)...")
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        from prompt_refiner import load_llm
+
+        load_llm(args.model, n_ctx=args.n_ctx, n_threads=args.threads)  # warm-up load, so both modes read a cached file
+        results = [bench_mode(args.model, prefix_cache, args) for prefix_cache in (False, True)]
+
+    print(f"\n{'mode':<18} {'case':<12} {'first text s':>13} {'total s':>9}")
+    for result in results:
+        mode = f"prefix ({result['cached_tokens']} tok)" if result["prefix_cache"] else "no prefix"
+        for case, row in result["cases"].items():
+            print(f"{mode:<18} {case:<12} {row['first_text_s']:>13.3f} {row['total_s']:>9.3f}")
+            mode = ""
+    print(f"\nModel load: {results[0]['load_s']:.2f}s without the prefix, {results[1]['load_s']:.2f}s with it "
+          f"(includes evaluating it once)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"model": args.model, "threads": args.threads, "results": results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Startup benchmark
+Cold start of the Qt app: wall time from launching a fresh interpreter to
+the first paint of the main window, split into module import and window
+construction, plus an -X importtime report of what the import pulls in.
+
+Also a regression check. It exits non-zero if the median time to first
+paint is over --budget seconds, or if any heavy module (torch,
+transformers, PIL, numpy, llama_cpp, requests, ...) is already imported when
+the window is shown; those belong behind the feature that first needs them.
+
+Examples:
+  python3 benchmarks/bench_startup.py                     # 5 launches, importtime report, 3s budget
+  python3 benchmarks/bench_startup.py --budget 1.5 --repeats 10
+  python3 benchmarks/bench_startup.py --offscreen --json startup.json   # headless CI
+"""
+
+# The child process imports only these before the app, so the importtime report shows the app's own imports;
+# the parent's imports (argparse, subprocess, ...) are done inside main()
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "mac-installer")
+APP_MODULE = "prompt_builder_qt_local_only"
+
+# Modules that cost tens to thousands of milliseconds to import and are only needed once a feature is used
+HEAVY_MODULES = ("torch", "transformers", "PIL", "numpy", "llama_cpp", "requests", "cv2", "onnxruntime", "psutil")
+
+_IMPORTTIME = r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)"
+
+
+def child(app_dir):
+    """Import the app, show its window and print timings as JSON at the first paint, then exit."""
+    start = time.perf_counter()
+    sys.path.insert(0, app_dir)
+    os.chdir(app_dir)  # the app looks for its logo relative to the working directory
+    app_module = __import__(APP_MODULE)
+    import_s = time.perf_counter() - start
+
+    from PyQt6.QtCore import QEvent, QObject
+    from PyQt6.QtWidgets import QApplication
+
+    app = QApplication(sys.argv[:1])
+    window = app_module.PromptBuilderQt()
+    window.show()
+    window_s = time.perf_counter() - start - import_s
+    heavy = sorted(name for name in HEAVY_MODULES if name in sys.modules)
+
+    class FirstPaint(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Type.Paint:
+                print(json.dumps({"import_s": import_s, "window_s": window_s,
+                                  "paint_s": time.perf_counter() - start, "heavy_modules": heavy}), flush=True)
+                os._exit(0)  # don't wait for background work (LLM preload) to finish
+            return False
+
+    first_paint = FirstPaint()
+    app.installEventFilter(first_paint)
+    app.exec()
+
+
+def launch(app_dir, importtime=False, timeout=60):
+    """Start a child; return its measurements plus wall_s (launch to first paint) and, optionally, importtime."""
+    import subprocess
+    import tempfile
+    import threading
+
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [
+        os.path.abspath(__file__), "--child", app_dir]
+    painted = []
+
+    def read_stdout():
+        for line in process.stdout:
+            if line.startswith("{") and not painted:
+                painted.append((json.loads(line), time.perf_counter() - start))
+
+    # stderr goes to a file: -X importtime output can fill a pipe and block the child before it paints.
+    # stdout is read on a thread so the deadline applies even while the child prints nothing.
+    with tempfile.TemporaryFile(mode="w+") as stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+        reader = threading.Thread(target=read_stdout, daemon=True)
+        reader.start()
+        try:
+            process.wait(timeout=timeout)
+            timed_out = False
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            timed_out = True
+        reader.join(timeout=5)
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+
+    if not painted:
+        reason = f"timed out after {timeout}s" if timed_out else f"exit code {process.returncode}"
+        raise RuntimeError(f"App did not paint ({reason}):\n{stderr.strip()[-2000:]}")
+    result, result["wall_s"] = painted[0]
+    if importtime:
+        result["importtime"] = parse_importtime(stderr)
+    return result
+
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from -X importtime output, in import order."""
+    import re
+
+    entries = []
+    for line in stderr.splitlines():
+        match = re.match(_IMPORTTIME, line)
+        if match:
+            entries.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return entries
+
+
+def print_importtime(entries, top):
+    total_us = sum(self_us for _, self_us, _, _ in entries)
+    print(f"\nImports before first paint: {len(entries)} modules, {total_us / 1000:.0f} ms")
+    print(f"\n{'top-level import':<40} {'cumulative ms':>14}")
+    for name, _, cumulative_us, _ in sorted((e for e in entries if e[3] == 0), key=lambda e: -e[2])[:top]:
+        print(f"{name:<40} {cumulative_us / 1000:>14.1f}")
+    print(f"\n{'module':<40} {'self ms':>14}")
+    for name, self_us, _, _ in sorted(entries, key=lambda e: -e[1])[:top]:
+        print(f"{name:<40} {self_us / 1000:>14.1f}")
+
+
+def main():
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="Measure cold start to first paint and check it against a budget")
+    parser.add_argument("--repeats", type=int, default=5, help="Launches to time; the median is checked")
+    parser.add_argument("--budget", type=float, default=3.0, help="Seconds allowed from launch to first paint")
+    parser.add_argument("--top", type=int, default=15, help="Rows in the importtime report")
+    parser.add_argument("--no-importtime", action="store_true", help="Skip the -X importtime launch")
+    parser.add_argument("--offscreen", action="store_true", help="Use Qt's offscreen platform (no display needed)")
+    parser.add_argument("--app-dir", default=DEFAULT_APP_DIR, help="Directory containing the Qt app")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    if args.offscreen:
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"  # inherited by the children
+
+    app_dir = os.path.abspath(args.app_dir)
+    print(f"Launching the app {args.repeats}x...")
+    launch(app_dir)  # warm the OS file cache so every timed launch starts alike
+    runs = [launch(app_dir) for _ in range(args.repeats)]
+    results = {key: statistics.median(run[key] for run in runs)
+               for key in ("wall_s", "import_s", "window_s", "paint_s")}
+    results["heavy_modules"] = sorted({name for run in runs for name in run["heavy_modules"]})
+    results["budget_s"] = args.budget
+
+    print(f"\n{'stage':<28} {'median s':>9}")
+    print(f"{'import ' + APP_MODULE[:20]:<28} {results['import_s']:>9.3f}")
+    print(f"{'build + show window':<28} {results['window_s']:>9.3f}")
+    print(f"{'first paint (in process)':<28} {results['paint_s']:>9.3f}")
+    print(f"{'launch to first paint':<28} {results['wall_s']:>9.3f}")
+
+    if not args.no_importtime:
+        entries = launch(app_dir, importtime=True)["importtime"]
+        results["imports"] = [{"module": name, "self_us": self_us, "cumulative_us": cumulative_us}
+                              for name, self_us, cumulative_us, depth in entries if depth == 0]
+        print_importtime(entries, args.top)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    failures = []
+    if results["wall_s"] > args.budget:
+        failures.append(f"first paint after {results['wall_s']:.2f}s, over the {args.budget:.2f}s budget")
+    if results["heavy_modules"]:
+        failures.append(f"heavy modules imported before the window was shown: {', '.join(results['heavy_modules'])}")
+    for failure in failures:
+        print(f"\n❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"\n✅ First paint in {results['wall_s']:.2f}s (budget {args.budget:.2f}s), no heavy imports at startup")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:  # parsed by hand so argparse stays out of the child's imports
+        child(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,203 @@
+"""
+Async Pipeline
+Awaitable captioning and prompt refinement for asyncio programs, such as an
+async web service embedding the pipeline.
+
+Model work runs on dedicated thread pools, one for captioning and one for
+the LLM, so the event loop never blocks. Each kind of work admits a bounded
+number of calls at a time (max_pending); past that, callers wait for a slot
+instead of queueing unbounded work behind the CPU. A call's timeout covers
+waiting for a slot and the work itself. A timed-out or cancelled call is
+dropped from the queue if it had not started; if it had, the torch caption
+decoder or the llama.cpp stream stops at its next step. A slot is only
+freed once its work has actually stopped.
+
+Usage:
+  async with AsyncPipeline(llm_path="models/phi-3-mini-4k-instruct-q4.gguf") as pipeline:
+      caption = await pipeline.caption("photo.jpg")
+      prompts = await pipeline.prompts("photo.jpg")
+      refined = await pipeline.refine(prompts[0], timeout=60)
+
+  python3 async_pipeline.py photo1.jpg photo2.jpg --llm models/phi-3-mini-4k-instruct-q4.gguf
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from collections import Counter
+
+from generate_prompts_from_image import build_prompt_variations, get_captioner
+from prompt_refiner import load_llm, refine_prompt
+
+DEFAULT_TIMEOUT = float(os.environ.get("PROMPT_BUILDER_ASYNC_TIMEOUT", 120))
+DEFAULT_CAPTION_WORKERS = int(os.environ.get("PROMPT_BUILDER_CAPTION_CONCURRENCY", 1))
+DEFAULT_MAX_PENDING = int(os.environ.get("PROMPT_BUILDER_MAX_PENDING", 8))
+
+
+def _call_soon(loop, callback):
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass  # the loop has already closed; nothing is waiting on the slot
+
+
+class AsyncPipeline:
+    """asyncio front-end over the captioner and the local LLM, with bounded concurrency and timeouts."""
+
+    def __init__(self, model_size="base", preset=None, caption_workers=DEFAULT_CAPTION_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING, timeout=DEFAULT_TIMEOUT, llm=None, llm_path=None):
+        self.model_size = model_size
+        self.preset = preset
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self.llm = llm
+        self.llm_path = llm_path
+        self._executors = {
+            # More than one caption thread only helps if the captioner leaves cores idle
+            "caption": concurrent.futures.ThreadPoolExecutor(max_workers=max(1, caption_workers),
+                                                             thread_name_prefix="async-caption"),
+            # A llama.cpp model is not re-entrant, so refinement is strictly one at a time
+            "refine": concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-refine")
+        }
+        self._slots = {}  # kind -> asyncio.Semaphore, created on first use inside the running loop
+        self._in_flight = Counter()
+        self.counters = Counter()  # "<kind>_<ok|error|timeout|cancelled>"
+        self._closed = False
+
+    async def _run(self, kind, timeout, fn, *args):
+        """Run fn(*args, stop_event) on the kind's executor once a slot is free."""
+        if self._closed:
+            raise RuntimeError("AsyncPipeline is closed")
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(kind)
+        if slots is None:
+            slots = self._slots[kind] = asyncio.Semaphore(self.max_pending)
+        stop = threading.Event()
+        future = None
+
+        def release():
+            self._in_flight[kind] -= 1
+            slots.release()
+
+        async def admitted():
+            nonlocal future
+            await slots.acquire()
+            try:
+                future = self._executors[kind].submit(fn, *args, stop)
+            except BaseException:
+                slots.release()
+                raise
+            self._in_flight[kind] += 1
+            # Runs on the executor thread once the work has really stopped, however the call ended
+            future.add_done_callback(lambda _: _call_soon(loop, release))
+            return await asyncio.wrap_future(future)
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            result = await asyncio.wait_for(admitted(), timeout or None)
+        except asyncio.TimeoutError:
+            self.counters[f"{kind}_timeout"] += 1
+            stop.set()
+            raise
+        except asyncio.CancelledError:
+            self.counters[f"{kind}_cancelled"] += 1
+            stop.set()
+            if future is not None:
+                future.cancel()
+            raise
+        except Exception:
+            self.counters[f"{kind}_error"] += 1
+            raise
+        self.counters[f"{kind}_ok"] += 1
+        return result
+
+    def _caption_sync(self, image_path, prompt_type, max_length, stop):
+        if stop.is_set():
+            return None
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        # Same captioner as generate_prompts_from_image: a warm caption server if there is one, else the pool
+        blip = get_captioner(self.model_size)
+        return blip.generate_caption(image_path, prompt_type=prompt_type, max_length=max_length,
+                                     decoding=self.preset, stop_event=stop)
+
+    def _refine_sync(self, text, stop):
+        if stop.is_set():
+            return None
+        if self.llm is None:
+            if not self.llm_path:
+                raise RuntimeError("No local LLM configured (pass llm or llm_path)")
+            self.llm = load_llm(self.llm_path)  # only ever touched from the refine thread
+        return refine_prompt(self.llm, text, stop_event=stop)
+
+    async def caption(self, image_path, prompt_type="detailed", max_length=60, timeout=None):
+        """Caption an image; None if it can't be read. Raises asyncio.TimeoutError past timeout seconds."""
+        return await self._run("caption", timeout, self._caption_sync, image_path, prompt_type, max_length)
+
+    async def prompts(self, image_path, timeout=None):
+        """The three prompt variations generate_prompts_from_image returns, without blocking the loop."""
+        return build_prompt_variations(await self.caption(image_path, timeout=timeout) or "")
+
+    async def refine(self, text, timeout=None):
+        """Improve a prompt with the local LLM. Raises asyncio.TimeoutError past timeout seconds."""
+        return await self._run("refine", timeout, self._refine_sync, text)
+
+    def stats(self):
+        return {
+            "in_flight": {kind: self._in_flight[kind] for kind in self._executors},
+            "max_pending": self.max_pending,
+            "counters": dict(self.counters)
+        }
+
+    def close(self, wait=True):
+        """Stop accepting calls and shut the executors down (work already running is not interrupted)."""
+        self._closed = True
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+async def _demo(args):
+    async with AsyncPipeline(args.model_size, preset=args.preset, caption_workers=args.caption_workers,
+                             timeout=args.timeout, llm_path=args.llm) as pipeline:
+        start_time = time.time()
+        results = await asyncio.gather(*(pipeline.prompts(path) for path in args.images), return_exceptions=True)
+        for path, prompts in zip(args.images, results):
+            if isinstance(prompts, BaseException):
+                print(f"❌ {path}: {type(prompts).__name__}: {prompts}")
+                continue
+            print(f"\n📸 {path}")
+            for prompt in prompts:
+                print(f"  • {prompt}")
+            if args.llm:
+                try:
+                    print(f"  ✨ {await pipeline.refine(prompts[0])}")
+                except Exception as e:
+                    print(f"  ❌ Refinement failed: {type(e).__name__}: {e}")
+        print(f"\n✅ {len(args.images)} images in {time.time() - start_time:.2f}s {pipeline.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caption (and optionally refine) images through the async API")
+    parser.add_argument('images', nargs='+', help='Image files, captioned concurrently')
+    parser.add_argument('--model-size', choices=['base', 'large'], default='base')
+    parser.add_argument('--preset', help='Decoding preset (default: the captioner default)')
+    parser.add_argument('--llm', help='GGUF model for refining the first prompt of each image')
+    parser.add_argument('--caption-workers', type=int, default=DEFAULT_CAPTION_WORKERS)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Seconds per call (0: no limit)')
+    asyncio.run(_demo(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,188 @@
 import torch
-from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers import BlipProcessor, BlipForConditionalGeneration, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 import platform
+import queue
+import threading
 import time
 import argparse
 import os
+import sys
+import json
+import glob
+import contextlib
+import concurrent.futures
+from collections import deque, namedtuple
+from caption_cache import CaptionCache, DEFAULT_CACHE_PATH
+from image_loader import load_image, model_input_size
+from instrumentation import add_arguments as add_instrumentation_arguments, instrument, span
+from model_snapshot import resolve_model_name, resolve_snapshot
+from near_duplicates import DEFAULT_MAX_DISTANCE, HASH_METHODS, NearDuplicateIndex, settings_digest
 
-class AppleSiliconBLIP:
-    def __init__(self, model_size="base"):
-        print("🍎 Initializing BLIP-1 for Apple Silicon...")
-        self.device = self._get_device()
+CAPTION_PROMPTS = {
+    "simple": "",
+    "detailed": "a detailed description of",
+    "creative": "an artistic description of",
+    "custom": "describe this image for AI art generation:"
+}
 
-        model_names = {
-            "base": "Salesforce/blip-image-captioning-base",
-            "large": "Salesforce/blip-image-captioning-large"
-        }
-        model_name = model_names.get(model_size, model_names["base"])
-        print(f"Loading model: {model_name}")
+QUANTIZE_MODES = ("none", "int8")
+BACKENDS = ("torch", "onnx")
+DTYPES = ("float32", "float16", "bfloat16")
 
-        print("Loading processor...")
-        self.processor = BlipProcessor.from_pretrained(model_name)
+# Speed/quality trade-offs for model.generate; beam-4-quality is the historical default
+DECODING_PRESETS = {
+    "greedy-fast": {"num_beams": 1},
+    "beam-2": {"num_beams": 2, "early_stopping": True},
+    "beam-4-quality": {"num_beams": 4, "early_stopping": True}
+}
+DEFAULT_PRESET = "beam-4-quality"
+DECODING_OVERRIDES = ("num_beams", "max_new_tokens", "length_penalty",
+                      "repetition_penalty", "no_repeat_ngram_size")
+
+def resolve_decoding(preset=None, **overrides):
+    """Return generate() settings for a named preset plus explicit overrides.
+
+    Overrides set to None are ignored, so CLI arguments can be passed through as-is.
+    """
+    preset = preset or DEFAULT_PRESET
+    if preset not in DECODING_PRESETS:
+        raise ValueError(f"Unknown decoding preset: {preset!r} (expected one of {list(DECODING_PRESETS)})")
+    decoding = dict(DECODING_PRESETS[preset])
+    for key, value in overrides.items():
+        if key not in DECODING_OVERRIDES:
+            raise TypeError(f"Unknown decoding option: {key!r} (expected one of {DECODING_OVERRIDES})")
+        if value is not None:
+            decoding[key] = value
+    if decoding.get("num_beams", 1) == 1:
+        # Beam-only settings make transformers warn on greedy decoding
+        decoding.pop("early_stopping", None)
+        decoding.pop("length_penalty", None)
+    return decoding
+
+def _from_pretrained_dtype_kwarg():
+    """transformers 4.56 renamed from_pretrained's torch_dtype argument to dtype."""
+    import transformers
+    major, minor = (int(part) for part in transformers.__version__.split(".")[:2])
+    return "dtype" if (major, minor) >= (4, 56) else "torch_dtype"
+
+def default_device():
+    if torch.backends.mps.is_available():
+        return "mps"
+    if torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+class _TokenQueueStreamer(BaseStreamer):
+    """Hands the token ids generate() produces to another thread through a queue."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+
+    def put(self, value):
+        self.queue.put(value.reshape(-1).tolist())  # the prompt ids first, then one token per step
 
-        print("Loading model...")
-        self.model = BlipForConditionalGeneration.from_pretrained(model_name)
-        self.model.to(self.device)
-        self.model.eval()
+    def end(self):
+        self.queue.put(None)
 
-        print(f"✅ BLIP-1 loaded successfully on {self.device}")
+    def __iter__(self):
+        return iter(self.queue.get, None)
+
+class _StopWhenSet(StoppingCriteria):
+    """Stops generate() at the next step once the event is set (e.g. the stream was closed)."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff", ".tif", ".webp")
+
+def iter_image_paths(inputs, recursive=False):
+    """Lazily expand files, directories, glob patterns and "-" (paths on stdin)."""
+    for item in inputs:
+        if item == "-":
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line
+        elif os.path.isdir(item):
+            if recursive:
+                for root, dirs, files in os.walk(item):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(IMAGE_EXTENSIONS):
+                            yield os.path.join(root, name)
+            else:
+                for name in sorted(os.listdir(item)):
+                    path = os.path.join(item, name)
+                    if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+                        yield path
+        elif glob.has_magic(item):
+            for path in sorted(glob.iglob(item, recursive=True)):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield item  # plain path; a missing file is reported in its result
+
+# What the caption cache and near-duplicate index need to look up or store one caption
+_CaptionKey = namedtuple("_CaptionKey", "digest_key image_path settings")
+
+class AppleSiliconBLIP:
+    def __init__(self, model_size="base", cache=None, quantize=None, device=None, decoding=None, backend="torch",
+                 dtype=None, low_memory=True, near_duplicates=None):
+        print("🍎 Initializing BLIP-1 for Apple Silicon...")
+        if quantize in (None, "none"):
+            quantize = None
+        elif quantize not in QUANTIZE_MODES:
+            raise ValueError(f"Unknown quantize mode: {quantize!r} (expected one of {QUANTIZE_MODES})")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend!r} (expected one of {BACKENDS})")
+        if backend == "onnx" and quantize:
+            raise ValueError("int8 quantization applies to the torch backend only")
+        dtype = dtype or "float32"
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype: {dtype!r} (expected one of {DTYPES})")
+        if dtype != "float32" and (quantize or backend == "onnx"):
+            raise ValueError(f"{dtype} weights apply to the unquantized torch backend only")
+        self.quantize = quantize
+        self.backend = backend
+        self.onnx = None
+        if quantize:
+            # Dynamic int8 kernels only exist for CPU
+            print(f"🔧 {quantize} quantization requested, using CPU")
+            self.device = "cpu"
+        elif backend == "onnx":
+            print("🔧 ONNX Runtime backend requested, using CPU")
+            self.device = "cpu"
+        else:
+            self.device = device or self._get_device()
+
+        model_name = resolve_model_name(model_size)
+        self.model_name = model_name
+        # An install-time snapshot is read strictly offline; otherwise fall back to the hub cache
+        self.snapshot = resolve_snapshot(model_name)
+        self.model_path = self.snapshot or model_name
+        self.pretrained_kwargs = {"local_files_only": True} if self.snapshot else {}
+        self.dtype = quantize or dtype
+        self.torch_dtype = getattr(torch, dtype)
+        self.low_memory = low_memory
+        # Identifies the weights as actually run, so quantized/half-precision captions get their own cache entries
+        variant = quantize or (dtype if dtype != "float32" else None) or (backend if backend != "torch" else None)
+        self.model_id = f"{model_name}+{variant}" if variant else model_name
+        self.cache = cache  # optional caption_cache.CaptionCache
+        self.near_duplicates = near_duplicates  # optional near_duplicates.NearDuplicateIndex, checked on cache misses
+        # Default decoding for every call; each call can still pass its own preset or dict
+        self.decoding = self._resolve_decoding(decoding)
+        print(f"Loading model: {model_name}" + (f" (offline snapshot {self.snapshot})" if self.snapshot else ""))
+        start_time = time.time()
+        with span("load", model=self.model_id, device=self.device):
+            self._load_model()
+        self.load_seconds = time.time() - start_time
+
+        print(f"✅ BLIP-1 loaded successfully on {self.device} ({self.dtype}, {self.load_seconds:.1f}s)")
         if self.device == "mps":
             print("🔧 Applying Apple Silicon optimizations...")
             try:
@@ -35,76 +191,630 @@ class AppleSiliconBLIP:
             except:
                 pass
 
+    def _load_model(self):
+        print("Loading processor...")
+        self.processor = BlipProcessor.from_pretrained(self.model_path, **self.pretrained_kwargs)
+
+        if self.backend == "onnx":
+            self.model = None
+            self._load_onnx()
+        else:
+            print("Loading model...")
+            if self.low_memory:
+                self.model = self._from_pretrained_low_memory()
+            else:
+                # Materialises fp32 weights in RAM first, then copies them to the device
+                self.model = BlipForConditionalGeneration.from_pretrained(self.model_path, **self.pretrained_kwargs)
+                self.model.to(self.device, self.torch_dtype)
+            self.model.eval()
+            if self.quantize == "int8":
+                self._quantize_int8()
+            text_config = self.model.config.text_config
+            self.bos_token_id = text_config.bos_token_id
+            self.eos_token_id = text_config.sep_token_id
+            self.pad_token_id = text_config.pad_token_id
+        self.input_size = model_input_size(self.processor)
+
+    def _from_pretrained_low_memory(self):
+        """Load weights straight into their final dtype and device.
+
+        Safetensors checkpoints are memory-mapped and each tensor is
+        materialised once, on the target device, instead of building a full
+        fp32 copy in RAM and then moving it, which roughly halves peak RSS.
+        """
+        kwargs = {_from_pretrained_dtype_kwarg(): self.torch_dtype, "low_cpu_mem_usage": True,
+                  "use_safetensors": True, **self.pretrained_kwargs}
+        if self.device != "cpu":
+            kwargs["device_map"] = {"": self.device}
+        try:
+            return BlipForConditionalGeneration.from_pretrained(self.model_path, **kwargs)
+        except OSError:
+            kwargs.pop("use_safetensors")
+            # Older snapshots may only ship pytorch_model.bin, which can't be memory-mapped
+            print("ℹ️  No safetensors weights found, loading the .bin checkpoint")
+        except (ImportError, ValueError) as e:
+            # device_map/low_cpu_mem_usage need accelerate on older transformers
+            print(f"⚠️  Low-memory loading unavailable ({e}), moving weights to {self.device} after loading")
+            kwargs.pop("device_map", None)
+            kwargs.pop("low_cpu_mem_usage")
+        model = BlipForConditionalGeneration.from_pretrained(self.model_path, **kwargs)
+        return model.to(self.device)
+
+    def _quantize_int8(self):
+        """Swap the Linear layers of the text decoder and vision encoder for dynamic int8 ones.
+
+        Weights are stored as int8 and activations are quantized on the fly,
+        which roughly halves the cost of the matmuls that dominate CPU beam search.
+        """
+        from torch.ao.quantization import quantize_dynamic
+
+        print("🔧 Applying dynamic int8 quantization...")
+        start_time = time.time()
+        self.model.text_decoder = quantize_dynamic(self.model.text_decoder, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.vision_model = quantize_dynamic(self.model.vision_model, {torch.nn.Linear}, dtype=torch.qint8)
+        print(f"✅ Quantized in {(time.time() - start_time):.2f}s")
+
+    def _load_onnx(self):
+        """Start ONNX Runtime sessions, exporting the graphs first if they aren't cached yet."""
+        from blip_onnx import BlipOnnxRuntime, export_blip_onnx, onnx_export_dir, read_manifest
+
+        export_dir = onnx_export_dir(self.model_name)
+        if read_manifest(export_dir) is None:
+            print("Loading model for one-time ONNX export...")
+            model = BlipForConditionalGeneration.from_pretrained(self.model_path, **self.pretrained_kwargs)
+            export_blip_onnx(model, self.model_name, export_dir)
+            del model
+
+        print("Loading ONNX Runtime sessions...")
+        self.onnx = BlipOnnxRuntime(export_dir)
+        self.bos_token_id = self.onnx.bos_token_id
+        self.eos_token_id = self.onnx.eos_token_id
+        self.pad_token_id = self.onnx.pad_token_id
+
     def _get_device(self):
-        if torch.backends.mps.is_available():
+        device = default_device()
+        if device == "mps":
             print("✅ Using Apple Silicon GPU (MPS)")
-            return "mps"
-        elif torch.cuda.is_available():
+        elif device == "cuda":
             print("✅ Using NVIDIA GPU (CUDA)")
-            return "cuda"
         else:
             print("⚠️  Using CPU")
-            return "cpu"
+        return device
 
-    def generate_caption(self, image_path, prompt_type="detailed", max_length=50):
-        print(f"📸 Processing: {image_path}")
+    def memory_bytes(self):
+        """Approximate bytes held by the loaded weights (graph files for the ONNX backend)."""
+        if self.onnx is not None:
+            return self.onnx.memory_bytes()
+        total = 0
+        for tensor in list(self.model.parameters()) + list(self.model.buffers()):
+            total += tensor.numel() * tensor.element_size()
+        # Dynamically quantized Linear layers keep their int8 weights outside parameters()
+        for module in self.model.modules():
+            packed = getattr(module, "_packed_params", None)
+            if packed is not None:
+                try:
+                    weight, bias = packed._weight_bias()
+                    total += weight.numel() * weight.element_size()
+                    if bias is not None:
+                        total += bias.numel() * bias.element_size()
+                except Exception:
+                    pass
+        return total
+
+    def _load_image(self, image_path):
+        with span("decode"):
+            return load_image(image_path, self.input_size)
+
+    def _resolve_decoding(self, decoding):
+        """Accept None (instance default), a preset name, or a resolve_decoding() dict."""
+        if decoding is None:
+            return getattr(self, "decoding", None) or resolve_decoding()
+        if isinstance(decoding, str):
+            return resolve_decoding(decoding)
+        return dict(decoding)
+
+    def _cache_key(self, image_path, prompt_type, max_length, decoding):
+        if self.cache is None and self.near_duplicates is None:
+            return None
+        generation_kwargs = self._generation_kwargs(max_length, decoding)
         try:
-            image = Image.open(image_path).convert('RGB')
-            print(f"Image loaded: {image.size}")
-        except Exception as e:
-            print(f"❌ Error loading image: {e}")
+            digest_key = (self.cache.make_key(image_path, self.model_id, prompt_type, generation_kwargs)
+                          if self.cache is not None else None)
+        except OSError:
+            return None  # unreadable file; let the normal load path report it
+        settings = None
+        if self.near_duplicates is not None:
+            settings = settings_digest(self.model_id, prompt_type, generation_kwargs)
+        return _CaptionKey(digest_key, image_path, settings)
+
+    def _cached_caption(self, cache_key):
+        if cache_key is None:
             return None
+        caption = self.cache.get(cache_key.digest_key) if cache_key.digest_key is not None else None
+        if caption is None and cache_key.settings is not None:
+            caption = self.near_duplicates.lookup(cache_key.image_path, cache_key.settings)
+            if caption is not None:
+                # Not backfilled into the exact cache: that would outlive a stricter distance or another hash method
+                print(f"♻️  Reusing the caption of a near-duplicate of {os.path.basename(cache_key.image_path)}")
+        return caption
+
+    def _store_caption(self, cache_key, caption):
+        if cache_key is None or not caption:
+            return
+        if cache_key.digest_key is not None:
+            self.cache.put(cache_key.digest_key, caption)
+        if cache_key.settings is not None:
+            self.near_duplicates.add(cache_key.image_path, cache_key.settings, caption)
 
-        prompts = {
-            "simple": "",
-            "detailed": "a detailed description of",
-            "creative": "an artistic description of",
-            "custom": "describe this image for AI art generation:"
+    def _generation_kwargs(self, max_length, decoding):
+        kwargs = {
+            "max_length": max_length,
+            "do_sample": False  # deterministic, avoids pad_token_id conflicts
         }
-        prompt = prompts.get(prompt_type, "")
+        kwargs.update(decoding)
+        if "max_new_tokens" in kwargs:
+            del kwargs["max_length"]  # transformers gives max_new_tokens precedence anyway
+        return kwargs
 
-        print(f"🔄 Generating {prompt_type} caption...")
-        start_time = time.time()
+    def _preprocess(self, images):
+        with span("preprocess", batch=len(images)):
+            return self.processor(images=images, return_tensors="pt")["pixel_values"]
 
-        if prompt:
-            inputs = self.processor(image, prompt, return_tensors="pt").to(self.device)
-        else:
-            inputs = self.processor(image, return_tensors="pt").to(self.device)
+    def _encode_pixels(self, pixel_values):
+        with span("encode", batch=pixel_values.shape[0]):
+            if self.onnx is not None:
+                return self.onnx.encode(pixel_values.numpy())
+            with torch.no_grad():
+                with torch.inference_mode():
+                    pixel_values = pixel_values.to(self.device, self.torch_dtype)
+                    return self.model.vision_model(pixel_values=pixel_values)[0]
+
+    def _encode_images(self, images):
+        """Run the ViT vision encoder once and return the image embeddings."""
+        return self._encode_pixels(self._preprocess(images))
+
+    def _decode_captions(self, image_embeds, prompt, max_length, decoding, **generate_kwargs):
+        """Run only the text decoder on precomputed image embeddings.
+
+        Mirrors BlipForConditionalGeneration.generate, minus the vision pass,
+        so the same embeddings can be decoded with several prompts.
+        """
+        with span("generate", batch=image_embeds.shape[0], num_beams=decoding.get("num_beams", 1)):
+            generated_ids = self._generate_ids(image_embeds, prompt, max_length, decoding, **generate_kwargs)
+
+        with span("tokenizer_decode", batch=len(generated_ids)):
+            return [self._ids_to_caption(ids, prompt) for ids in generated_ids]
+
+    def _ids_to_caption(self, ids, prompt):
+        caption = self.processor.decode(ids, skip_special_tokens=True)
+        if prompt and caption.startswith(prompt):
+            caption = caption[len(prompt):].strip()
+        return caption
+
+    def _onnx_prompt_ids(self, prompt):
+        # Every row shares the same prompt, so no padding or attention mask is needed
+        prompt_ids = self.processor.tokenizer(prompt)["input_ids"][:-1]
+        prompt_ids[0] = self.bos_token_id
+        return prompt_ids
+
+    def _generate_ids(self, image_embeds, prompt, max_length, decoding, **generate_kwargs):
+        """Run the text decoder; generate_kwargs (streamer, stopping_criteria) go to the torch generate()."""
+        if self.onnx is not None:
+            return self.onnx.generate(image_embeds, self._onnx_prompt_ids(prompt),
+                                      self._generation_kwargs(max_length, decoding))
+
+        text_inputs = self.processor.tokenizer([prompt] * image_embeds.shape[0], padding=True,
+                                               return_tensors="pt").to(self.device)
+        input_ids = text_inputs["input_ids"].clone()
+        input_ids[:, 0] = self.bos_token_id
+        image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
 
         with torch.no_grad():
             with torch.inference_mode():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    max_length=max_length,
-                    num_beams=4,
-                    early_stopping=True,
-                    do_sample=False  # deterministic, avoids pad_token_id conflicts
+                return self.model.text_decoder.generate(
+                    input_ids=input_ids[:, :-1],
+                    attention_mask=text_inputs["attention_mask"][:, :-1],
+                    eos_token_id=self.eos_token_id,
+                    pad_token_id=self.pad_token_id,
+                    encoder_hidden_states=image_embeds,
+                    encoder_attention_mask=image_attention_mask,
+                    **self._generation_kwargs(max_length, decoding),
+                    **generate_kwargs
                 )
 
-        caption = self.processor.decode(generated_ids[0], skip_special_tokens=True)
-        if prompt and caption.startswith(prompt):
-            caption = caption[len(prompt):].strip()
+    def _stream_ids(self, image_embeds, prompt, max_length, decoding):
+        """Yield the growing token-id list of one caption as the decoder produces it.
 
-        end_time = time.time()
-        print(f"✅ Generated in {(end_time - start_time):.2f}s: {caption}")
+        The torch decoder runs generate() on a worker thread that feeds a
+        queue; closing this generator early stops generate() at its next step.
+        """
+        if self.onnx is not None:
+            yield from self.onnx.stream(image_embeds, self._onnx_prompt_ids(prompt),
+                                        self._generation_kwargs(max_length, decoding))
+            return
+
+        streamer = _TokenQueueStreamer()
+        stop = threading.Event()
 
+        def run():
+            try:
+                self._generate_ids(image_embeds, prompt, max_length, decoding, streamer=streamer,
+                                   stopping_criteria=StoppingCriteriaList([_StopWhenSet(stop)]))
+            except BaseException as e:
+                streamer.error = e
+            finally:
+                streamer.end()  # a second end() after generate's own is harmless
+
+        worker = threading.Thread(target=run, name="caption-stream", daemon=True)
+        worker.start()
+        try:
+            ids = []
+            for tokens in streamer:
+                ids.extend(tokens)
+                yield ids
+            if streamer.error is not None:
+                raise streamer.error
+        finally:
+            stop.set()
+            worker.join()
+
+    def _release_cache(self):
         if self.device == "mps":
             try:
                 torch.backends.mps.empty_cache()
             except:
                 pass
+
+    def _generate_batch(self, images, prompt, max_length, decoding, **generate_kwargs):
+        image_embeds = self._encode_images(images)
+        captions = self._decode_captions(image_embeds, prompt, max_length, decoding, **generate_kwargs)
+        self._release_cache()
+        return captions
+
+    def generate_caption(self, image_path, prompt_type="detailed", max_length=50, decoding=None, stop_event=None):
+        """Caption one image; returns None if it can't be read or stop_event (a threading.Event) gets set.
+
+        Setting stop_event stops the torch decoder at its next step (ONNX
+        finishes the caption first); a stopped caption is not cached.
+        """
+        print(f"📸 Processing: {image_path}")
+        decoding = self._resolve_decoding(decoding)
+        cache_key = self._cache_key(image_path, prompt_type, max_length, decoding)
+        cached = self._cached_caption(cache_key)
+        if cached is not None:
+            print(f"⚡ Cached {prompt_type} caption: {cached}")
+            return cached
+
+        try:
+            image = self._load_image(image_path)
+            print(f"Image loaded: {image.size}")
+        except Exception as e:
+            print(f"❌ Error loading image: {e}")
+            return None
+
+        prompt = CAPTION_PROMPTS.get(prompt_type, "")
+
+        print(f"🔄 Generating {prompt_type} caption...")
+        start_time = time.time()
+
+        generate_kwargs = {}
+        if stop_event is not None and self.onnx is None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([_StopWhenSet(stop_event)])
+        caption = self._generate_batch([image], prompt, max_length, decoding, **generate_kwargs)[0]
+        if stop_event is not None and stop_event.is_set():
+            print(f"⏹️  Stopped {prompt_type} caption after {(time.time() - start_time):.2f}s")
+            return None
+
+        end_time = time.time()
+        print(f"✅ Generated in {(end_time - start_time):.2f}s: {caption}")
+        self._store_caption(cache_key, caption)
         return caption
 
-    def generate_multiple_captions(self, image_path, styles=None):
+    def stream_caption(self, image_path, prompt_type="detailed", max_length=50, decoding=None, sample=False,
+                       temperature=0.7, top_p=0.9):
+        """Yield the caption generated so far, growing as each token is produced.
+
+        Decodes greedily (or with temperature/top-p sampling when sample=True),
+        since beam search can't commit to any text until it finishes; beam
+        settings in decoding are dropped, the penalties are kept. The last
+        value yielded is the full caption. Cached captions arrive in one piece.
+        Closing the generator early stops generation.
+        """
+        decoding = {k: v for k, v in self._resolve_decoding(decoding).items()
+                    if k not in ("num_beams", "early_stopping", "length_penalty")}
+        decoding["num_beams"] = 1
+        if sample:
+            decoding.update(do_sample=True, temperature=temperature, top_p=top_p)
+
+        # Sampled captions differ every run, so only greedy ones are cached
+        cache_key = None if sample else self._cache_key(image_path, prompt_type, max_length, decoding)
+        cached = self._cached_caption(cache_key)
+        if cached is not None:
+            print(f"⚡ Cached {prompt_type} caption: {cached}")
+            yield cached
+            return
+
+        image = self._load_image(image_path)
+        prompt = CAPTION_PROMPTS.get(prompt_type, "")
+        print(f"🔄 Streaming {prompt_type} caption{' (sampling)' if sample else ''}...")
+        start_time = time.time()
+        first_text_s = None
+        caption = ""
+        image_embeds = self._encode_images([image])
+        for ids in self._stream_ids(image_embeds, prompt, max_length, decoding):
+            text = self._ids_to_caption(ids, prompt)
+            if text != caption:
+                if first_text_s is None:
+                    first_text_s = time.time() - start_time
+                caption = text
+                yield caption
+        self._release_cache()
+
+        print(f"✅ Streamed in {(time.time() - start_time):.2f}s "
+              f"(first text after {(first_text_s or 0) * 1000:.0f}ms): {caption}")
+        self._store_caption(cache_key, caption)
+
+    def caption_images(self, images, prompt_type="detailed", max_length=50, decoding=None):
+        """Caption in-memory PIL images (e.g. video frames) in one batch.
+
+        They have no file to key the caption cache on, so they always go
+        through the model; callers are expected to have deduplicated them.
+        """
+        if not images:
+            return []
+        decoding = self._resolve_decoding(decoding)
+        return self._generate_batch([image.convert("RGB") for image in images],
+                                    CAPTION_PROMPTS.get(prompt_type, ""), max_length, decoding)
+
+    def generate_captions_batch(self, image_paths, prompt_type="detailed", max_length=50, batch_size=8,
+                                decoding=None):
+        """Caption many images with one generate() call per batch.
+
+        Returns one dict per input path, in input order, with keys
+        "path", "caption" and "error". Files that fail to load or caption
+        get caption=None and the error message; the rest of the batch
+        is still captioned.
+        """
+        image_paths = list(image_paths)
+        decoding = self._resolve_decoding(decoding)
+        prompt = CAPTION_PROMPTS.get(prompt_type, "")
+        results = [None] * len(image_paths)
+
+        print(f"\n📦 Captioning {len(image_paths)} images ({prompt_type}, batch size {batch_size})...")
+        start_time = time.time()
+
+        cache_keys = [self._cache_key(path, prompt_type, max_length, decoding) for path in image_paths]
+        pending = []
+        for index, path in enumerate(image_paths):
+            cached = self._cached_caption(cache_keys[index])
+            if cached is not None:
+                results[index] = {"path": path, "caption": cached, "error": None}
+            else:
+                pending.append(index)
+        if len(pending) < len(image_paths):
+            print(f"⚡ {len(image_paths) - len(pending)} captions served from cache")
+        duplicates = {}  # index -> index of the near-identical image whose caption it reuses
+        if self.near_duplicates is not None and len(pending) > 1:
+            groups = self.near_duplicates.cluster([image_paths[index] for index in pending])
+            duplicates = {pending[row]: pending[group] for row, group in enumerate(groups) if group != row}
+            pending = [index for index in pending if index not in duplicates]
+            if duplicates:
+                print(f"♻️  {len(duplicates)} near-duplicates will reuse another image's caption")
+
+        for batch_start in range(0, len(pending), batch_size):
+            images = []
+            indices = []
+            for index in pending[batch_start:batch_start + batch_size]:
+                path = image_paths[index]
+                try:
+                    images.append(self._load_image(path))
+                    indices.append(index)
+                except Exception as e:
+                    print(f"❌ Error loading image {path}: {e}")
+                    results[index] = {"path": path, "caption": None, "error": str(e)}
+
+            if not images:
+                continue
+
+            try:
+                captions = self._generate_batch(images, prompt, max_length, decoding)
+            except Exception as e:
+                if len(images) == 1:
+                    print(f"❌ Caption generation failed for {image_paths[indices[0]]}: {e}")
+                    results[indices[0]] = {"path": image_paths[indices[0]], "caption": None, "error": str(e)}
+                    continue
+                # Retry one by one so a single bad image doesn't fail the whole batch
+                print(f"⚠️  Batch failed ({e}), retrying images individually...")
+                captions = []
+                for index, image in zip(indices, images):
+                    try:
+                        captions.append(self._generate_batch([image], prompt, max_length, decoding)[0])
+                    except Exception as single_error:
+                        print(f"❌ Caption generation failed for {image_paths[index]}: {single_error}")
+                        captions.append(single_error)
+
+            for index, caption in zip(indices, captions):
+                if isinstance(caption, Exception):
+                    results[index] = {"path": image_paths[index], "caption": None, "error": str(caption)}
+                else:
+                    results[index] = {"path": image_paths[index], "caption": caption, "error": None}
+                    self._store_caption(cache_keys[index], caption)
+
+        for index, original in duplicates.items():
+            # Borrowed captions aren't stored; the original's index entry already covers this image
+            results[index] = dict(results[original], path=image_paths[index])
+
+        elapsed = time.time() - start_time
+        failed = sum(1 for r in results if r["error"])
+        print(f"✅ Captioned {len(results) - failed}/{len(results)} images in {elapsed:.2f}s")
+        return results
+
+    def generate_multiple_captions(self, image_path, styles=None, max_length=50, decoding=None):
+        """Caption one image in several styles, encoding it only once.
+
+        The image is decoded and passed through the vision encoder a single
+        time; each style then only runs the text decoder on those embeddings.
+        """
         if styles is None:
             styles = ["simple", "detailed", "creative"]
+        decoding = self._resolve_decoding(decoding)
         results = {}
         print(f"\n🎯 Generating {len(styles)} caption styles...")
+        print(f"📸 Processing: {image_path}")
+
+        cache_keys = {}
+        pending = []
         for style in styles:
-            caption = self.generate_caption(image_path, style)
+            cache_keys[style] = self._cache_key(image_path, style, max_length, decoding)
+            cached = self._cached_caption(cache_keys[style])
+            if cached is not None:
+                print(f"⚡ Cached {style} caption: {cached}")
+                results[style] = cached
+            else:
+                pending.append(style)
+        if not pending:
+            return results
+
+        try:
+            image = self._load_image(image_path)
+            print(f"Image loaded: {image.size}")
+        except Exception as e:
+            print(f"❌ Error loading image: {e}")
+            return results
+
+        start_time = time.time()
+        image_embeds = self._encode_images([image])
+        print(f"🔍 Image encoded in {(time.time() - start_time):.2f}s")
+
+        for style in pending:
+            print(f"🔄 Generating {style} caption...")
+            style_start = time.time()
+            caption = self._decode_captions(image_embeds, CAPTION_PROMPTS.get(style, ""), max_length, decoding)[0]
+            print(f"✅ Generated in {(time.time() - style_start):.2f}s: {caption}")
             if caption:
                 results[style] = caption
-        return results
+                self._store_caption(cache_keys[style], caption)
+
+        self._release_cache()
+        return {style: results[style] for style in styles if style in results}
+
+    def _prepare_image(self, image_path, styles, max_length, decoding):
+        """Cache lookup, decode and preprocess for one image (runs on a prefetch thread)."""
+        item = {"path": image_path, "cache_keys": {}, "captions": {}, "cached": set(),
+                "pixel_values": None, "error": None, "timings": {}}
+        for style in styles:
+            item["cache_keys"][style] = self._cache_key(image_path, style, max_length, decoding)
+            cached = self._cached_caption(item["cache_keys"][style])
+            if cached is not None:
+                item["captions"][style] = cached
+                item["cached"].add(style)
+        if len(item["cached"]) == len(styles):
+            return item
+
+        try:
+            start_time = time.time()
+            image = self._load_image(image_path)
+            item["timings"]["decode_ms"] = (time.time() - start_time) * 1000
+            start_time = time.time()
+            item["pixel_values"] = self._preprocess([image])
+            item["timings"]["preprocess_ms"] = (time.time() - start_time) * 1000
+        except Exception as e:
+            item["error"] = str(e)
+        return item
+
+    def _caption_prepared(self, batch, styles, max_length, decoding):
+        to_encode = [item for item in batch if item["pixel_values"] is not None]
+        duplicates = []  # (item, near-identical item in this batch whose captions it reuses)
+        if self.near_duplicates is not None and len(to_encode) > 1:
+            groups = self.near_duplicates.cluster([item["path"] for item in to_encode])
+            duplicates = [(item, to_encode[group]) for row, (item, group) in enumerate(zip(to_encode, groups))
+                          if group != row]
+            to_encode = [item for row, item in enumerate(to_encode) if groups[row] == row]
+        if to_encode:
+            try:
+                start_time = time.time()
+                image_embeds = self._encode_pixels(torch.cat([item["pixel_values"] for item in to_encode]))
+                encode_ms = (time.time() - start_time) * 1000 / len(to_encode)
+                for item in to_encode:
+                    item["timings"]["encode_ms"] = encode_ms
+
+                for style in styles:
+                    rows = [row for row, item in enumerate(to_encode) if style not in item["captions"]]
+                    if not rows:
+                        continue
+                    start_time = time.time()
+                    captions = self._decode_captions(image_embeds[rows], CAPTION_PROMPTS.get(style, ""),
+                                                     max_length, decoding)
+                    generate_ms = (time.time() - start_time) * 1000 / len(rows)
+                    for row, caption in zip(rows, captions):
+                        item = to_encode[row]
+                        item["captions"][style] = caption
+                        item["timings"][f"generate_{style}_ms"] = generate_ms
+                        self._store_caption(item["cache_keys"][style], caption)
+            except Exception as e:
+                for item in to_encode:
+                    item["error"] = str(e)
+            self._release_cache()
+
+        for item, original in duplicates:
+            item["error"] = original["error"]
+            for style in styles:
+                if style not in item["captions"] and original["captions"].get(style) is not None:
+                    item["captions"][style] = original["captions"][style]
+                    item["cached"].add(style)  # borrowed, like an index hit, so not stored
+
+        for item in batch:
+            item["pixel_values"] = None
+            for style in styles:
+                timings = {k: round(v, 2) for k, v in item["timings"].items()
+                           if not k.startswith("generate_") or k == f"generate_{style}_ms"}
+                if f"generate_{style}_ms" in timings:
+                    timings["generate_ms"] = timings.pop(f"generate_{style}_ms")
+                caption = item["captions"].get(style)
+                yield {
+                    "path": item["path"],
+                    "style": style,
+                    "caption": caption,
+                    "cached": style in item["cached"],
+                    "error": None if caption is not None else (item["error"] or "no caption generated"),
+                    "timings": timings
+                }
+
+    def iter_captions(self, image_paths, styles=("detailed",), max_length=50, batch_size=8, prefetch_workers=2,
+                      decoding=None):
+        """Stream captions for an iterable of image paths.
+
+        Decoding and preprocessing run on a background thread pool while the
+        model captions the previous batch. At most a couple of batches are in
+        flight, so memory stays flat however many paths are queued. Yields one
+        result dict per (image, style) in input order; encode_ms and
+        generate_ms are the batch time divided by the images in the batch.
+        """
+        styles = list(styles)
+        decoding = self._resolve_decoding(decoding)
+        window = max(batch_size * 2, prefetch_workers)
+        paths = iter(image_paths)
+        pending = deque()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+            def fill():
+                while len(pending) < window:
+                    path = next(paths, None)
+                    if path is None:
+                        return
+                    pending.append(pool.submit(self._prepare_image, path, styles, max_length, decoding))
+
+            try:
+                fill()
+                while pending:
+                    batch = []
+                    while pending and len(batch) < batch_size:
+                        batch.append(pending.popleft().result())
+                        fill()
+                    yield from self._caption_prepared(batch, styles, max_length, decoding)
+            finally:
+                for future in pending:
+                    future.cancel()
 
 def main():
     parser = argparse.ArgumentParser(
@@ -115,18 +825,90 @@ Examples:
   python3 blip1_m1_optimized.py
   python3 blip1_m1_optimized.py my_photo.jpg
   python3 blip1_m1_optimized.py image.png --style detailed
+  python3 blip1_m1_optimized.py photos/ --style detailed -o captions.jsonl
+  python3 blip1_m1_optimized.py "shoots/**/*.jpg" --batch-size 16
+  python3 blip1_m1_optimized.py photos/ --workers 4 --threads-per-worker 2 -o captions.jsonl
+  find . -name "*.png" | python3 blip1_m1_optimized.py - > captions.jsonl
+  python3 blip1_m1_optimized.py photos/ --timings --trace spans.jsonl --profile cprofile
         """
     )
-    parser.add_argument('image_path', nargs='?', default='test_image.jpg', help='Path to the image file')
+    parser.add_argument('inputs', nargs='*', default=['test_image.jpg'],
+                        help='Image files, directories or glob patterns ("-" reads paths from stdin)')
     parser.add_argument('--style', choices=['simple', 'detailed', 'creative', 'all'], default='all')
     parser.add_argument('--model-size', choices=['base', 'large'], default='base')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES, default='none',
+                        help='int8: dynamic quantization for faster CPU inference')
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                        help='onnx: ONNX Runtime on CPU (graphs are exported once and cached)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float32',
+                        help='float16/bfloat16 halve weight memory (bfloat16 needs a recent CPU or GPU)')
+    parser.add_argument('--no-low-memory', dest='low_memory', action='store_false',
+                        help='Load fp32 weights into RAM first, then move them (the old loader)')
+    parser.add_argument('--preset', choices=list(DECODING_PRESETS), default=DEFAULT_PRESET,
+                        help='Decoding speed/quality preset (greedy-fast is several times cheaper)')
+    parser.add_argument('--num-beams', type=int, help='Override the preset\'s beam count')
+    parser.add_argument('--max-new-tokens', type=int, help='Cap generated tokens (instead of total length)')
+    parser.add_argument('--length-penalty', type=float, help='>1 favours longer beams, <1 shorter ones')
+    parser.add_argument('--repetition-penalty', type=float, help='>1 discourages repeated tokens')
+    parser.add_argument('--no-repeat-ngram-size', type=int, help='Forbid repeating n-grams of this size')
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH, help='SQLite caption cache file')
+    parser.add_argument('--no-cache', action='store_true', help='Always recompute captions')
+    parser.add_argument('--near-dup-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help='Reuse the caption of an image whose perceptual hash differs by at most this many '
+                             'bits (0 disables)')
+    parser.add_argument('--near-dup-method', choices=HASH_METHODS, default='phash',
+                        help='dhash is cheaper to compute; flat images are never matched with either')
+    parser.add_argument('--output', '-o', help='Write JSONL results to this file (default: stdout)')
+    parser.add_argument('--jsonl', action='store_true', help='Emit JSONL even for a single image')
+    parser.add_argument('--recursive', '-r', action='store_true', help='Recurse into directories')
+    parser.add_argument('--batch-size', type=int, default=8, help='Images per generate() call in batch mode')
+    parser.add_argument('--prefetch-workers', type=int, default=2, help='Threads decoding images ahead of the model')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Caption processes on CPU in batch mode (0: one per couple of cores, memory permitting)')
+    parser.add_argument('--threads-per-worker', type=int,
+                        help='torch threads per caption process (default: cores divided by --workers)')
+    add_instrumentation_arguments(parser)
     args = parser.parse_args()
+    args.decoding = resolve_decoding(args.preset, num_beams=args.num_beams, max_new_tokens=args.max_new_tokens,
+                                     length_penalty=args.length_penalty,
+                                     repetition_penalty=args.repetition_penalty,
+                                     no_repeat_ngram_size=args.no_repeat_ngram_size)
+
+    batch_mode = (args.jsonl or args.output or len(args.inputs) > 1
+                  or any(item == "-" or os.path.isdir(item) or glob.has_magic(item) for item in args.inputs))
+    with instrument(args):
+        if batch_mode:
+            run_batch(args)
+        else:
+            run_single(args)
+
+def open_near_duplicates(args):
+    """The near-duplicate index the CLI flags ask for, stored next to the caption cache (None if disabled)."""
+    if args.no_cache or args.near_dup_distance <= 0:
+        return None
+    return NearDuplicateIndex(os.path.join(os.path.dirname(os.path.abspath(args.cache_path)),
+                                           "near_duplicates.sqlite3"),
+                              max_distance=args.near_dup_distance, method=args.near_dup_method)
+
+def print_near_duplicate_stats(near_duplicates):
+    if near_duplicates is None:
+        return
+    stats = near_duplicates.stats()
+    print(f"♻️  Near-duplicates: {stats['hits']} reused from the index, {stats['batch_reuses']} within batches, "
+          f"{stats['misses']} misses (distances {stats['hit_distances']}, hashing {stats['hash_ms']:.0f}ms)")
+
+def run_single(args):
+    """Caption one image and print the results for a human reader."""
+    args.image_path = args.inputs[0]
 
     print("🍎 BLIP-1 Apple Silicon Demo")
     print("=" * 50)
     print(f"Image: {args.image_path}")
     print(f"Style: {args.style}")
-    print(f"Model: {args.model_size}\n")
+    print(f"Decoding: {args.preset} {args.decoding}")
+    variant = args.quantize if args.quantize != "none" else (
+        args.dtype if args.dtype != "float32" else (args.backend if args.backend != "torch" else None))
+    print(f"Model: {args.model_size}" + (f" ({variant})" if variant else "") + "\n")
 
     if platform.machine() == "arm64":
         print("✅ Running on Apple Silicon")
@@ -139,8 +921,13 @@ Examples:
             print("💡 Run 'python3 download_test_image.py' to get a test image")
         return
 
+    cache = None if args.no_cache else CaptionCache(args.cache_path)
+    near_duplicates = open_near_duplicates(args)
+
     try:
-        blip = AppleSiliconBLIP(args.model_size)
+        blip = AppleSiliconBLIP(args.model_size, cache=cache, quantize=args.quantize, decoding=args.decoding,
+                                backend=args.backend, dtype=args.dtype, low_memory=args.low_memory,
+                                near_duplicates=near_duplicates)
     except Exception as e:
         print(f"❌ Failed to initialize BLIP-1: {e}")
         return
@@ -159,5 +946,84 @@ Examples:
         print(f"❌ Caption generation failed: {e}")
         print("💡 Try using a different image or check if the file is corrupted")
 
+    if cache is not None:
+        stats = cache.stats()
+        print(f"\n⚡ Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    print_near_duplicate_stats(near_duplicates)
+
+def run_batch(args):
+    """Caption every input and stream one JSONL line per (image, style)."""
+    styles = ["simple", "detailed", "creative"] if args.style == 'all' else [args.style]
+    # Opened (and closed) out here: inside the redirect below, sys.stdout is stderr
+    output = open(args.output, "w", encoding="utf-8") if args.output else contextlib.nullcontext(sys.stdout)
+
+    # Progress chatter goes to stderr so stdout stays valid JSONL
+    with output as out, contextlib.redirect_stdout(sys.stderr):
+        if args.workers != 1:
+            run_batch_pool(args, styles, out)
+            return
+        cache = None if args.no_cache else CaptionCache(args.cache_path)
+        near_duplicates = open_near_duplicates(args)
+        try:
+            blip = AppleSiliconBLIP(args.model_size, cache=cache, quantize=args.quantize, decoding=args.decoding,
+                                    backend=args.backend, dtype=args.dtype, low_memory=args.low_memory,
+                                    near_duplicates=near_duplicates)
+        except Exception as e:
+            print(f"❌ Failed to initialize BLIP-1: {e}")
+            return
+
+        print(f"📦 Streaming {', '.join(styles)} captions (batch size {args.batch_size})...")
+        write_results(blip.iter_captions(iter_image_paths(args.inputs, args.recursive), styles,
+                                         batch_size=args.batch_size, prefetch_workers=args.prefetch_workers),
+                      out)
+        if cache is not None:
+            stats = cache.stats()
+            print(f"⚡ Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+        print_near_duplicate_stats(near_duplicates)
+
+def run_batch_pool(args, styles, out):
+    """Batch mode across several CPU processes (--workers), each with its own copy of the model."""
+    from caption_pool import CaptionPool
+
+    try:
+        pool = CaptionPool(args.model_size, workers=args.workers or None, threads_per_worker=args.threads_per_worker,
+                           quantize=args.quantize, backend=args.backend, dtype=args.dtype,
+                           low_memory=args.low_memory, decoding=args.decoding,
+                           cache_path=None if args.no_cache else args.cache_path,
+                           near_dup_distance=args.near_dup_distance, near_dup_method=args.near_dup_method)
+    except Exception as e:
+        print(f"❌ Failed to start caption workers: {e}")
+        return
+
+    print(f"📦 Streaming {', '.join(styles)} captions ({pool.workers} workers x {pool.threads_per_worker} "
+          f"threads, batch size {args.batch_size})...")
+    with pool:
+        write_results(pool.iter_captions(iter_image_paths(args.inputs, args.recursive), styles,
+                                         chunk_size=args.batch_size), out)
+    stats = pool.stats()
+    if "cache" in stats:
+        print(f"⚡ Cache: {stats['cache']['hits']} hits, {stats['cache']['misses']} misses")
+    if "near_duplicates" in stats:
+        print(f"♻️  Near-duplicates: {stats['near_duplicates']['hits']} reused from the index")
+
+def write_results(results, out):
+    """Write caption results as JSONL, then print throughput."""
+    start_time = time.time()
+    images = 0
+    last_path = None
+    failed = 0
+    for result in results:
+        if result["path"] != last_path:  # results come grouped per image, so no set of every path is needed
+            images += 1
+            last_path = result["path"]
+        if result["error"]:
+            failed += 1
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+
+    elapsed = time.time() - start_time
+    rate = images / elapsed if elapsed > 0 else 0.0
+    print(f"✅ {images} images in {elapsed:.2f}s ({rate:.2f} images/s), {failed} failed captions")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,420 @@
+"""
+BLIP ONNX Runtime Backend
+Exports BLIP's vision encoder and text decoder to ONNX once, caches the
+graphs on disk, and captions through onnxruntime's CPU provider.
+
+Three graphs are exported:
+  vision.onnx    pixel_values -> image_embeds
+  cross_kv.onnx  image_embeds -> cross-attention keys/values for every layer
+  decoder.onnx   one decoding step: new tokens + self-attention KV cache ->
+                 next-token logits + updated cache
+
+Cross-attention keys/values depend only on the image, so they are computed
+once per caption instead of once per token, and the self-attention cache
+means each step only runs the newest token through the decoder. Greedy and
+beam search run in numpy and follow transformers' generate() semantics.
+"""
+
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from caption_cache import DEFAULT_CACHE_DIR
+
+ONNX_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "onnx")
+EXPORT_VERSION = 1
+OPSET_VERSION = 17
+
+_GRAPHS = ("vision.onnx", "cross_kv.onnx", "decoder.onnx")
+_GENERATION_DEFAULT_KEYS = ("min_length", "repetition_penalty", "no_repeat_ngram_size", "length_penalty")
+
+
+def onnx_export_dir(model_name, cache_dir=ONNX_CACHE_DIR):
+    return os.path.join(cache_dir, model_name.replace("/", "--"))
+
+
+def read_manifest(export_dir):
+    """Return the export manifest, or None if the graphs are missing or stale."""
+    try:
+        with open(os.path.join(export_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("export_version") != EXPORT_VERSION:
+        return None
+    if not all(os.path.exists(os.path.join(export_dir, name)) for name in _GRAPHS):
+        return None
+    return manifest
+
+
+def export_blip_onnx(model, model_name, export_dir):
+    """Export a BlipForConditionalGeneration to the three ONNX graphs in export_dir."""
+    import inspect
+    import torch
+
+    text_config = model.config.text_config
+    num_layers = text_config.num_hidden_layers
+    num_heads = text_config.num_attention_heads
+    head_dim = text_config.hidden_size // num_heads
+
+    def split_heads(x):
+        return x.view(x.shape[0], x.shape[1], num_heads, head_dim).transpose(1, 2)
+
+    def attend(query, key, value, bias=None):
+        scores = torch.matmul(query, key.transpose(-1, -2)) / math.sqrt(head_dim)
+        if bias is not None:
+            scores = scores + bias
+        context = torch.matmul(torch.softmax(scores, dim=-1), value).transpose(1, 2)
+        return context.reshape(context.shape[0], context.shape[1], num_heads * head_dim)
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self, vision_model):
+            super().__init__()
+            self.vision_model = vision_model
+
+        def forward(self, pixel_values):
+            return self.vision_model(pixel_values=pixel_values)[0]
+
+    class CrossKV(torch.nn.Module):
+        def __init__(self, text_decoder):
+            super().__init__()
+            self.layers = text_decoder.bert.encoder.layer
+
+        def forward(self, image_embeds):
+            kv = []
+            for layer in self.layers:
+                cross = layer.crossattention.self
+                kv.append(torch.stack([split_heads(cross.key(image_embeds)), split_heads(cross.value(image_embeds))]))
+            return torch.stack(kv)  # (layers, 2, batch, heads, image_tokens, head_dim)
+
+    class DecoderStep(torch.nn.Module):
+        def __init__(self, text_decoder):
+            super().__init__()
+            self.embeddings = text_decoder.bert.embeddings
+            self.layers = text_decoder.bert.encoder.layer
+            self.head = text_decoder.cls
+
+        def forward(self, input_ids, position_ids, attention_bias, past_kv, cross_kv):
+            hidden = self.embeddings.word_embeddings(input_ids) + self.embeddings.position_embeddings(position_ids)
+            hidden = self.embeddings.LayerNorm(hidden)
+            present = []
+            for i, layer in enumerate(self.layers):
+                attn = layer.attention.self
+                key = torch.cat([past_kv[i, 0], split_heads(attn.key(hidden))], dim=2)
+                value = torch.cat([past_kv[i, 1], split_heads(attn.value(hidden))], dim=2)
+                present.append(torch.stack([key, value]))
+                context = attend(split_heads(attn.query(hidden)), key, value, attention_bias)
+                hidden = layer.attention.output(context, hidden)
+
+                cross = layer.crossattention.self
+                context = attend(split_heads(cross.query(hidden)), cross_kv[i, 0], cross_kv[i, 1])
+                hidden = layer.crossattention.output(context, hidden)
+                hidden = layer.output(layer.intermediate(hidden), hidden)
+            logits = self.head(hidden[:, -1:, :])[:, 0, :]
+            return logits, torch.stack(present)
+
+    os.makedirs(export_dir, exist_ok=True)
+    model = model.to("cpu").float().eval()
+    export_kwargs = {"opset_version": OPSET_VERSION, "do_constant_folding": True}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False  # the TorchScript exporter handles these plain modules without extra deps
+
+    vision_config = model.config.vision_config
+    pixel_values = torch.zeros(1, 3, vision_config.image_size, vision_config.image_size)
+    batch = {0: "batch"}
+
+    print("📦 Exporting BLIP vision encoder to ONNX...")
+    start_time = time.time()
+    with torch.no_grad():
+        image_embeds = model.vision_model(pixel_values=pixel_values)[0]
+        torch.onnx.export(VisionEncoder(model.vision_model), (pixel_values,),
+                          os.path.join(export_dir, "vision.onnx"),
+                          input_names=["pixel_values"], output_names=["image_embeds"],
+                          dynamic_axes={"pixel_values": batch, "image_embeds": batch}, **export_kwargs)
+
+        print("📦 Exporting BLIP text decoder to ONNX...")
+        cross_kv = CrossKV(model.text_decoder)(image_embeds)
+        torch.onnx.export(CrossKV(model.text_decoder), (image_embeds,),
+                          os.path.join(export_dir, "cross_kv.onnx"),
+                          input_names=["image_embeds"], output_names=["cross_kv"],
+                          dynamic_axes={"image_embeds": batch, "cross_kv": {2: "batch"}}, **export_kwargs)
+
+        input_ids = torch.tensor([[text_config.bos_token_id, text_config.bos_token_id]])
+        position_ids = torch.arange(2).unsqueeze(0)
+        attention_bias = torch.zeros(2, 3)
+        past_kv = torch.zeros(num_layers, 2, 1, num_heads, 1, head_dim)
+        torch.onnx.export(DecoderStep(model.text_decoder), (input_ids, position_ids, attention_bias, past_kv, cross_kv),
+                          os.path.join(export_dir, "decoder.onnx"),
+                          input_names=["input_ids", "position_ids", "attention_bias", "past_kv", "cross_kv"],
+                          output_names=["logits", "present_kv"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "new_tokens"},
+                                        "position_ids": {1: "new_tokens"},
+                                        "attention_bias": {0: "new_tokens", 1: "total_tokens"},
+                                        "past_kv": {2: "batch", 4: "past_tokens"},
+                                        "cross_kv": {2: "batch"},
+                                        "logits": {0: "batch"},
+                                        "present_kv": {2: "batch", 4: "total_tokens"}},
+                          **export_kwargs)
+
+    generation_config = model.text_decoder.generation_config
+    manifest = {
+        "export_version": EXPORT_VERSION,
+        "model_name": model_name,
+        "opset": OPSET_VERSION,
+        "num_layers": num_layers,
+        "num_heads": num_heads,
+        "head_dim": head_dim,
+        "bos_token_id": text_config.bos_token_id,
+        "eos_token_id": text_config.sep_token_id,
+        "pad_token_id": text_config.pad_token_id,
+        "generation_defaults": {key: getattr(generation_config, key, None) for key in _GENERATION_DEFAULT_KEYS},
+        "exported_at": time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+    with open(os.path.join(export_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"✅ ONNX export finished in {(time.time() - start_time):.2f}s: {export_dir}")
+    return manifest
+
+
+def _log_softmax(logits):
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class BlipOnnxRuntime:
+    """Runs exported BLIP graphs with onnxruntime on CPU."""
+
+    def __init__(self, export_dir, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The ONNX backend needs onnxruntime: pip3 install onnxruntime onnx") from None
+
+        self.export_dir = export_dir
+        self.manifest = read_manifest(export_dir)
+        if self.manifest is None:
+            raise FileNotFoundError(f"No usable ONNX export in {export_dir}")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.vision = ort.InferenceSession(os.path.join(export_dir, "vision.onnx"), options, providers=providers)
+        self.cross_kv = ort.InferenceSession(os.path.join(export_dir, "cross_kv.onnx"), options, providers=providers)
+        self.decoder = ort.InferenceSession(os.path.join(export_dir, "decoder.onnx"), options, providers=providers)
+
+        self.num_layers = self.manifest["num_layers"]
+        self.num_heads = self.manifest["num_heads"]
+        self.head_dim = self.manifest["head_dim"]
+        self.bos_token_id = self.manifest["bos_token_id"]
+        self.eos_token_id = self.manifest["eos_token_id"]
+        self.pad_token_id = self.manifest["pad_token_id"]
+        self.generation_defaults = {k: v for k, v in self.manifest["generation_defaults"].items() if v is not None}
+
+    def memory_bytes(self):
+        return sum(os.path.getsize(os.path.join(self.export_dir, name)) for name in _GRAPHS)
+
+    def encode(self, pixel_values):
+        return self.vision.run(None, {"pixel_values": np.asarray(pixel_values, dtype=np.float32)})[0]
+
+    def _step(self, tokens, past_kv, cross_kv):
+        past_len = past_kv.shape[4]
+        new_len = tokens.shape[1]
+        # Causal mask for the new tokens against everything cached so far
+        query_pos = past_len + np.arange(new_len)[:, None]
+        key_pos = np.arange(past_len + new_len)[None, :]
+        bias = np.where(key_pos > query_pos, np.float32(-1e9), np.float32(0)).astype(np.float32)
+        logits, present = self.decoder.run(None, {
+            "input_ids": tokens.astype(np.int64),
+            "position_ids": np.arange(past_len, past_len + new_len, dtype=np.int64)[None, :],
+            "attention_bias": bias,
+            "past_kv": past_kv,
+            "cross_kv": cross_kv
+        })
+        return logits, present
+
+    def _empty_cache(self, batch):
+        return np.zeros((self.num_layers, 2, batch, self.num_heads, 0, self.head_dim), dtype=np.float32)
+
+    def _process_scores(self, scores, sequences, cur_len, settings):
+        """Apply min-length, repetition and n-gram constraints in place (mirrors transformers' processors)."""
+        if cur_len < settings.get("min_length", 0):
+            scores[:, self.eos_token_id] = -np.inf
+        penalty = settings.get("repetition_penalty", 1.0)
+        if penalty and penalty != 1.0:
+            for row, seq in enumerate(sequences):
+                seen = np.unique(seq)
+                values = scores[row, seen]
+                scores[row, seen] = np.where(values < 0, values * penalty, values / penalty)
+        ngram = settings.get("no_repeat_ngram_size", 0)
+        if ngram and cur_len + 1 >= ngram:
+            for row, seq in enumerate(sequences):
+                seq = seq.tolist()
+                prefix = tuple(seq[len(seq) - ngram + 1:]) if ngram > 1 else ()
+                banned = {seq[i + ngram - 1] for i in range(len(seq) - ngram + 1)
+                          if tuple(seq[i:i + ngram - 1]) == prefix}
+                if banned:
+                    scores[row, list(banned)] = -np.inf
+        return scores
+
+    def _settings(self, generation_kwargs, prompt_len):
+        """Merge generate() kwargs over the model's defaults; returns (settings, max_length)."""
+        settings = dict(self.generation_defaults)
+        settings.update({k: v for k, v in generation_kwargs.items() if v is not None})
+        if "max_new_tokens" in settings:
+            return settings, prompt_len + settings["max_new_tokens"]
+        return settings, settings.get("max_length", 20)
+
+    def _cross_kv(self, image_embeds):
+        return self.cross_kv.run(None, {"image_embeds": np.asarray(image_embeds, dtype=np.float32)})[0]
+
+    def generate(self, image_embeds, prompt_ids, generation_kwargs):
+        """Return one token-id list per image, starting with prompt_ids."""
+        prompt_ids = np.asarray(prompt_ids, dtype=np.int64)
+        settings, max_length = self._settings(generation_kwargs, len(prompt_ids))
+        cross_kv = self._cross_kv(image_embeds)
+
+        num_beams = settings.get("num_beams", 1) or 1
+        if num_beams == 1:
+            return self._greedy(cross_kv, prompt_ids, max_length, settings)
+        return self._beam_search(cross_kv, prompt_ids, max_length, num_beams, settings)
+
+    def _greedy(self, cross_kv, prompt_ids, max_length, settings):
+        batch = cross_kv.shape[2]
+        sequences = np.tile(prompt_ids, (batch, 1))
+        finished = np.zeros(batch, dtype=bool)
+        past_kv = self._empty_cache(batch)
+        tokens = sequences
+        while sequences.shape[1] < max_length:
+            logits, past_kv = self._step(tokens, past_kv, cross_kv)
+            scores = self._process_scores(logits.copy(), sequences, sequences.shape[1], settings)
+            next_tokens = scores.argmax(axis=-1)
+            next_tokens = np.where(finished, self.pad_token_id, next_tokens)
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == self.eos_token_id
+            if finished.all():
+                break
+            tokens = next_tokens[:, None]
+        return [seq.tolist() for seq in sequences]
+
+    def stream(self, image_embeds, prompt_ids, generation_kwargs, seed=None):
+        """Yield the growing token-id list of a single caption after every new token.
+
+        Greedy, or sampled when generation_kwargs sets do_sample (temperature,
+        top_k and top_p are applied like transformers' logits warpers).
+        """
+        settings, max_length = self._settings(generation_kwargs, len(prompt_ids))
+        rng = np.random.default_rng(seed)
+        cross_kv = self._cross_kv(image_embeds)
+        sequence = [int(token) for token in prompt_ids]
+        past_kv = self._empty_cache(1)
+        tokens = np.asarray([sequence], dtype=np.int64)
+        while len(sequence) < max_length:
+            logits, past_kv = self._step(tokens, past_kv, cross_kv)
+            scores = self._process_scores(logits.copy(), np.asarray([sequence]), len(sequence), settings)[0]
+            token = self._sample(scores, settings, rng) if settings.get("do_sample") else int(scores.argmax())
+            sequence.append(token)
+            yield sequence
+            if token == self.eos_token_id:
+                break
+            tokens = np.asarray([[token]], dtype=np.int64)
+
+    @staticmethod
+    def _sample(scores, settings, rng):
+        scores = scores / max(settings.get("temperature") or 1.0, 1e-5)
+        top_k = settings.get("top_k", 50)
+        if top_k and top_k < scores.shape[-1]:
+            scores = np.where(scores < np.partition(scores, -top_k)[-top_k], -np.inf, scores)
+        probs = np.exp(scores - scores.max())
+        probs /= probs.sum()
+        top_p = settings.get("top_p", 1.0)
+        if top_p is not None and top_p < 1.0:
+            order = np.argsort(-probs)
+            # Keep the smallest set of tokens whose probability mass reaches top_p
+            keep = order[:np.searchsorted(np.cumsum(probs[order]), top_p) + 1]
+            mask = np.zeros_like(probs)
+            mask[keep] = probs[keep]
+            probs = mask / mask.sum()
+        return int(rng.choice(len(probs), p=probs))
+
+    def _beam_search(self, cross_kv, prompt_ids, max_length, num_beams, settings):
+        batch = cross_kv.shape[2]
+        prompt_len = len(prompt_ids)
+        length_penalty = settings.get("length_penalty", 1.0)
+        early_stopping = settings.get("early_stopping", False)
+        cross_kv = np.repeat(cross_kv, num_beams, axis=2)
+
+        sequences = np.tile(prompt_ids, (batch * num_beams, 1))
+        running_scores = np.zeros((batch, num_beams), dtype=np.float32)
+        running_scores[:, 1:] = -1e9  # all beams start identical; only expand the first
+        finished = [[] for _ in range(batch)]  # best-first (score, token list), at most num_beams each
+        improvable = [True] * batch
+        past_kv = self._empty_cache(batch * num_beams)
+        tokens = sequences
+
+        while True:
+            cur_len = sequences.shape[1]
+            at_max_length = cur_len + 1 >= max_length
+            logits, past_kv = self._step(tokens, past_kv, cross_kv)
+            scores = self._process_scores(_log_softmax(logits), sequences, cur_len, settings)
+            scores = scores + running_scores.reshape(-1, 1)
+            vocab = scores.shape[1]
+            scores = scores.reshape(batch, num_beams * vocab)
+
+            next_tokens = np.zeros((batch, num_beams), dtype=np.int64)
+            next_sources = np.zeros((batch, num_beams), dtype=np.int64)
+            for b in range(batch):
+                # Keep 2 * num_beams candidates so enough survive when some of them end in EOS
+                top = np.argsort(-scores[b], kind="stable")[:2 * num_beams]
+                full = early_stopping is True and len(finished[b]) == num_beams
+                running = []
+                for rank, flat in enumerate(top):
+                    beam, token = divmod(int(flat), vocab)
+                    source = b * num_beams + beam
+                    if token == self.eos_token_id or at_max_length:
+                        # Only the top num_beams candidates may become final captions
+                        if rank < num_beams and improvable[b] and not full:
+                            score = float(scores[b, flat]) / ((cur_len + 1 - prompt_len) ** length_penalty)
+                            finished[b].append((score, sequences[source].tolist() + [token]))
+                    elif len(running) < num_beams:
+                        running.append((float(scores[b, flat]), token, source))
+                finished[b] = sorted(finished[b], key=lambda h: -h[0])[:num_beams]
+                if not at_max_length:
+                    for slot, (score, token, source) in enumerate(running):
+                        running_scores[b, slot] = score
+                        next_tokens[b, slot] = token
+                        next_sources[b, slot] = source
+
+            if at_max_length:
+                break
+            sources = next_sources.reshape(-1)
+            tokens = next_tokens.reshape(-1, 1)
+            sequences = np.concatenate([sequences[sources], tokens], axis=1)
+            past_kv = past_kv[:, :, sources]
+
+            # Stop once no running beam can beat the worst finished one
+            for b in range(batch):
+                if not improvable[b]:
+                    continue
+                if early_stopping == "never" and length_penalty > 0:
+                    best_length = max_length - prompt_len
+                else:
+                    best_length = sequences.shape[1] - prompt_len
+                worst = finished[b][-1][0] if len(finished[b]) == num_beams else -1e9
+                improvable[b] = running_scores[b, 0] / (best_length ** length_penalty) > worst
+            if not any(improvable):
+                break
+            if early_stopping is True and all(len(f) == num_beams for f in finished):
+                break
+
+        results = []
+        for b in range(batch):
+            if finished[b]:
+                results.append(finished[b][0][1])
+            else:
+                results.append(sequences[b * num_beams].tolist())
+        return results
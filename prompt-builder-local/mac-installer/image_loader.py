@@ -0,0 +1,58 @@
+"""
+Image Loader
+Decode images close to the model's input size instead of at full resolution.
+
+BLIP resizes every image to 384x384, so decoding a 40 MP JPEG at full size
+only to throw most of it away wastes time and hundreds of MB of RAM. JPEGs
+are decoded at 1/2, 1/4 or 1/8 scale via libjpeg's draft mode, everything is
+then reduced with a box filter before the final resample, and EXIF rotation
+and colour conversion happen on the small image.
+"""
+
+from PIL import Image, ImageOps
+
+DEFAULT_TARGET_SIZE = 384
+
+
+def model_input_size(processor, default=DEFAULT_TARGET_SIZE):
+    """Return the square edge length the BLIP image processor resizes to."""
+    try:
+        size = processor.image_processor.size
+        return max(size.get("height", default), size.get("width", default))
+    except Exception:
+        return default
+
+
+def load_image(image_path, target_size=DEFAULT_TARGET_SIZE):
+    """Open an image as RGB, downscaled so its shorter side is about target_size.
+
+    The shorter side never goes below target_size, so the processor's own
+    resize still has full detail to work with. Pass target_size=None to decode
+    at full resolution.
+    """
+    image = Image.open(image_path)
+
+    if target_size:
+        width, height = image.size
+        # EXIF rotations of 90/270 degrees swap the axes, but the shorter side
+        # is the same either way, so the scale can be computed before rotating.
+        scale = target_size / min(width, height)
+        if scale < 1:
+            if image.format == "JPEG":
+                # libjpeg picks the largest 1/2^n reduction that keeps both
+                # sides >= the requested size
+                image.draft(None, (int(width * scale) + 1, int(height * scale) + 1))
+            if image.mode in ("P", "1"):
+                # Palette/bilevel images can't be resampled with a smooth filter
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            elif image.mode.startswith(("I", "F")):
+                # 16/32-bit integer and float images (e.g. 16-bit grayscale TIFF/PNG) can't be resampled
+                # with a smooth filter before Pillow 10.1; convert at full size, as the plain decode did
+                image = image.convert("RGB")
+            new_size = (max(target_size, round(width * scale)), max(target_size, round(height * scale)))
+            image.thumbnail(new_size, Image.BICUBIC, reducing_gap=2.0)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
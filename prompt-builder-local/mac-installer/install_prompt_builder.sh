@@ -50,6 +50,18 @@ REQUIRED_FILES=(
     "ai_generators.py"
     "generate_prompts_from_image.py"
     "blip1_m1_optimized.py"
+    "caption_cache.py"
+    "image_loader.py"
+    "caption_server.py"
+    "blip_onnx.py"
+    "instrumentation.py"
+    "model_manager.py"
+    "model_snapshot.py"
+    "near_duplicates.py"
+    "caption_pool.py"
+    "prompt_refiner.py"
+    "async_pipeline.py"
+    "video_prompts.py"
     "requirements_local_only.txt"
 )
 
@@ -70,6 +82,18 @@ cp layout_local_only.ui "$INSTALL_DIR/"
 cp ai_generators.py "$INSTALL_DIR/"
 cp generate_prompts_from_image.py "$INSTALL_DIR/"
 cp blip1_m1_optimized.py "$INSTALL_DIR/"
+cp caption_cache.py "$INSTALL_DIR/"
+cp image_loader.py "$INSTALL_DIR/"
+cp caption_server.py "$INSTALL_DIR/"
+cp blip_onnx.py "$INSTALL_DIR/"
+cp instrumentation.py "$INSTALL_DIR/"
+cp model_manager.py "$INSTALL_DIR/"
+cp model_snapshot.py "$INSTALL_DIR/"
+cp near_duplicates.py "$INSTALL_DIR/"
+cp caption_pool.py "$INSTALL_DIR/"
+cp prompt_refiner.py "$INSTALL_DIR/"
+cp async_pipeline.py "$INSTALL_DIR/"
+cp video_prompts.py "$INSTALL_DIR/"
 cp requirements_local_only.txt "$INSTALL_DIR/"
 
 # Copy logo if it exists
@@ -109,6 +133,15 @@ else
     print_warning "You can try installing them manually later."
 fi
 
+# Snapshot the captioning model so the app starts offline
+print_status "Downloading the BLIP captioning model (~1GB) for offline use..."
+if python3 "$INSTALL_DIR/model_snapshot.py" base --models-dir "$MODELS_DIR"; then
+    print_success "Captioning model saved to $MODELS_DIR."
+else
+    print_warning "Captioning model download failed; it will be downloaded on first use."
+    print_warning "To retry: python3 $INSTALL_DIR/model_snapshot.py base"
+fi
+
 # Create launcher script
 print_status "Creating launcher script..."
 cat > "$INSTALL_DIR/launch_prompt_builder.sh" << 'EOF'
@@ -0,0 +1,296 @@
+"""
+Model Manager
+Keeps loaded BLIP captioners in a small LRU pool keyed by model, device and dtype.
+
+Switching between base and large reuses whichever one is already loaded
+instead of reloading, at most max_models captioners stay resident, and a
+background reaper unloads models that have sat idle for idle_timeout
+seconds or when free system memory drops below min_available_mb, so an
+idle GUI does not hold gigabytes of weights. Under memory pressure the
+reaper never unloads the most recently used captioner or one a caller is
+still holding; only a load of a different model replaces the last one.
+
+Loading is single-flight: concurrent callers asking for the same model wait
+on the one in-flight load instead of starting their own, and preload()
+starts a load on a background thread (at app start or when an image is
+picked) so the first caption doesn't pay for it.
+
+Limits can be set with PROMPT_BUILDER_MAX_MODELS, PROMPT_BUILDER_MODEL_IDLE_S
+and PROMPT_BUILDER_MIN_AVAILABLE_MB. PROMPT_BUILDER_CAPTION_DTYPE=float16 (or
+bfloat16) loads half-precision weights by default, which helps 8 GB machines
+that also run the LLM.
+"""
+
+import concurrent.futures
+import gc
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_MODELS = int(os.environ.get("PROMPT_BUILDER_MAX_MODELS", 2))
+DEFAULT_IDLE_TIMEOUT = float(os.environ.get("PROMPT_BUILDER_MODEL_IDLE_S", 600))
+DEFAULT_MIN_AVAILABLE_MB = float(os.environ.get("PROMPT_BUILDER_MIN_AVAILABLE_MB", 1024))
+DEFAULT_DTYPE = os.environ.get("PROMPT_BUILDER_CAPTION_DTYPE") or None
+
+
+def _available_memory_bytes():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except Exception:
+        return None
+
+
+def _process_rss_bytes():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+def _empty_device_cache(device):
+    try:
+        import torch
+        if device == "mps":
+            torch.mps.empty_cache()
+        elif device == "cuda":
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+
+class _Entry:
+    def __init__(self, key, model):
+        self.key = key
+        self.model = model
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+        self.uses = 0
+        self.memory_bytes = model.memory_bytes() if hasattr(model, "memory_bytes") else None
+
+
+class ModelManager:
+    """Bounded LRU pool of AppleSiliconBLIP captioners with idle and memory-pressure unloading."""
+
+    def __init__(self, max_models=DEFAULT_MAX_MODELS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 min_available_mb=DEFAULT_MIN_AVAILABLE_MB, cache=None, loader=None, near_duplicates=None):
+        self.max_models = max(1, max_models)
+        self.idle_timeout = idle_timeout
+        self.min_available_bytes = min_available_mb * 1024 * 1024 if min_available_mb else 0
+        self.cache = cache  # caption_cache.CaptionCache shared by every captioner
+        self.near_duplicates = near_duplicates  # near_duplicates.NearDuplicateIndex, likewise shared
+        self._loader = loader  # callable(model_size, **options) -> captioner, for tests and benchmarks
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._loading = {}  # key -> Future for loads in flight
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.hits = 0
+        self.waits = 0  # callers that joined an in-flight load instead of loading again
+        self.evictions = {"lru": 0, "idle": 0, "memory": 0, "manual": 0}
+        self._stop = threading.Event()
+        self._reaper = None
+        if idle_timeout or self.min_available_bytes:
+            self._reaper = threading.Thread(target=self._reap, name="model-reaper", daemon=True)
+            self._reaper.start()
+
+    @staticmethod
+    def make_key(model_size="base", device=None, quantize=None, backend="torch", dtype=None):
+        """Return the (model name, device, dtype, backend) key a captioner is pooled under.
+
+        dtype in the key is the int8 quantize mode when set, else the weight
+        dtype (float32, float16 or bfloat16, defaulting to PROMPT_BUILDER_CAPTION_DTYPE).
+        """
+        from blip1_m1_optimized import default_device, resolve_model_name
+
+        quantize = None if quantize in (None, "none") else quantize
+        if quantize or backend == "onnx":
+            device = "cpu"  # mirrors AppleSiliconBLIP: these modes only run on CPU
+            dtype = None  # and only with float32 weights
+        else:
+            dtype = dtype or DEFAULT_DTYPE
+        return (resolve_model_name(model_size), device or default_device(), quantize or dtype or "float32", backend)
+
+    def get(self, model_size="base", device=None, quantize=None, backend="torch", decoding=None, timeout=None,
+            dtype=None):
+        """Return a loaded captioner for these settings, loading (and evicting) as needed.
+
+        Safe to call from any thread. If another thread is already loading the
+        same model, this waits for that load (up to timeout seconds) instead of
+        loading the weights a second time.
+        """
+        key = self.make_key(model_size, device, quantize, backend, dtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                entry.last_used = time.monotonic()
+                entry.uses += 1
+                return entry.model
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = self._loading[key] = concurrent.futures.Future()
+                # Make room first so the old weights are gone before the new ones load
+                while self._entries and len(self._entries) + len(self._loading) > self.max_models:
+                    self._evict(next(iter(self._entries)), "lru")
+                self._relieve_memory_pressure()
+            else:
+                self.waits += 1
+
+        if not owner:
+            return future.result(timeout)
+
+        # The slow part runs outside the lock so hits on other models aren't blocked
+        try:
+            model = self._load(model_size, key, decoding)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            entry = _Entry(key, model)
+            entry.uses += 1
+            self._entries[key] = entry
+            del self._loading[key]
+            self.loads += 1
+        future.set_result(model)
+        return model
+
+    def preload(self, model_size="base", device=None, quantize=None, backend="torch", decoding=None, dtype=None):
+        """Start loading a captioner on a background thread; returns a Future for it.
+
+        Returns an already-completed Future when the model is resident, and the
+        in-flight load's Future when one is running, so calling this from UI
+        events (app start, image picked) never loads twice.
+        """
+        key = self.make_key(model_size, device, quantize, backend, dtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                future = concurrent.futures.Future()
+                future.set_result(entry.model)
+                return future
+            if key in self._loading:
+                return self._loading[key]
+
+        result = concurrent.futures.Future()
+
+        def load():
+            try:
+                result.set_result(self.get(model_size, device, quantize, backend, decoding, dtype=dtype))
+            except BaseException as e:
+                print(f"❌ Background model load failed: {e}")
+                result.set_exception(e)
+
+        threading.Thread(target=load, name="model-preload", daemon=True).start()
+        return result
+
+    def _load(self, model_size, key, decoding):
+        from blip1_m1_optimized import DTYPES, AppleSiliconBLIP
+
+        model_name, device, dtype, backend = key
+        quantize = None if dtype in DTYPES else dtype
+        dtype = dtype if dtype in DTYPES else None
+        if self._loader is not None:
+            return self._loader(model_size, device=device, quantize=quantize, backend=backend, decoding=decoding,
+                                dtype=dtype)
+        return AppleSiliconBLIP(model_size, cache=self.cache, quantize=quantize, device=device,
+                                decoding=decoding, backend=backend, dtype=dtype,
+                                near_duplicates=self.near_duplicates)
+
+    def _evict(self, key, reason):
+        entry = self._entries.pop(key)
+        self.evictions[reason] += 1
+        print(f"♻️  Unloading {entry.key[0]} ({entry.key[1]}, {entry.key[2]}): {reason}")
+        # A caller mid-caption keeps its reference; the weights go once it finishes
+        entry.model = None
+        gc.collect()  # transformers models hold reference cycles
+        _empty_device_cache(entry.key[1])
+
+    @staticmethod
+    def _in_use(entry):
+        """True while a caller holds the captioner (e.g. mid-caption); unloading it would free nothing."""
+        return sys.getrefcount(entry.model) > 2  # the entry's reference and getrefcount's argument
+
+    def _relieve_memory_pressure(self, keep=None, skip_in_use=False):
+        if not self.min_available_bytes:
+            return
+        while self._entries:
+            available = _available_memory_bytes()
+            if available is None or available >= self.min_available_bytes:
+                return
+            victim = next((k for k, e in self._entries.items()
+                           if k != keep and not (skip_in_use and self._in_use(e))), None)
+            if victim is None:
+                return
+            self._evict(victim, "memory")
+
+    def unload(self, model_size=None, device=None, quantize=None, backend="torch", dtype=None):
+        """Unload one captioner, or every captioner when model_size is None. Returns how many."""
+        with self._lock:
+            if model_size is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k in [self.make_key(model_size, device, quantize, backend, dtype)] if k in self._entries]
+            for key in keys:
+                self._evict(key, "manual")
+            return len(keys)
+
+    def unload_idle(self, idle_timeout=None):
+        """Unload captioners unused for idle_timeout seconds (default: the manager's setting)."""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if now - e.last_used >= idle_timeout]
+            for key in keys:
+                self._evict(key, "idle")
+            return len(keys)
+
+    def _reap(self):
+        interval = min(self.idle_timeout / 4 if self.idle_timeout else 30, 30)
+        while not self._stop.wait(max(interval, 0.05)):
+            with self._lock:
+                if self.idle_timeout:
+                    self.unload_idle()
+                if self._entries:
+                    self._relieve_memory_pressure(keep=next(reversed(self._entries)), skip_in_use=True)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            models = [{
+                "model": e.key[0],
+                "device": e.key[1],
+                "dtype": e.key[2],
+                "backend": e.key[3],
+                "memory_mb": round(e.memory_bytes / (1024 * 1024), 1) if e.memory_bytes is not None else None,
+                "idle_s": round(now - e.last_used, 1),
+                "uses": e.uses
+            } for e in reversed(self._entries.values())]
+            available = _available_memory_bytes()
+            rss = _process_rss_bytes()
+            return {
+                "loaded": len(models),
+                "max_models": self.max_models,
+                "idle_timeout_s": self.idle_timeout,
+                "loads": self.loads,
+                "hits": self.hits,
+                "waits": self.waits,
+                "loading": [k[0] for k in self._loading],
+                "evictions": dict(self.evictions),
+                "models": models,
+                "model_memory_mb": round(sum(m["memory_mb"] or 0 for m in models), 1),
+                "process_rss_mb": round(rss / (1024 * 1024), 1) if rss is not None else None,
+                "available_mb": round(available / (1024 * 1024), 1) if available is not None else None
+            }
+
+    def close(self):
+        self._stop.set()
+        if self._reaper is not None:
+            self._reaper.join()
+        self.unload()
@@ -0,0 +1,291 @@
+"""
+Video Prompts
+Prompts from video clips, one set per scene.
+
+Frames are sampled lazily from the decoder (every_s seconds apart; skipped
+frames are grabbed but never converted) and shrunk to the model's input
+size straight away. Each sample is reduced to a 64-bit perceptual hash and
+compared with the current scene's keyframe: within scene_distance bits it
+only extends the scene and is dropped. Flat frames (a fade to black, a
+title card's empty background) have no structure to hash and are compared
+by their mean colour instead. A sample that matches one of the
+last few scenes (a cut back to an earlier shot) reuses that scene's
+caption. Only the remaining keyframes reach the model, batch_size at a
+time (sooner if cut-backs are waiting on a keyframe in the batch), and each
+scene is yielded as soon as it is captioned and has ended.
+
+At most one batch of keyframes and a handful of scene records are held at
+once, so memory does not grow with the length of the clip. Decoding uses
+OpenCV (opencv-python-headless).
+
+Usage:
+  python3 video_prompts.py clip.mp4
+  python3 video_prompts.py clip.mov --every 0.5 --scene-distance 12 --jsonl > scenes.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import deque
+
+from near_duplicates import HASH_METHODS, dhash, flat_colour, hamming_distance, phash
+
+# Samples of one shot differ by 0-6 bits (noise, a moving subject) and a steady pan adds a few bits per
+# second; a cut to a different shot is 20+ bits away
+DEFAULT_SCENE_DISTANCE = int(os.environ.get("PROMPT_BUILDER_SCENE_DISTANCE", 14))
+DEFAULT_SAMPLE_EVERY_S = 1.0
+DEFAULT_RECENT_SCENES = 8
+# Flat frames are the same shot if their mean colours are this close in every channel
+FLAT_COLOUR_TOLERANCE = 8
+
+
+def _open_capture(video_path):
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Video support needs OpenCV: pip install opencv-python-headless") from None
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Video not found: {video_path}")
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    return cv2, capture
+
+
+def probe_video(video_path):
+    """Return fps, frame count, duration and frame size of a video as reported by its container."""
+    cv2, capture = _open_capture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        return {
+            "fps": fps,
+            "frames": frames,
+            "duration_s": frames / fps if fps and frames else None,
+            "width": int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        }
+    finally:
+        capture.release()
+
+
+def iter_frames(video_path, every_s=DEFAULT_SAMPLE_EVERY_S, target_size=384):
+    """Yield (timestamp_s, PIL RGB image) every every_s seconds, shorter side shrunk to about target_size."""
+    from PIL import Image
+
+    cv2, capture = _open_capture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0  # some containers don't say; 25 is a safe guess for spacing
+        step = max(1, round(fps * every_s))
+        index = 0
+        while capture.grab():  # demux and decode only; the colour conversion is skipped for unsampled frames
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    height, width = frame.shape[:2]
+                    scale = target_size / min(width, height) if target_size else 1
+                    if scale < 1:
+                        frame = cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                           interpolation=cv2.INTER_AREA)
+                    yield index / fps, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            index += 1
+    finally:
+        capture.release()
+
+
+class KeyframeCaptioner:
+    """Turns a video into a stream of captioned scenes, running the model only on distinct keyframes."""
+
+    def __init__(self, captioner, every_s=DEFAULT_SAMPLE_EVERY_S, scene_distance=DEFAULT_SCENE_DISTANCE,
+                 method="phash", batch_size=4, recent_scenes=DEFAULT_RECENT_SCENES, prompt_type="detailed",
+                 max_length=60, decoding=None):
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method!r} (expected one of {HASH_METHODS})")
+        self.captioner = captioner  # AppleSiliconBLIP (anything with caption_images)
+        self.every_s = every_s
+        self.scene_distance = scene_distance
+        self._hash_image = phash if method == "phash" else dhash
+        self.batch_size = max(1, batch_size)
+        self.recent_scenes = recent_scenes
+        self.prompt_type = prompt_type
+        self.max_length = max_length
+        self.decoding = decoding
+        self.samples = 0
+        self.keyframes = 0  # scenes whose keyframe went through the model
+        self.reused = 0  # scenes that matched an earlier scene's keyframe
+        self.hash_ms = 0.0
+        self.caption_ms = 0.0
+
+    def _caption(self, batch):
+        start_time = time.time()
+        captions = self.captioner.caption_images([scene.pop("_image") for scene in batch], self.prompt_type,
+                                                 self.max_length, self.decoding)
+        self.caption_ms += (time.time() - start_time) * 1000
+        for scene, caption in zip(batch, captions):
+            scene["caption"] = caption or ""
+        batch.clear()
+
+    def _frame_key(self, image):
+        return self._hash_image(image), flat_colour(image)
+
+    @staticmethod
+    def _distance(key, other):
+        """Bits between two frames' hashes; a flat frame is 0 from a flat one of its colour, else 64."""
+        (image_hash, colour), (other_hash, other_colour) = key, other
+        if colour is None and other_colour is None:
+            return hamming_distance(image_hash, other_hash)
+        if colour is None or other_colour is None:
+            return 64
+        return 0 if max(abs(a - b) for a, b in zip(colour, other_colour)) <= FLAT_COLOUR_TOLERANCE else 64
+
+    @staticmethod
+    def _stalled(pending, batch):
+        """True if a finished scene waits on the batch while cut-backs queue up behind it.
+
+        Reused scenes never add to the batch, so in a shot/reverse-shot clip
+        with fewer shots than batch_size it would not fill until the end.
+        """
+        head = pending[0]
+        if head["end_s"] is None or len(pending) <= len(batch):
+            return False
+        waits_on = (head, head.get("_source"))
+        return any(scene is waited for scene in batch for waited in waits_on)
+
+    def iter_scenes(self, video_path):
+        """Yield one dict per scene, in order, as soon as it has ended and been captioned.
+
+        Each has scene (index), start_s, end_s, frames (samples in the scene),
+        caption, prompts and reused_from (the index of the earlier scene whose
+        caption it shares, or None).
+        """
+        from generate_prompts_from_image import build_prompt_variations
+
+        target_size = getattr(self.captioner, "input_size", 384)
+        duration_s = probe_video(video_path)["duration_s"]
+        pending = deque()  # scenes not yielded yet, oldest first
+        batch = []  # scenes whose keyframe waits for the model
+        recent = deque(maxlen=self.recent_scenes)  # (frame key, scene) of the latest keyframes, for cut-backs
+        current = None
+        current_key = None
+        last_timestamp = 0.0
+
+        def ready():
+            while pending:
+                scene = pending[0]
+                source = scene.get("_source")
+                if source is not None and source.get("caption") is not None:
+                    scene["caption"] = source["caption"]
+                if scene["end_s"] is None or scene.get("caption") is None:
+                    return
+                pending.popleft()
+                scene.pop("_source", None)
+                scene["prompts"] = build_prompt_variations(scene["caption"])
+                yield scene
+
+        for timestamp, image in iter_frames(video_path, self.every_s, target_size):
+            self.samples += 1
+            last_timestamp = timestamp
+            start_time = time.time()
+            key = self._frame_key(image)
+            self.hash_ms += (time.time() - start_time) * 1000
+
+            if current is not None and self._distance(key, current_key) <= self.scene_distance:
+                current["frames"] += 1
+                continue
+
+            if current is not None:
+                current["end_s"] = round(timestamp, 3)
+            current = {"scene": (current["scene"] + 1) if current else 0, "start_s": round(timestamp, 3),
+                       "end_s": None, "frames": 1, "caption": None, "reused_from": None}
+            current_key = key
+            match = min(recent, key=lambda entry: self._distance(key, entry[0]), default=None)
+            if match is not None and self._distance(key, match[0]) <= self.scene_distance:
+                current["reused_from"] = match[1]["scene"]
+                current["_source"] = match[1]
+                self.reused += 1
+            else:
+                current["_image"] = image
+                batch.append(current)
+                self.keyframes += 1
+                recent.append((key, current))
+            pending.append(current)
+
+            if len(batch) >= self.batch_size or self._stalled(pending, batch):
+                self._caption(batch)
+            yield from ready()
+
+        if current is not None:
+            current["end_s"] = round(max(duration_s or 0.0, last_timestamp), 3)
+        if batch:
+            self._caption(batch)
+        yield from ready()
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "scenes": self.keyframes + self.reused,
+            "keyframes_captioned": self.keyframes,
+            "scenes_reused": self.reused,
+            "model_calls_skipped": 1 - self.keyframes / self.samples if self.samples else 0.0,
+            "hash_ms": round(self.hash_ms, 1),
+            "caption_ms": round(self.caption_ms, 1)
+        }
+
+
+def stream_prompts_from_video(video_path, model_size="base", preset=None, **options):
+    """Yield per-scene prompt dicts for a video (see KeyframeCaptioner.iter_scenes) as they are produced."""
+    from generate_prompts_from_image import get_model_manager
+
+    captioner = get_model_manager().get(model_size)
+    yield from KeyframeCaptioner(captioner, decoding=preset, **options).iter_scenes(video_path)
+
+
+def main():
+    from blip1_m1_optimized import DECODING_PRESETS
+
+    parser = argparse.ArgumentParser(description="Generate per-scene prompts from a video clip")
+    parser.add_argument('video', help='Video file (mp4, mov, mkv, avi, webm...)')
+    parser.add_argument('--model-size', choices=['base', 'large'], default='base')
+    parser.add_argument('--preset', choices=list(DECODING_PRESETS), help='Decoding preset')
+    parser.add_argument('--every', type=float, default=DEFAULT_SAMPLE_EVERY_S, help='Seconds between samples')
+    parser.add_argument('--scene-distance', type=int, default=DEFAULT_SCENE_DISTANCE,
+                        help='Perceptual-hash bits a sample may differ from its scene keyframe')
+    parser.add_argument('--method', choices=HASH_METHODS, default='phash',
+                        help='dhash is cheaper to compute; flat frames are compared by mean colour with either')
+    parser.add_argument('--batch-size', type=int, default=4, help='Keyframes per generate() call')
+    parser.add_argument('--jsonl', action='store_true', help='Print one JSON object per scene')
+    args = parser.parse_args()
+
+    out = sys.stdout
+    # Progress chatter goes to stderr so stdout stays valid JSONL
+    with contextlib.redirect_stdout(sys.stderr if args.jsonl else sys.stdout):
+        from generate_prompts_from_image import get_model_manager
+
+        video = KeyframeCaptioner(get_model_manager().get(args.model_size), every_s=args.every,
+                                  scene_distance=args.scene_distance, method=args.method,
+                                  batch_size=args.batch_size, decoding=args.preset)
+        start_time = time.time()
+        try:
+            for scene in video.iter_scenes(args.video):
+                if args.jsonl:
+                    out.write(json.dumps(scene, ensure_ascii=False) + "\n")
+                    out.flush()
+                    continue
+                reused = f" (same shot as scene {scene['reused_from']})" if scene["reused_from"] is not None else ""
+                print(f"\n🎬 Scene {scene['scene']}  {scene['start_s']:.1f}s - {scene['end_s']:.1f}s{reused}")
+                for prompt in scene["prompts"]:
+                    print(f"  • {prompt}")
+        except (ImportError, OSError, ValueError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        stats = video.stats()
+        print(f"\n✅ {stats['scenes']} scenes from {stats['samples']} samples in {time.time() - start_time:.1f}s: "
+              f"{stats['keyframes_captioned']} keyframes captioned, {stats['scenes_reused']} reused "
+              f"({stats['model_calls_skipped']:.0%} of model calls skipped)")
+
+
+if __name__ == "__main__":
+    main()
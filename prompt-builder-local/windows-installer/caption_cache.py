@@ -0,0 +1,128 @@
+"""
+Caption Cache
+Persistent, content-addressed cache for BLIP captions backed by SQLite.
+
+Entries are keyed by a hash of the image bytes plus everything that changes
+the caption (model name, prompt type and decoding parameters), so renamed or
+copied files still hit and edited files never return stale captions.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "PROMPT_BUILDER_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "prompt_builder")
+)
+DEFAULT_CACHE_PATH = os.path.join(DEFAULT_CACHE_DIR, "captions.sqlite3")
+DEFAULT_MAX_ENTRIES = 10000
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_image_file(image_path):
+    """Return the SHA-256 hex digest of an image file's bytes."""
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaptionCache:
+    """SQLite caption cache with size-bounded LRU eviction and hit/miss counters."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (abspath, mtime_ns, size) -> digest, so unchanged files are only hashed once per session
+        self._digests = {}
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions(last_used)")
+        self._conn.commit()
+
+    def image_digest(self, image_path):
+        st = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            digest = hash_image_file(image_path)
+            self._digests[memo_key] = digest
+        return digest
+
+    def make_key(self, image_path, model_name, prompt_type, generation_kwargs):
+        """Build the cache key; raises OSError if the image can't be read."""
+        payload = json.dumps({
+            "image": self.image_digest(image_path),
+            "model": model_name,
+            "prompt_type": prompt_type,
+            "generation": generation_kwargs
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, caption):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO captions (key, caption, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, caption, now, now)
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM captions WHERE key IN "
+                    "(SELECT key FROM captions ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM captions")
+            self._conn.commit()
+            self._digests.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "path": self.path
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,307 @@
+"""
+Caption Pool
+Multi-process batch captioning for CPU-only hosts.
+
+One process with torch's default threading does not scale with cores for
+the small batches and sequential token loop of beam search: most of the
+time is spent in ops too small to split across many threads. The pool runs
+N worker processes instead, each loading the model once and pinned to its
+share of the cores with torch.set_num_threads, pulling chunks of images
+from one shared queue. Results come back in input order.
+
+Each worker holds its own copy of the weights, so the default worker count
+is limited by free memory as well as by cores. PROMPT_BUILDER_CAPTION_WORKERS
+and PROMPT_BUILDER_THREADS_PER_WORKER override the defaults.
+
+Usage:
+  with CaptionPool("base", workers=4) as pool:
+      for result in pool.iter_captions(paths, styles=["detailed"]):
+          ...
+"""
+
+import contextlib
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+DEFAULT_WORKERS = int(os.environ.get("PROMPT_BUILDER_CAPTION_WORKERS", 0)) or None  # None: derive from cores
+DEFAULT_THREADS_PER_WORKER = int(os.environ.get("PROMPT_BUILDER_THREADS_PER_WORKER", 0)) or None
+DEFAULT_CHUNK_SIZE = 4
+
+# Rough resident size of one fp32 worker (weights plus activations), used to cap the default worker count
+_WORKER_MB = {"base": 1100, "large": 2000}
+_HALF_DTYPES = ("float16", "bfloat16", "int8")
+
+
+def physical_cores():
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def plan_workers(workers=None, threads_per_worker=None, model_size="base", dtype=None):
+    """Return (workers, threads_per_worker) for this machine.
+
+    Unset values are derived so workers x threads covers the physical cores
+    (two threads per worker by default), and the worker count is capped by
+    the memory a copy of the model needs.
+    """
+    from model_manager import _available_memory_bytes
+
+    cores = physical_cores()
+    if workers is None:
+        workers = max(1, cores // (threads_per_worker or 2))
+        worker_mb = _WORKER_MB.get(model_size, _WORKER_MB["large"])
+        if dtype in _HALF_DTYPES:
+            worker_mb //= 2
+        available = _available_memory_bytes()
+        if available:
+            workers = max(1, min(workers, int(available / (worker_mb * 1024 * 1024))))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cores // workers)
+    return workers, threads_per_worker
+
+
+def _failed_items(paths, styles, error):
+    return [{"path": path, "style": style, "caption": None, "cached": False, "error": error, "timings": {}}
+            for path in paths for style in styles]
+
+
+@contextlib.contextmanager
+def _thread_env(threads):
+    """Set the OpenMP/MKL/Accelerate thread counts for processes started inside, then restore them.
+
+    A spawned worker re-imports the parent's __main__ (and with it torch)
+    before _worker_main runs, so they have to be in the environment it
+    inherits; setting them in the worker would be too late.
+    """
+    names = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update({name: str(threads) for name in names})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _worker_main(worker_id, threads, options, tasks, results):
+    """Load the captioner once, then caption chunks from tasks until a None arrives."""
+    # Progress chatter goes to stderr so a JSONL stdout stays valid
+    with contextlib.redirect_stdout(sys.stderr):
+        import torch
+
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # already set; only possible if something ran torch ops at import
+
+        from blip1_m1_optimized import AppleSiliconBLIP
+        from caption_cache import CaptionCache
+        from near_duplicates import NearDuplicateIndex
+
+        cache = near_duplicates = None
+        try:
+            start_time = time.time()
+            if options["cache_path"]:
+                cache = CaptionCache(options["cache_path"])
+                if options["near_dup_distance"] > 0:
+                    near_duplicates = NearDuplicateIndex(
+                        os.path.join(os.path.dirname(os.path.abspath(options["cache_path"])),
+                                     "near_duplicates.sqlite3"),
+                        max_distance=options["near_dup_distance"], method=options["near_dup_method"])
+            blip = AppleSiliconBLIP(options["model_size"], cache=cache, quantize=options["quantize"], device="cpu",
+                                    decoding=options["decoding"], backend=options["backend"], dtype=options["dtype"],
+                                    low_memory=options["low_memory"], near_duplicates=near_duplicates)
+        except Exception as e:
+            results.put(("failed", worker_id, str(e)))
+            return
+        results.put(("ready", worker_id, {"load_s": time.time() - start_time, "threads": threads,
+                                          "pid": os.getpid()}))
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            chunk_id, paths, styles, max_length, batch_size = task
+            results.put(("taken", worker_id, chunk_id))
+            try:
+                items = list(blip.iter_captions(paths, styles, max_length, batch_size=batch_size,
+                                                prefetch_workers=1))
+            except Exception as e:
+                items = _failed_items(paths, styles, str(e))
+            results.put(("done", worker_id, chunk_id, items))
+
+        stats = {}
+        if cache is not None:
+            stats["cache"] = cache.stats()
+        if near_duplicates is not None:
+            stats["near_duplicates"] = near_duplicates.stats()
+        results.put(("exit", worker_id, stats))
+
+
+class CaptionPool:
+    """N captioning processes fed from one queue, each with a fixed torch thread budget."""
+
+    def __init__(self, model_size="base", workers=DEFAULT_WORKERS, threads_per_worker=DEFAULT_THREADS_PER_WORKER,
+                 quantize=None, backend="torch", dtype=None, low_memory=True, decoding=None, cache_path=None,
+                 near_dup_distance=0, near_dup_method="phash"):
+        self.workers, self.threads_per_worker = plan_workers(workers, threads_per_worker, model_size, dtype)
+        options = {
+            "model_size": model_size, "quantize": quantize, "backend": backend, "dtype": dtype,
+            "low_memory": low_memory, "decoding": decoding, "cache_path": cache_path,
+            "near_dup_distance": near_dup_distance, "near_dup_method": near_dup_method
+        }
+        # spawn, not fork: a forked torch process can deadlock in OpenMP, and it is the default on macOS/Windows
+        context = multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = {}
+        self._assigned = {}  # worker_id -> chunk it is working on
+        self._worker_stats = {}
+        self._next_chunk = 0  # chunk ids stay unique across calls, so stale results can't be mistaken for new ones
+        self.ready = {}  # worker_id -> {"load_s", "threads", "pid"}
+        self._closed = False
+
+        print(f"🧵 Starting {self.workers} caption workers x {self.threads_per_worker} threads...")
+        start_time = time.time()
+        with _thread_env(self.threads_per_worker):
+            for worker_id in range(self.workers):
+                process = context.Process(target=_worker_main, daemon=True,
+                                          args=(worker_id, self.threads_per_worker, options, self._tasks,
+                                                self._results))
+                process.start()
+                self._processes[worker_id] = process
+
+        errors = []
+        while len(self.ready) + len(errors) < self.workers:
+            message = self._next_message()
+            if message[0] == "lost":
+                errors.append("worker exited during startup")
+            elif message[0] == "ready":
+                self.ready[message[1]] = message[2]
+            elif message[0] == "failed":
+                errors.append(message[2])
+        if not self.ready:
+            self.close()
+            raise RuntimeError(f"No caption worker could load the model: {errors[0]}")
+        for error in errors:
+            print(f"⚠️  A caption worker failed to start: {error}")
+        print(f"✅ {len(self.ready)} caption workers ready ({time.time() - start_time:.1f}s, "
+              f"including imports in each process)")
+
+    def _alive(self):
+        return [worker_id for worker_id, process in self._processes.items() if process.is_alive()]
+
+    def _next_message(self):
+        """The next message from a worker, or ("lost", worker_id) if one died without reporting back."""
+        while True:
+            try:
+                return self._results.get(timeout=1.0)
+            except queue.Empty:
+                for worker_id, process in list(self._processes.items()):
+                    if not process.is_alive() and process.exitcode not in (0, None):
+                        del self._processes[worker_id]
+                        return ("lost", worker_id)
+
+    def iter_captions(self, image_paths, styles=("detailed",), max_length=50, chunk_size=DEFAULT_CHUNK_SIZE,
+                      batch_size=None):
+        """Caption an iterable of image paths across the workers.
+
+        Paths are sent in chunks of chunk_size (small chunks balance the load,
+        larger ones let a worker batch more); each worker captions its chunk
+        in batches of batch_size (default: the whole chunk). At most two
+        chunks per worker are queued at a time, so memory stays flat for any
+        number of paths. Yields the same dicts as AppleSiliconBLIP.iter_captions,
+        in input order.
+        """
+        if self._closed:
+            raise RuntimeError("CaptionPool is closed")
+        styles = list(styles)
+        batch_size = batch_size or chunk_size
+        paths = iter(image_paths)
+        chunks = {}  # chunk_id -> paths, until its results are yielded
+        done = {}  # chunk_id -> items that arrived ahead of an earlier chunk
+        next_yield = self._next_chunk
+
+        def submit():
+            while len(chunks) < 2 * max(1, len(self._alive())):
+                chunk = [path for _, path in zip(range(chunk_size), paths)]
+                if not chunk:
+                    return
+                chunks[self._next_chunk] = chunk
+                self._tasks.put((self._next_chunk, chunk, styles, max_length, batch_size))
+                self._next_chunk += 1
+
+        submit()
+        while next_yield in chunks:
+            while next_yield not in done:
+                message = self._next_message()
+                if message[0] == "lost":
+                    # Its chunk will never come back; report it as failed rather than waiting forever
+                    print(f"❌ Caption worker {message[1]} exited unexpectedly")
+                    lost = self._assigned.pop(message[1], None)
+                    if lost in chunks:
+                        done[lost] = _failed_items(chunks[lost], styles, "caption worker exited")
+                    if not self._alive():
+                        for chunk_id, chunk in chunks.items():
+                            done.setdefault(chunk_id, _failed_items(chunk, styles, "no caption workers left"))
+                elif message[0] == "taken":
+                    self._assigned[message[1]] = message[2]
+                elif message[0] == "done":
+                    self._assigned.pop(message[1], None)
+                    if message[2] in chunks:
+                        done[message[2]] = message[3]
+            items = done.pop(next_yield)
+            del chunks[next_yield]
+            next_yield += 1
+            submit()
+            yield from items
+
+    def stats(self):
+        """Per-worker load info, plus cache counters summed over workers once the pool is closed."""
+        info = {"workers": len(self.ready), "threads_per_worker": self.threads_per_worker,
+                "load_s": {worker_id: round(ready["load_s"], 2) for worker_id, ready in self.ready.items()}}
+        for name in ("cache", "near_duplicates"):
+            counters = [stats[name] for stats in self._worker_stats.values() if name in stats]
+            if counters:
+                info[name] = {key: sum(c[key] for c in counters) for key in ("hits", "misses")}
+        return info
+
+    def close(self, timeout=10):
+        if self._closed:
+            return
+        self._closed = True
+        # Drop chunks nobody has started (an abandoned iter_captions) so workers see the stop signal promptly
+        with contextlib.suppress(queue.Empty):
+            while True:
+                self._tasks.get_nowait()
+        alive = self._alive()
+        for _ in alive:
+            self._tasks.put(None)
+        deadline = time.time() + timeout
+        while len(self._worker_stats) < len(alive) and time.time() < deadline:
+            try:
+                message = self._results.get(timeout=max(0.1, deadline - time.time()))
+            except queue.Empty:
+                break
+            if message[0] == "exit":
+                self._worker_stats[message[1]] = message[2]
+        for process in self._processes.values():
+            process.join(max(0.1, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
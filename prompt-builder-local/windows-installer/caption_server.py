@@ -0,0 +1,342 @@
+"""
+Caption Server
+Long-running local captioning service that keeps one BLIP model warm.
+
+Concurrent requests are collected into micro-batches: the first request
+opens a short window (a few ms), everything that arrives within it is
+captioned with a single generate() call. Listens on localhost HTTP so the
+Qt app and batch scripts on macOS and Windows can share one loaded model
+through CaptionClient instead of each paying the from_pretrained cost.
+
+Run:
+  python3 caption_server.py --model-size base --port 8765
+  python3 caption_server.py --timings   # /health then reports per-stage latency
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import add_arguments as add_instrumentation_arguments, instrument
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_SERVER_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+# Set to a URL to point clients elsewhere, or to "off" to never use a server
+SERVER_URL_ENV = "PROMPT_BUILDER_CAPTION_SERVER"
+
+
+class _CaptionRequest:
+    def __init__(self, image_path, prompt_type, max_length, decoding):
+        self.image_path = image_path
+        self.prompt_type = prompt_type
+        self.max_length = max_length
+        self.decoding = decoding
+        self.future = concurrent.futures.Future()
+
+
+class MicroBatcher:
+    """Collects caption requests for up to window_ms and runs them as one batch."""
+
+    def __init__(self, blip, max_batch_size=8, window_ms=20):
+        self.blip = blip
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self.requests = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="caption-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image_path, prompt_type="detailed", max_length=50, decoding=None):
+        request = _CaptionRequest(image_path, prompt_type, max_length, decoding)
+        self._queue.put(request)
+        return request.future
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # finish this batch, then stop
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self.requests += len(batch)
+            self.batches += 1
+
+            # Requests can only share a generate() call if they decode the same way
+            groups = {}
+            for request in batch:
+                key = (request.prompt_type, request.max_length, json.dumps(request.decoding, sort_keys=True))
+                groups.setdefault(key, []).append(request)
+
+            for (prompt_type, max_length, _), requests in groups.items():
+                try:
+                    results = self.blip.generate_captions_batch(
+                        [r.image_path for r in requests], prompt_type, max_length,
+                        batch_size=len(requests), decoding=requests[0].decoding
+                    )
+                except Exception as e:
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    request.future.set_result(result)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": (self.requests / self.batches) if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window * 1000
+        }
+
+
+class _CaptionHandler(BaseHTTPRequestHandler):
+    server_version = "PromptBuilderCaption/1.0"
+
+    def log_message(self, format, *args):
+        pass  # keep the console for the model's own progress output
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.server.health())
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint: {self.path}"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+        if not isinstance(payload, dict):
+            self._send_json(400, {"error": "Expected a JSON object"})
+            return
+
+        from blip1_m1_optimized import CAPTION_PROMPTS, resolve_decoding
+
+        prompt_type = payload.get("prompt_type", "detailed")
+        if not isinstance(prompt_type, str) or prompt_type not in CAPTION_PROMPTS:
+            self._send_json(400, {"error": f"Unknown prompt_type: {prompt_type!r} "
+                                           f"(expected one of {', '.join(CAPTION_PROMPTS)})"})
+            return
+        try:
+            max_length = int(payload.get("max_length", 50))
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {"error": f"Invalid max_length: {e}"})
+            return
+        if max_length < 1:
+            self._send_json(400, {"error": f"Invalid max_length: {max_length} (must be at least 1)"})
+            return
+        decoding = payload.get("decoding")
+        if isinstance(decoding, str):
+            try:
+                decoding = resolve_decoding(decoding)
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+        if self.path == "/caption":
+            paths = [payload.get("path")]
+        elif self.path == "/captions":
+            paths = payload.get("paths") or []
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint: {self.path}"})
+            return
+        if not all(isinstance(p, str) and p for p in paths):
+            self._send_json(400, {"error": "Expected image path(s) as strings"})
+            return
+
+        futures = [self.server.batcher.submit(p, prompt_type, max_length, decoding) for p in paths]
+        try:
+            results = [f.result(timeout=self.server.request_timeout) for f in futures]
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, results[0] if self.path == "/caption" else {"results": results})
+
+
+class CaptionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, blip, host=DEFAULT_HOST, port=DEFAULT_PORT, max_batch_size=8, window_ms=20,
+                 request_timeout=300):
+        super().__init__((host, port), _CaptionHandler)
+        self.blip = blip
+        self.batcher = MicroBatcher(blip, max_batch_size, window_ms)
+        self.request_timeout = request_timeout
+        self.started = time.time()
+        self.timings = None  # instrumentation.HistogramSink when --timings is on
+
+    def health(self):
+        info = {
+            "status": "ok",
+            "model": getattr(self.blip, "model_id", None),
+            "device": getattr(self.blip, "device", None),
+            "uptime_s": round(time.time() - self.started, 1),
+            "batching": self.batcher.stats()
+        }
+        if getattr(self.blip, "cache", None) is not None:
+            info["cache"] = self.blip.cache.stats()
+        if getattr(self.blip, "near_duplicates", None) is not None:
+            info["near_duplicates"] = self.blip.near_duplicates.stats()
+        if self.timings is not None:
+            info["timings"] = self.timings.summary()
+        return info
+
+    def server_close(self):
+        self.batcher.stop()
+        super().server_close()
+
+
+class CaptionClient:
+    """Thin client for CaptionServer with the same captioning interface as AppleSiliconBLIP."""
+
+    def __init__(self, url=DEFAULT_SERVER_URL, timeout=300):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.model_name = None
+
+    def _request(self, endpoint, payload=None, timeout=None):
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(self.url + endpoint, data=data,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", str(e))
+            except Exception:
+                message = str(e)
+            raise RuntimeError(f"Caption server error: {message}") from None
+
+    def health(self, timeout=None):
+        info = self._request("/health", timeout=timeout)
+        self.model_name = info.get("model")
+        return info
+
+    def is_available(self, timeout=0.5):
+        try:
+            return self.health(timeout=timeout).get("status") == "ok"
+        except (OSError, ValueError, RuntimeError):
+            return False
+
+    def generate_caption(self, image_path, prompt_type="detailed", max_length=50, decoding=None, stop_event=None):
+        # A request the server has started runs to completion; stop_event only prevents sending one
+        if stop_event is not None and stop_event.is_set():
+            return None
+        result = self._request("/caption", {"path": os.path.abspath(image_path), "prompt_type": prompt_type,
+                                            "max_length": max_length, "decoding": decoding})
+        if result.get("error"):
+            print(f"❌ Caption server: {result['error']}")
+        return result.get("caption")
+
+    def generate_captions_batch(self, image_paths, prompt_type="detailed", max_length=50, batch_size=None,
+                                decoding=None):
+        result = self._request("/captions", {"paths": [os.path.abspath(p) for p in image_paths],
+                                             "prompt_type": prompt_type, "max_length": max_length,
+                                             "decoding": decoding})
+        return result["results"]
+
+
+def connect_to_server(url=None):
+    """Return a CaptionClient if a caption server is reachable, else None."""
+    url = url or os.environ.get(SERVER_URL_ENV, DEFAULT_SERVER_URL)
+    if url.lower() in ("off", "none", "0", ""):
+        return None
+    client = CaptionClient(url)
+    return client if client.is_available() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve BLIP captions from one warm model over localhost HTTP")
+    parser.add_argument('--model-size', choices=['base', 'large'], default='base')
+    parser.add_argument('--quantize', choices=['none', 'int8'], default='none',
+                        help='int8: dynamic quantization for faster CPU inference')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help='onnx: ONNX Runtime on CPU (graphs are exported once and cached)')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'bfloat16'], default='float32',
+                        help='float16/bfloat16 halve weight memory')
+    parser.add_argument('--no-low-memory', dest='low_memory', action='store_false',
+                        help='Load fp32 weights into RAM first, then move them (the old loader)')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--preset', choices=['greedy-fast', 'beam-2', 'beam-4-quality'], default='beam-4-quality',
+                        help='Default decoding preset; clients can override it per request')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='Most requests merged into one generate()')
+    parser.add_argument('--window-ms', type=float, default=20, help='How long to wait for more requests')
+    parser.add_argument('--no-cache', action='store_true', help='Always recompute captions')
+    parser.add_argument('--near-dup-distance', type=int, default=None,
+                        help='Reuse captions of images within this perceptual-hash distance (0 disables)')
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument(args) as timings:
+        serve(args, timings)
+
+
+def serve(args, timings=None):
+    from blip1_m1_optimized import AppleSiliconBLIP
+    from caption_cache import CaptionCache
+    from near_duplicates import DEFAULT_MAX_DISTANCE, NearDuplicateIndex
+
+    cache = None if args.no_cache else CaptionCache()
+    distance = DEFAULT_MAX_DISTANCE if args.near_dup_distance is None else args.near_dup_distance
+    near_duplicates = None if args.no_cache or distance <= 0 else NearDuplicateIndex(max_distance=distance)
+    blip = AppleSiliconBLIP(args.model_size, cache=cache, quantize=args.quantize, decoding=args.preset,
+                            backend=args.backend, dtype=args.dtype, low_memory=args.low_memory,
+                            near_duplicates=near_duplicates)
+    server = CaptionServer(blip, args.host, args.port, args.max_batch_size, args.window_ms)
+    server.timings = timings
+    print(f"🚀 Caption server listening on http://{args.host}:{args.port} "
+          f"(batch ≤ {args.max_batch_size}, window {args.window_ms:g} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Shutting down caption server")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,74 @@
-from blip1_m1_optimized import AppleSiliconBLIP
+# Only light modules at import time: the GUI imports this before its window exists. The cache (sqlite3), the
+# near-duplicate index (numpy, PIL) and the server client (urllib) are imported on first use.
+from instrumentation import span
+from model_manager import ModelManager
 import os
 import re
+import threading
 
-blip = None  # Lazy init
+caption_client = None  # Lazy init: warm caption server client, False once probed and absent
+model_manager = None  # Lazy init: pool of local captioners, keyed by model size
+caption_cache = None  # Lazy init, shared across calls
+near_duplicates = None  # Lazy init: perceptual-hash index so near-identical images reuse captions
+_init_lock = threading.Lock()  # guards the lazy inits above; model loads are single-flight in ModelManager
+
+def get_model_manager():
+    """Return the shared ModelManager, creating it on first use."""
+    global model_manager, caption_cache, near_duplicates
+    with _init_lock:
+        if model_manager is None:
+            from caption_cache import CaptionCache
+            from near_duplicates import DEFAULT_MAX_DISTANCE, NearDuplicateIndex
+
+            if caption_cache is None:
+                caption_cache = CaptionCache()
+            if near_duplicates is None and DEFAULT_MAX_DISTANCE > 0:
+                near_duplicates = NearDuplicateIndex()
+            model_manager = ModelManager(cache=caption_cache, near_duplicates=near_duplicates)
+        return model_manager
+
+def get_caption_client():
+    """Return the caption server client, or False if no server was found (probed once)."""
+    global caption_client
+    with _init_lock:
+        if caption_client is None:
+            from caption_server import connect_to_server
+
+            caption_client = connect_to_server() or False
+            if caption_client:
+                print(f"🔌 Using caption server at {caption_client.url} ({caption_client.model_name})")
+        return caption_client
+
+def serves_model(client, model_size):
+    """True if the caption server runs the model that model_size names (in any quantization/dtype)."""
+    from model_snapshot import resolve_model_name
+
+    # The server reports its model_id, e.g. "Salesforce/blip-image-captioning-base+int8"
+    return bool(client.model_name) and client.model_name.split("+")[0] == resolve_model_name(model_size)
+
+def get_captioner(model_size="base"):
+    """Return a warm caption server running model_size's model, else the local captioner from the pool."""
+    client = get_caption_client()
+    if client and serves_model(client, model_size):
+        return client
+    return get_model_manager().get(model_size)
+
+def preload_captioner(model_size="base"):
+    """Warm up captioning in the background (e.g. at app start or when an image is picked).
+
+    Probes for a caption server and, if there is none, starts loading the
+    local model. Returns immediately; a later generate_prompts_from_image
+    call waits for the in-flight load instead of starting another.
+    """
+    def warm():
+        try:
+            client = get_caption_client()
+            if not (client and serves_model(client, model_size)):
+                get_model_manager().preload(model_size)
+        except Exception as e:
+            print(f"❌ Captioner preload failed: {e}")
+
+    threading.Thread(target=warm, name="captioner-preload", daemon=True).start()
 
 def normalize_text(text: str) -> str:
     # Basic cleanup
@@ -15,32 +81,61 @@ def normalize_text(text: str) -> str:
     text = text.strip(" {}[]\"'")
     return text
 
-def generate_prompts_from_image(image_path, model_size="base"):
-    global blip
+def generate_prompts_from_image(image_path, model_size="base", preset=None):
+    """Return three prompt variations for an image.
 
+    preset picks a decoding speed/quality trade-off ("greedy-fast", "beam-2",
+    "beam-4-quality"); None keeps the captioner's default.
+    """
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image not found: {image_path}")
 
-    # Lazy-initialize BLIP-1 once
-    if blip is None:
-        blip = AppleSiliconBLIP(model_size)
+    # Prefer a running caption server's warm model; otherwise load locally via the pool
+    blip = get_captioner(model_size)
 
     # 1) Get a strong descriptive base caption
-    base = blip.generate_caption(image_path, prompt_type="detailed", max_length=60) or ""
-    base = normalize_text(base)
-
-    if not base:
-        # True fallback: only use this if BLIP returns empty
-        return [
-            "Describe the image in detail: subject, composition, colors, style, lighting.",
-            "Summarize key elements of the image as an AI art prompt.",
-            "Extract objects, scene, mood, and style cues from the image."
-        ]
+    base = blip.generate_caption(image_path, prompt_type="detailed", max_length=60, decoding=preset) or ""
+    return build_prompt_variations(base)
+
+def stream_prompts_from_image(image_path, model_size="base", preset=None, sample=False):
+    """Like generate_prompts_from_image, but yields (caption so far, None) while
+    the base caption is being generated and finally (caption, prompts).
+
+    Streaming decodes greedily (or samples with sample=True); a caption
+    server, which can't stream, yields the finished result once.
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found: {image_path}")
 
-    # 2) Create 3 useful variations from the base caption
-    prompts = [
-        normalize_text(f"{base}, photorealistic, high detail, natural lighting, crisp focus"),
-        normalize_text(f"{base}, minimalist composition, soft lighting, muted palette, modern design"),
-        normalize_text(f"{base}, artistic interpretation, cinematic lighting, volumetric light, dramatic contrast")
-    ]
+    blip = get_captioner(model_size)
+    if not hasattr(blip, "stream_caption"):
+        base = blip.generate_caption(image_path, prompt_type="detailed", max_length=60, decoding=preset) or ""
+        yield base, build_prompt_variations(base)
+        return
+
+    base = ""
+    for base in blip.stream_caption(image_path, prompt_type="detailed", max_length=60, decoding=preset,
+                                    sample=sample):
+        yield base, None
+    yield base, build_prompt_variations(base)
+
+def build_prompt_variations(base):
+    """Turn a base caption into three prompt variations."""
+    with span("format", stage="caption_variations"):
+        base = normalize_text(base)
+
+        if not base:
+            # True fallback: only use this if BLIP returns empty
+            return [
+                "Describe the image in detail: subject, composition, colors, style, lighting.",
+                "Summarize key elements of the image as an AI art prompt.",
+                "Extract objects, scene, mood, and style cues from the image."
+            ]
+
+        # 2) Create 3 useful variations from the base caption
+        prompts = [
+            normalize_text(f"{base}, photorealistic, high detail, natural lighting, crisp focus"),
+            normalize_text(f"{base}, minimalist composition, soft lighting, muted palette, modern design"),
+            normalize_text(f"{base}, artistic interpretation, cinematic lighting, volumetric light, dramatic contrast")
+        ]
     return prompts
\ No newline at end of file
@@ -30,6 +30,18 @@ if not exist "layout_local_only.ui" set "MISSING_FILES=!MISSING_FILES! layout_lo
 if not exist "ai_generators.py" set "MISSING_FILES=!MISSING_FILES! ai_generators.py"
 if not exist "generate_prompts_from_image.py" set "MISSING_FILES=!MISSING_FILES! generate_prompts_from_image.py"
 if not exist "blip1_m1_optimized.py" set "MISSING_FILES=!MISSING_FILES! blip1_m1_optimized.py"
+if not exist "caption_cache.py" set "MISSING_FILES=!MISSING_FILES! caption_cache.py"
+if not exist "image_loader.py" set "MISSING_FILES=!MISSING_FILES! image_loader.py"
+if not exist "caption_server.py" set "MISSING_FILES=!MISSING_FILES! caption_server.py"
+if not exist "blip_onnx.py" set "MISSING_FILES=!MISSING_FILES! blip_onnx.py"
+if not exist "instrumentation.py" set "MISSING_FILES=!MISSING_FILES! instrumentation.py"
+if not exist "model_manager.py" set "MISSING_FILES=!MISSING_FILES! model_manager.py"
+if not exist "model_snapshot.py" set "MISSING_FILES=!MISSING_FILES! model_snapshot.py"
+if not exist "near_duplicates.py" set "MISSING_FILES=!MISSING_FILES! near_duplicates.py"
+if not exist "caption_pool.py" set "MISSING_FILES=!MISSING_FILES! caption_pool.py"
+if not exist "prompt_refiner.py" set "MISSING_FILES=!MISSING_FILES! prompt_refiner.py"
+if not exist "async_pipeline.py" set "MISSING_FILES=!MISSING_FILES! async_pipeline.py"
+if not exist "video_prompts.py" set "MISSING_FILES=!MISSING_FILES! video_prompts.py"
 if not exist "requirements_local_only.txt" set "MISSING_FILES=!MISSING_FILES! requirements_local_only.txt"
 
 if not "!MISSING_FILES!"=="" (
@@ -49,6 +61,18 @@ copy "layout_local_only.ui" "%INSTALL_DIR%\" >nul
 copy "ai_generators.py" "%INSTALL_DIR%\" >nul
 copy "generate_prompts_from_image.py" "%INSTALL_DIR%\" >nul
 copy "blip1_m1_optimized.py" "%INSTALL_DIR%\" >nul
+copy "caption_cache.py" "%INSTALL_DIR%\" >nul
+copy "image_loader.py" "%INSTALL_DIR%\" >nul
+copy "caption_server.py" "%INSTALL_DIR%\" >nul
+copy "blip_onnx.py" "%INSTALL_DIR%\" >nul
+copy "instrumentation.py" "%INSTALL_DIR%\" >nul
+copy "model_manager.py" "%INSTALL_DIR%\" >nul
+copy "model_snapshot.py" "%INSTALL_DIR%\" >nul
+copy "near_duplicates.py" "%INSTALL_DIR%\" >nul
+copy "caption_pool.py" "%INSTALL_DIR%\" >nul
+copy "prompt_refiner.py" "%INSTALL_DIR%\" >nul
+copy "async_pipeline.py" "%INSTALL_DIR%\" >nul
+copy "video_prompts.py" "%INSTALL_DIR%\" >nul
 copy "requirements_local_only.txt" "%INSTALL_DIR%\" >nul
 
 REM Copy logo if it exists
@@ -98,6 +122,17 @@ if errorlevel 1 (
 )
 echo.
 
+REM Snapshot the captioning model so the app starts offline
+echo [INFO] Downloading the BLIP captioning model (~1GB) for offline use...
+python "%INSTALL_DIR%\model_snapshot.py" base --models-dir "%MODELS_DIR%"
+if errorlevel 1 (
+    echo [WARNING] Captioning model download failed; it will be downloaded on first use.
+    echo [WARNING] To retry: python "%INSTALL_DIR%\model_snapshot.py" base
+) else (
+    echo [SUCCESS] Captioning model saved to %MODELS_DIR%.
+)
+echo.
+
 REM Create launcher batch file
 echo [INFO] Creating launcher script...
 (
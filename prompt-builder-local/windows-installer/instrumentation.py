@@ -0,0 +1,249 @@
+"""
+Instrumentation
+Lightweight timing spans for the caption, refine and format stages.
+
+Code marks a stage with `with span("generate", batch=4):`. Spans cost a
+single list check until a sink is installed, so they stay in production
+code. Stage names used across the app: load, decode, preprocess, encode,
+generate, tokenizer_decode, llm_eval and format.
+
+Sinks:
+  HistogramSink   per-stage latency distributions kept in memory
+  JsonlTraceSink  one JSON line per finished span, appended to a file
+  profile()       wraps a run in cProfile or torch.profiler; spans show up
+                  as labelled ranges in torch traces
+
+The CLIs expose these as --timings, --trace PATH and --profile; setting
+PROMPT_BUILDER_TRACE=path traces any entry point without extra flags.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+TRACE_ENV = "PROMPT_BUILDER_TRACE"
+PROFILE_MODES = ("cprofile", "torch")
+
+_sinks = []
+_sinks_lock = threading.Lock()
+_local = threading.local()
+_record_function = None  # torch.profiler.record_function while a torch profile is running
+
+
+def add_sink(sink):
+    with _sinks_lock:
+        _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time the enclosed block and hand the result to every installed sink."""
+    if not _sinks and _record_function is None:
+        yield
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    labelled = _record_function(name) if _record_function is not None else contextlib.nullcontext()
+    start_wall = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        with labelled:
+            yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        stack.pop()
+        record = {
+            "name": name,
+            "start": round(start_wall, 6),
+            "duration_ms": round(duration_ms, 3),
+            "parent": parent,
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+            "error": error
+        }
+        for sink in list(_sinks):
+            sink.record(record)
+
+
+class HistogramSink:
+    """Keeps a latency histogram and recent samples for every span name."""
+
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    def __init__(self, max_samples=10000):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=max_samples))
+        self._buckets = defaultdict(lambda: [0] * (len(self.BUCKETS_MS) + 1))
+        self._counts = defaultdict(int)
+        self._totals = defaultdict(float)
+        self._errors = defaultdict(int)
+
+    def record(self, record):
+        name = record["name"]
+        duration = record["duration_ms"]
+        with self._lock:
+            self._samples[name].append(duration)
+            self._buckets[name][bisect.bisect_left(self.BUCKETS_MS, duration)] += 1
+            self._counts[name] += 1
+            self._totals[name] += duration
+            if record["error"]:
+                self._errors[name] += 1
+
+    def summary(self):
+        """Return {span name: count, total/mean/percentiles in ms, bucket counts}."""
+        result = {}
+        with self._lock:
+            for name, samples in self._samples.items():
+                ordered = sorted(samples)
+
+                def pct(p):
+                    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+                labels = [f"<={b}" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}"]
+                result[name] = {
+                    "count": self._counts[name],
+                    "errors": self._errors[name],
+                    "total_ms": round(self._totals[name], 3),
+                    "mean_ms": round(self._totals[name] / self._counts[name], 3),
+                    "p50_ms": pct(50),
+                    "p90_ms": pct(90),
+                    "p99_ms": pct(99),
+                    "max_ms": ordered[-1],
+                    "buckets_ms": {label: n for label, n in zip(labels, self._buckets[name]) if n}
+                }
+        return result
+
+    def report(self):
+        lines = [f"{'stage':<18} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'total s':>9}"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(f"{name:<18} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} "
+                         f"{stats['p99_ms']:>9.1f} {stats['total_ms'] / 1000:>9.2f}")
+        return "\n".join(lines)
+
+
+class JsonlTraceSink:
+    """Appends every finished span to a JSONL file."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def record(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+@contextlib.contextmanager
+def profile(mode="cprofile", output=None, top=25):
+    """Profile the enclosed block with cProfile or torch.profiler.
+
+    cProfile stats are written to output (a .prof file for snakeviz/pstats);
+    torch profiles are written as a Chrome trace (open in chrome://tracing or
+    Perfetto). A summary table goes to stderr either way.
+    """
+    global _record_function
+
+    if mode == "cprofile":
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(output)
+                print(f"📊 cProfile stats written to {output}", file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(top)
+    elif mode == "torch":
+        import torch
+        from torch.profiler import ProfilerActivity, record_function
+        from torch.profiler import profile as torch_profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with torch_profile(activities=activities) as profiler:
+            _record_function = record_function
+            try:
+                yield
+            finally:
+                _record_function = None
+        if output:
+            profiler.export_chrome_trace(output)
+            print(f"📊 torch.profiler trace written to {output}", file=sys.stderr)
+        print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=top), file=sys.stderr)
+    else:
+        raise ValueError(f"Unknown profile mode: {mode!r} (expected one of {PROFILE_MODES})")
+
+
+def add_arguments(parser):
+    """Add --timings, --trace, --profile and --profile-output to an argparse parser."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument('--timings', action='store_true', help='Print per-stage latency histograms on exit')
+    group.add_argument('--trace', metavar='PATH', help=f'Append one JSON line per timed stage (or set {TRACE_ENV})')
+    group.add_argument('--profile', choices=PROFILE_MODES, help='Capture a cProfile or torch.profiler run')
+    group.add_argument('--profile-output', metavar='PATH',
+                       help='Where to save the profile (.prof for cprofile, Chrome trace .json for torch)')
+    return group
+
+
+@contextlib.contextmanager
+def instrument(args=None):
+    """Install the sinks requested by CLI args (or the environment) for the duration of a run.
+
+    Yields the HistogramSink when --timings is on, else None. Reports go to
+    stderr so JSONL on stdout stays clean.
+    """
+    installed = []
+    trace_path = getattr(args, "trace", None) or os.environ.get(TRACE_ENV)
+    if trace_path:
+        installed.append(add_sink(JsonlTraceSink(trace_path)))
+    histograms = add_sink(HistogramSink()) if getattr(args, "timings", False) else None
+    if histograms is not None:
+        installed.append(histograms)
+    mode = getattr(args, "profile", None)
+
+    try:
+        with profile(mode, getattr(args, "profile_output", None)) if mode else contextlib.nullcontext():
+            yield histograms
+    finally:
+        for sink in installed:
+            remove_sink(sink)
+            if hasattr(sink, "close"):
+                sink.close()
+        if histograms is not None and histograms.summary():
+            print("\n⏱️  Stage timings\n" + histograms.report(), file=sys.stderr)
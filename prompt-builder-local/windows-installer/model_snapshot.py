@@ -0,0 +1,207 @@
+"""
+Model Snapshot
+Pins the BLIP processor and weights to a local directory at install time so
+the app never resolves models through the Hugging Face hub at startup.
+
+Each snapshot lives in models/<repo--name>/ next to the app (or under
+PROMPT_BUILDER_MODELS_DIR) with a manifest.json recording the repo, the
+exact hub commit it was taken from, and the size and SHA-256 of every file.
+AppleSiliconBLIP loads from a valid snapshot with local_files_only=True, so
+a cold start is a handful of stat() calls plus reading the weights; without
+a snapshot it falls back to the hub cache as before.
+
+Usage (the installers run the first form):
+  python3 model_snapshot.py base
+  python3 model_snapshot.py base large --revision <commit>
+  python3 model_snapshot.py --list
+  python3 model_snapshot.py base --verify
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+DEFAULT_MODELS_DIR = os.environ.get(
+    "PROMPT_BUILDER_MODELS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+)
+MODEL_NAMES = {
+    "base": "Salesforce/blip-image-captioning-base",
+    "large": "Salesforce/blip-image-captioning-large"
+}
+MANIFEST_NAME = "manifest.json"
+SNAPSHOT_VERSION = 1
+
+# Everything BlipProcessor and BlipForConditionalGeneration read; safetensors preferred over .bin
+_CONFIG_PATTERNS = ["*.json", "*.txt", "*.model"]
+_WEIGHT_PATTERNS = ["*.safetensors", "*.bin"]
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def resolve_model_name(model_size):
+    """Map "base"/"large" (or a local checkpoint directory) to what from_pretrained loads."""
+    if model_size in MODEL_NAMES:
+        return MODEL_NAMES[model_size]
+    if os.path.isdir(str(model_size)):
+        return model_size  # local checkpoint directory, e.g. the benchmarks' tiny model
+    return MODEL_NAMES["base"]
+
+
+def snapshot_dir(model_name, models_dir=DEFAULT_MODELS_DIR):
+    return os.path.join(models_dir, model_name.replace("/", "--"))
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("snapshot_version") == SNAPSHOT_VERSION else None
+
+
+def verify_snapshot(path, full=False):
+    """Return a list of problems with the snapshot at path (empty when it is usable).
+
+    The quick check compares file sizes against the manifest; full=True also
+    re-hashes every file.
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        return [f"no valid {MANIFEST_NAME} in {path}"]
+    problems = []
+    for name, info in manifest["files"].items():
+        file_path = os.path.join(path, name)
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            problems.append(f"missing {name}")
+            continue
+        if size != info["size"]:
+            problems.append(f"{name} is {size} bytes, expected {info['size']}")
+        elif full and _sha256(file_path) != info["sha256"]:
+            problems.append(f"{name} does not match its recorded SHA-256")
+    return problems
+
+
+def resolve_snapshot(model_name, models_dir=DEFAULT_MODELS_DIR):
+    """Return the directory of a usable snapshot of model_name, or None."""
+    path = snapshot_dir(model_name, models_dir)
+    if not os.path.isdir(path):
+        return None
+    problems = verify_snapshot(path)
+    if problems:
+        print(f"⚠️  Ignoring damaged model snapshot {path}: {problems[0]}")
+        return None
+    return path
+
+
+def create_snapshot(model_name, revision=None, models_dir=DEFAULT_MODELS_DIR, force=False):
+    """Download model_name at revision into its snapshot directory and write the manifest.
+
+    The files land in a .partial directory that is renamed into place only
+    once the manifest is written, so an interrupted download never looks
+    like a valid snapshot.
+    """
+    from huggingface_hub import HfApi, snapshot_download
+
+    target = snapshot_dir(model_name, models_dir)
+    if not force and resolve_snapshot(model_name, models_dir):
+        print(f"✅ Snapshot already present: {target}")
+        return target
+
+    info = HfApi().model_info(model_name, revision=revision)
+    repo_files = [sibling.rfilename for sibling in info.siblings]
+    has_safetensors = any(name.endswith(".safetensors") for name in repo_files)
+    patterns = _CONFIG_PATTERNS + (["*.safetensors"] if has_safetensors else ["*.bin"])
+
+    partial = target + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    print(f"📦 Downloading {model_name}@{info.sha[:12]} to {target}...")
+    start_time = time.time()
+    # Pin to the resolved commit so a push to the repo mid-download can't mix revisions
+    snapshot_download(model_name, revision=info.sha, local_dir=partial, allow_patterns=patterns)
+
+    files = {}
+    for root, dirs, names in os.walk(partial):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]  # huggingface_hub's .cache metadata
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            files[os.path.relpath(file_path, partial).replace(os.sep, "/")] = {
+                "size": os.path.getsize(file_path),
+                "sha256": _sha256(file_path)
+            }
+    manifest = {
+        "snapshot_version": SNAPSHOT_VERSION,
+        "model_name": model_name,
+        "revision": info.sha,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "files": files
+    }
+    with open(os.path.join(partial, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+    total_mb = sum(f["size"] for f in files.values()) / (1024 * 1024)
+    print(f"✅ Snapshot of {model_name} ready ({total_mb:.0f} MB, {time.time() - start_time:.0f}s)")
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot BLIP models for fully offline startup")
+    parser.add_argument('models', nargs='*', default=['base'],
+                        help='base, large, or a Hugging Face repo id (default: base)')
+    parser.add_argument('--revision', help='Hub branch, tag or commit to pin (default: main)')
+    parser.add_argument('--models-dir', default=DEFAULT_MODELS_DIR, help='Where snapshots are stored')
+    parser.add_argument('--force', action='store_true', help='Download again even if a snapshot exists')
+    parser.add_argument('--verify', action='store_true', help='Re-hash existing snapshots instead of downloading')
+    parser.add_argument('--list', action='store_true', help='Show the snapshots in --models-dir')
+    args = parser.parse_args()
+
+    if args.list:
+        names = sorted(os.listdir(args.models_dir)) if os.path.isdir(args.models_dir) else []
+        for name in names:
+            manifest = read_manifest(os.path.join(args.models_dir, name))
+            if manifest:
+                size_mb = sum(f["size"] for f in manifest["files"].values()) / (1024 * 1024)
+                print(f"{manifest['model_name']:<45} {manifest['revision'][:12]}  {size_mb:>7.0f} MB  "
+                      f"{manifest['created_at']}")
+        if not names:
+            print(f"No snapshots in {args.models_dir}")
+        return
+
+    failed = False
+    for model in args.models:
+        model_name = MODEL_NAMES.get(model, model)
+        if args.verify:
+            problems = verify_snapshot(snapshot_dir(model_name, args.models_dir), full=True)
+            for problem in problems:
+                print(f"❌ {model_name}: {problem}")
+            if not problems:
+                print(f"✅ {model_name}: snapshot verified")
+            failed = failed or bool(problems)
+            continue
+        try:
+            create_snapshot(model_name, args.revision, args.models_dir, args.force)
+        except Exception as e:
+            print(f"❌ Could not snapshot {model_name}: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
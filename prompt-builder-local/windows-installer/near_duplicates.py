@@ -0,0 +1,292 @@
+"""
+Near-Duplicate Index
+Perceptual hashes of captioned images, so resized copies, re-encoded JPEGs
+and burst shots reuse an existing caption instead of running BLIP again.
+
+Each image is reduced to a 64-bit pHash (low frequencies of a DCT of a
+32x32 grayscale thumbnail) or dHash (horizontal gradients of a 9x8
+thumbnail) and stored as an integer in SQLite together with its caption and
+a digest of the captioning settings. A lookup returns the caption of the
+closest image captioned with the same settings, if it is within
+max_distance differing bits (Hamming distance).
+
+Flat images (solid backgrounds, blank scans, the black of a fade) have no
+structure to hash: their pHash bits are rounding noise and their dHash is
+all zeros, so a white page would match a grey or blue one. They are neither
+indexed nor looked up and always go through the model.
+
+The caption cache catches byte-identical files first; this index only runs
+on its misses. PROMPT_BUILDER_NEAR_DUP_DISTANCE sets the default threshold
+(0 turns reuse off).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from caption_cache import DEFAULT_CACHE_DIR
+from image_loader import load_image
+
+DEFAULT_INDEX_PATH = os.path.join(DEFAULT_CACHE_DIR, "near_duplicates.sqlite3")
+# pHash bits that may differ: re-encodes and resizes land at 0-2, burst shots around 3-6
+DEFAULT_MAX_DISTANCE = int(os.environ.get("PROMPT_BUILDER_NEAR_DUP_DISTANCE", 4))
+DEFAULT_MAX_ENTRIES = 50000
+HASH_METHODS = ("phash", "dhash")
+# Grayscale standard deviation (0-255) of a 32x32 thumbnail below which an image counts as flat:
+# solid colours and blank scans measure under 1, hazy low-detail photos 5 and up
+FLAT_MAX_STDDEV = 2.0
+
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_int(bits):
+    return int("".join("1" if bit else "0" for bit in bits.ravel()), 2)
+
+
+def phash(image):
+    """64-bit perceptual hash: signs of the 8x8 lowest DCT frequencies against their median."""
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _bits_to_int(low > np.median(low.ravel()[1:]))  # the DC term would skew the median
+
+
+def dhash(image):
+    """64-bit difference hash: whether each pixel is brighter than its right neighbour."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def flat_colour(image):
+    """Return the mean (R, G, B) of a flat image, whose hash would carry no information, else None."""
+    thumbnail = image.convert("RGB").resize((32, 32), Image.BOX)
+    if np.asarray(thumbnail.convert("L"), dtype=np.float64).std() >= FLAT_MAX_STDDEV:
+        return None
+    return tuple(int(round(c)) for c in np.asarray(thumbnail, dtype=np.float64).reshape(-1, 3).mean(axis=0))
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _popcount(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def settings_digest(model_name, prompt_type, generation_kwargs):
+    """Digest of everything besides the image that changes a caption."""
+    payload = json.dumps({"model": model_name, "prompt_type": prompt_type, "generation": generation_kwargs},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Bucket:
+    """Hashes with one value each (a caption, or a batch index), kept in a growable uint64 array."""
+
+    def __init__(self):
+        self.hashes = np.empty(64, dtype=np.uint64)
+        self.values = []
+
+    def append(self, image_hash, value):
+        count = len(self.values)
+        if count == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.empty(count, dtype=np.uint64)])
+        self.hashes[count] = image_hash
+        self.values.append(value)
+
+    def nearest(self, image_hash):
+        """Return (value, distance) of the closest hash, or (None, None) when empty."""
+        if not self.values:
+            return None, None
+        distances = _popcount(self.hashes[:len(self.values)] ^ np.uint64(image_hash))
+        best = int(distances.argmin())
+        return self.values[best], int(distances[best])
+
+
+class NearDuplicateIndex:
+    """SQLite-backed perceptual-hash index with Hamming-distance lookup and hit statistics."""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, max_distance=DEFAULT_MAX_DISTANCE, method="phash",
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method!r} (expected one of {HASH_METHODS})")
+        self.path = path
+        self.max_distance = max_distance
+        self.method = method
+        self.max_entries = max_entries
+        self._hash_image = phash if method == "phash" else dhash
+        self.hits = 0
+        self.misses = 0
+        self.batch_reuses = 0  # images that shared a caption with a near-duplicate in the same batch
+        self.flat_skips = 0  # lookups skipped because the image is flat
+        self.hit_distances = Counter()
+        self.hash_ms = 0.0
+        self._lock = threading.Lock()
+        self._buckets = {}  # settings digest -> _Bucket, loaded from SQLite on first use
+        self._image_hashes = {}  # (abspath, mtime_ns, size) -> hash, so lookup then add decodes once
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_hashes ("
+            "method TEXT NOT NULL, settings TEXT NOT NULL, hash INTEGER NOT NULL, "
+            "caption TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS image_hashes_settings ON image_hashes(method, settings)")
+        self._conn.commit()
+
+    def image_hash(self, image_path):
+        """Return the 64-bit perceptual hash of an image file, or None if it is flat.
+
+        Raises OSError if the file can't be read.
+        """
+        st = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+        if memo_key not in self._image_hashes:
+            start = time.perf_counter()
+            # A 64px decode is plenty for a 32x32 thumbnail and lets JPEGs skip most of the work
+            image = load_image(image_path, 64)
+            self._image_hashes[memo_key] = None if flat_colour(image) else self._hash_image(image)
+            self.hash_ms += (time.perf_counter() - start) * 1000
+        return self._image_hashes[memo_key]
+
+    def _bucket(self, settings):
+        bucket = self._buckets.get(settings)
+        if bucket is None:
+            bucket = self._buckets[settings] = _Bucket()
+            rows = self._conn.execute(
+                "SELECT hash, caption FROM image_hashes WHERE method = ? AND settings = ? ORDER BY created",
+                (self.method, settings)
+            )
+            for value, caption in rows:
+                bucket.append(value % (1 << 64), caption)
+        return bucket
+
+    def lookup(self, image_path, settings):
+        """Return the caption of a near-identical image captioned with these settings, or None."""
+        if not self.max_distance:
+            return None
+        try:
+            image_hash = self.image_hash(image_path)
+        except Exception:
+            return None  # unreadable file; the caption path reports it
+        if image_hash is None:
+            with self._lock:
+                self.flat_skips += 1
+            return None
+        with self._lock:
+            caption, distance = self._bucket(settings).nearest(image_hash)
+            if caption is None or distance > self.max_distance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.hit_distances[distance] += 1
+            return caption
+
+    def cluster(self, image_paths):
+        """Group near-identical images within one batch.
+
+        Returns, for each path, the index of the first earlier path within
+        max_distance (its own index if there is none, or if it is flat or
+        can't be read), so only one image per group needs to go through the
+        model.
+        """
+        representatives = _Bucket()
+        groups = []
+        for index, path in enumerate(image_paths):
+            group = index
+            try:
+                image_hash = self.image_hash(path) if self.max_distance else None
+            except Exception:
+                image_hash = None
+            if image_hash is not None:
+                representative, distance = representatives.nearest(image_hash)
+                if representative is not None and distance <= self.max_distance:
+                    group = representative
+                    with self._lock:
+                        self.batch_reuses += 1
+                        self.hit_distances[distance] += 1
+                else:
+                    representatives.append(image_hash, index)
+            groups.append(group)
+        return groups
+
+    def add(self, image_path, settings, caption):
+        if not caption:
+            return
+        try:
+            image_hash = self.image_hash(image_path)
+        except Exception:
+            return
+        if image_hash is None:
+            return
+        with self._lock:
+            self._bucket(settings).append(image_hash, caption)
+            self._conn.execute(
+                "INSERT INTO image_hashes (method, settings, hash, caption, created) VALUES (?, ?, ?, ?, ?)",
+                (self.method, settings, _to_signed(image_hash), caption, time.time())
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0]
+            if count > self.max_entries * 1.1:
+                # Prune in chunks so the in-memory buckets are only rebuilt occasionally
+                self._conn.execute(
+                    "DELETE FROM image_hashes WHERE rowid IN "
+                    "(SELECT rowid FROM image_hashes ORDER BY created ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                self._buckets.clear()
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM image_hashes")
+            self._conn.commit()
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "batch_reuses": self.batch_reuses,
+            "flat_skips": self.flat_skips,
+            "hit_distances": dict(sorted(self.hit_distances.items())),
+            "entries": entries,
+            "method": self.method,
+            "max_distance": self.max_distance,
+            "hash_ms": round(self.hash_ms, 1),
+            "path": self.path
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
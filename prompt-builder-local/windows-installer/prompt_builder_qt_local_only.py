@@ -1,17 +1,20 @@
 import sys
 import os
-import requests
+import argparse
 import json
 import re
 import concurrent.futures
+import importlib.util
 import traceback
 import subprocess
 import stat
-from functools import partial
+import html
+import threading
+import time
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QFileDialog,
     QMessageBox, QTextEdit, QComboBox, QLabel,
     QPushButton, QSpinBox, QFrame, QCheckBox)
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt, QTimer, QObject, pyqtSignal
 from PyQt6.QtGui import QPixmap
 from PyQt6 import uic
 
@@ -20,19 +23,81 @@ from ai_generators import (
     get_generator_names, get_generator_config, supports_negative_prompt,
     has_flags, format_prompt, get_midjourney_options
 )
-from generate_prompts_from_image import generate_prompts_from_image
-
-# Try to import llama-cpp-python (optional)
-try:
-    from llama_cpp import Llama
-    LLAMA_CPP_AVAILABLE = True
-except ImportError:
-    LLAMA_CPP_AVAILABLE = False
+from generate_prompts_from_image import preload_captioner, stream_prompts_from_image
+from instrumentation import add_arguments as add_instrumentation_arguments, instrument, span
+from prompt_refiner import load_llm, stream_refinement
+
+# llama-cpp-python is optional. Only look it up here: importing it loads its native library,
+# which waits until the model itself is loaded in the background
+LLAMA_CPP_AVAILABLE = importlib.util.find_spec("llama_cpp") is not None
+if not LLAMA_CPP_AVAILABLE:
     print("llama-cpp-python not installed. Local LLM will not be available.")
 
 # --- Configuration ---
 # Local LLM model path - CHANGE THIS to your downloaded model
 LOCAL_MODEL_PATH = "/Users/jozefkubica/prompt_builder/models/phi-3-mini-4k-instruct-q4.gguf"
+# Streamed refinement text reaches the GUI at most this often; the first tokens go out at once
+REFINE_UPDATE_INTERVAL_S = 0.05
+# Load the LLM in the background as soon as the window is up; "0" loads it on the first Refine click instead
+PRELOAD_LLM = os.environ.get("PROMPT_BUILDER_PRELOAD_LLM", "1") != "0"
+
+def llm_diagnostics(model_path=None):
+    """Return a report on why the local LLM can or can't load (llama_cpp import, model file details)."""
+    model_path = model_path or LOCAL_MODEL_PATH
+    lines = ["=== Local LLM diagnostics ===", f"LLAMA_CPP_AVAILABLE: {LLAMA_CPP_AVAILABLE}"]
+
+    # Try import again and report details
+    try:
+        import llama_cpp
+        lines.append(f"Imported llama_cpp (llama-cpp-python {getattr(llama_cpp, '__version__', '?')}) successfully.")
+    except Exception as e:
+        lines.append(f"ImportError: failed to import llama_cpp: {e!r}")
+
+    lines.append(f"Configured LOCAL_MODEL_PATH: {model_path}")
+
+    # File existence & metadata
+    try:
+        exists = os.path.exists(model_path)
+        lines.append(f"Model exists: {exists}")
+        if exists:
+            st = os.stat(model_path)
+            lines.append(f"Model file size (bytes): {st.st_size}")
+            lines.append(f"Model file mode: {oct(st.st_mode)}")
+            lines.append("Model file permissions (rwx for owner): "
+                         f"{bool(st.st_mode & stat.S_IRUSR)} {bool(st.st_mode & stat.S_IWUSR)} "
+                         f"{bool(st.st_mode & stat.S_IXUSR)}")
+            # Run 'file' to see actual file type
+            try:
+                file_out = subprocess.run(["file", model_path], capture_output=True, text=True, check=False)
+                lines.append(f"`file` output: {file_out.stdout.strip()}")
+            except Exception as e:
+                lines.append(f"Could not run `file` command: {e!r}")
+        else:
+            lines.append("Model not found at path. Please re-check the path and filename.")
+    except Exception as e:
+        lines.append(f"Error checking model file: {e!r}")
+    return "\n".join(lines)
+
+class CaptionSignals(QObject):
+    """Signals the caption worker emits; Qt queues them onto the GUI thread.
+
+    Each carries the id of the job that emitted it so results of a
+    cancelled job can be told apart from the current one.
+    """
+    progress = pyqtSignal(int, str)  # caption generated so far
+    result = pyqtSignal(int, list)  # finished prompt variations
+    error = pyqtSignal(int, str)
+
+class RefineSignals(QObject):
+    """Signals the refinement worker emits, tagged with the job id like CaptionSignals."""
+    progress = pyqtSignal(int, str)  # cleaned refinement so far
+    result = pyqtSignal(int, str)  # finished refinement
+    error = pyqtSignal(int, str)
+
+class LlmSignals(QObject):
+    """Signals from the LLM loader thread, queued onto the GUI thread."""
+    status = pyqtSignal(str, str)  # "loading", "ready" or "unavailable"; detail text
+    diagnostics = pyqtSignal(str)  # llm_diagnostics() report
 
 class PromptBuilderQt(QMainWindow):
     def __init__(self):
@@ -50,6 +115,7 @@ class PromptBuilderQt(QMainWindow):
         self.image_label = self.findChild(QLabel, "imageFileLabel")
         self.preview = self.findChild(QLabel, "imagePreviewLabel")
         self.generate_btn = self.findChild(QPushButton, "generateButton")
+        self.cancel_btn = self.findChild(QPushButton, "cancelButton")
         self.prompt_text = self.findChild(QTextEdit, "promptText")
         self.send_to_refiner_btn = self.findChild(QPushButton, "sendToRefinerButton")
 
@@ -66,6 +132,7 @@ class PromptBuilderQt(QMainWindow):
         # Right column (refiner) controls
         self.refiner_input = self.findChild(QTextEdit, "refinerInput")
         self.refine_btn = self.findChild(QPushButton, "refineButton")
+        self.stop_refine_btn = self.findChild(QPushButton, "stopRefineButton")
         self.refiner_output = self.findChild(QTextEdit, "refinerOutput")
         self.send_to_ai_btn = self.findChild(QPushButton, "sendToAiButton")
         self.copy_btn = self.findChild(QPushButton, "copyButton")
@@ -73,14 +140,28 @@ class PromptBuilderQt(QMainWindow):
         # State variables
         self.uploaded_image = None
         self.local_llm = None
-        
+        self.llm_state = "idle"  # idle -> loading -> ready / unavailable
+        self.pending_refine = None  # prompt to refine once a load started by the Refine button finishes
+        self.refine_job = 0  # id of the refinement the UI is showing, as with caption_job
+        self.refine_stop = None  # threading.Event of the running refinement
+        self.caption_job = 0  # id of the caption job the UI is showing; bumped on every start and cancel
+        self.caption_cancel = None  # threading.Event of the running caption job
+
         # Thread executor for background tasks
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Captioning gets its own thread so a model load never queues behind (or blocks) refinement
+        self.caption_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.caption_signals = CaptionSignals()
+        self.refine_signals = RefineSignals()
+        self.llm_signals = LlmSignals()
 
         # Setup UI
         self.setup_ui()
         self.connect_signals()
-        self.load_local_llm()
+
+        # Loading a multi-GB GGUF takes seconds; start it once the window has been shown
+        if PRELOAD_LLM:
+            QTimer.singleShot(0, self.start_llm_load)
 
     def setup_ui(self):
         """Initialize UI elements with data"""
@@ -101,70 +182,76 @@ class PromptBuilderQt(QMainWindow):
         # Initially hide Midjourney controls
         self.mj_controls_frame.setVisible(False)
 
+        # Only shown while a caption or a refinement is being generated
+        self.cancel_btn.setVisible(False)
+        self.stop_refine_btn.setVisible(False)
+
+        # LLM status, with a link to the diagnostics
+        self.llm_status_label = self.findChild(QLabel, "llmStatusLabel")
+        self.llm_status_label.setTextInteractionFlags(Qt.TextInteractionFlag.LinksAccessibleByMouse)
+
         # Load logo if it exists
         self.load_logo()
 
-    def load_local_llm(self):
-        """Load the local LLM model with verbose diagnostics."""
-        print("=== Local LLM diagnostics start ===")
-        print("LLAMA_CPP_AVAILABLE:", LLAMA_CPP_AVAILABLE)
+    def start_llm_load(self):
+        """Load the local LLM on the background executor; progress arrives through llm_signals."""
+        if self.llm_state in ("loading", "ready"):
+            return
+        self._on_llm_status("loading", "")
+        self.executor.submit(self._load_llm_worker, LOCAL_MODEL_PATH)
 
-        # Try import again and print details
+    def _load_llm_worker(self, model_path):
+        """Runs on the executor thread."""
+        if not LLAMA_CPP_AVAILABLE:
+            self.llm_signals.status.emit("unavailable", "llama-cpp-python is not installed")
+            return
+        if not os.path.exists(model_path):
+            self.llm_signals.status.emit("unavailable", f"model not found at {model_path}")
+            return
         try:
-            from llama_cpp import Llama
-            print("Imported llama_cpp (llama-cpp-python) successfully.")
+            print(f"Loading local LLM from {model_path}...")
+            # Use conservative defaults; adjust n_threads as needed
+            self.local_llm = load_llm(model_path, n_ctx=2048, n_threads=4)
         except Exception as e:
-            print("ImportError: failed to import llama_cpp:", repr(e))
+            print("Exception while loading model with Llama():", repr(e))
             traceback.print_exc()
-            self.local_llm = None
-            print("=== Local LLM diagnostics end ===")
+            self.llm_signals.status.emit("unavailable", str(e) or type(e).__name__)
+            return
+        print("Local LLM loaded successfully!")
+        self.llm_signals.status.emit("ready", "")
+
+    def _on_llm_status(self, state, detail):
+        """Reflect the LLM state in the status label and the Refine button."""
+        self.llm_state = state
+        if state == "loading":
+            self.llm_status_label.setText("⏳ Loading local LLM...")
+            self.refine_btn.setEnabled(False)
+            self.refine_btn.setText("Loading LLM...")
             return
 
-        model_path = LOCAL_MODEL_PATH
-        print("Configured LOCAL_MODEL_PATH:", model_path)
+        if state == "ready":
+            self.llm_status_label.setText("✅ Local LLM ready")
+        else:
+            self.llm_status_label.setText(
+                f"⚠️ Local LLM unavailable: {html.escape(detail)} (<a href=\"diagnostics\">diagnostics</a>)")
+        self.refine_btn.setEnabled(True)
+        self.refine_btn.setText("Refine Prompt")
 
-        # File existence & metadata
-        try:
-            exists = os.path.exists(model_path)
-            print("Model exists:", exists)
-            if exists:
-                st = os.stat(model_path)
-                print("Model file size (bytes):", st.st_size)
-                print("Model file mode:", oct(st.st_mode))
-                print("Model file permissions (rwx for owner):",
-                      bool(st.st_mode & stat.S_IRUSR),
-                      bool(st.st_mode & stat.S_IWUSR),
-                      bool(st.st_mode & stat.S_IXUSR))
-                # Run 'file' to see actual file type
-                try:
-                    file_out = subprocess.run(["file", model_path], capture_output=True, text=True, check=False)
-                    print("`file` output:", file_out.stdout.strip())
-                except Exception as e:
-                    print("Could not run `file` command:", repr(e))
+        prompt, self.pending_refine = self.pending_refine, None
+        if prompt is not None:
+            if state == "ready":
+                self._start_refine(prompt)
             else:
-                print("Model not found at path. Please re-check the path and filename.")
-                self.local_llm = None
-                print("=== Local LLM diagnostics end ===")
-                return
-        except Exception as e:
-            print("Error checking model file:", repr(e))
-            traceback.print_exc()
-            self.local_llm = None
-            print("=== Local LLM diagnostics end ===")
-            return
+                self._warn_llm_unavailable()
 
-        # Attempt to instantiate Llama and show full traceback on failure
-        try:
-            print("Attempting to load model with Llama(...) – this may take a moment.")
-            # Use conservative defaults; adjust n_threads as needed
-            self.local_llm = Llama(model_path=model_path, n_ctx=2048, n_threads=4, verbose=False)
-            print("Local LLM loaded successfully!")
-        except Exception as e:
-            print("Exception while loading model with Llama():", repr(e))
-            traceback.print_exc()
-            self.local_llm = None
+    def show_llm_diagnostics(self, _link=None):
+        """Run the LLM diagnostics off the GUI thread and show the report."""
+        threading.Thread(target=lambda: self.llm_signals.diagnostics.emit(llm_diagnostics()),
+                         name="llm-diagnostics", daemon=True).start()
 
-        print("=== Local LLM diagnostics end ===")
+    def _on_llm_diagnostics(self, report):
+        print(report)
+        QMessageBox.information(self, "Local LLM diagnostics", report)
 
     def load_logo(self):
         """Load logo image if it exists"""
@@ -182,8 +269,14 @@ class PromptBuilderQt(QMainWindow):
         # Left column signals
         self.upload_btn.clicked.connect(self.upload_image)
         self.generate_btn.clicked.connect(self.generate_prompt)
+        self.cancel_btn.clicked.connect(self.cancel_generation)
         self.send_to_refiner_btn.clicked.connect(self.send_to_refiner)
 
+        # Caption worker signals
+        self.caption_signals.progress.connect(self._on_caption_progress)
+        self.caption_signals.result.connect(self._on_caption_result)
+        self.caption_signals.error.connect(self._on_caption_error)
+
         # AI Generator signals
         self.model_combo.currentTextChanged.connect(self.on_generator_changed)
         self.convert_btn.clicked.connect(self.convert_prompt)
@@ -196,9 +289,18 @@ class PromptBuilderQt(QMainWindow):
 
         # Right column signals
         self.refine_btn.clicked.connect(self.refine_prompt)
+        self.stop_refine_btn.clicked.connect(self.stop_refinement)
         self.send_to_ai_btn.clicked.connect(self.send_to_ai_generator)
         self.copy_btn.clicked.connect(self.copy_to_clipboard)
 
+        # LLM loader signals
+        self.refine_signals.progress.connect(self._on_refine_progress)
+        self.refine_signals.result.connect(self._on_refine_result)
+        self.refine_signals.error.connect(self._on_refine_error)
+        self.llm_signals.status.connect(self._on_llm_status)
+        self.llm_signals.diagnostics.connect(self._on_llm_diagnostics)
+        self.llm_status_label.linkActivated.connect(self.show_llm_diagnostics)
+
     def upload_image(self):
         """Handle image upload"""
         file_path, _ = QFileDialog.getOpenFileName(
@@ -213,6 +315,9 @@ class PromptBuilderQt(QMainWindow):
                 # Store the image path
                 self.uploaded_image = file_path
 
+                # Start loading BLIP while the user looks at the preview
+                preload_captioner()
+
                 # Update the file label
                 self.image_label.setText(f"Selected: {os.path.basename(file_path)}")
 
@@ -227,32 +332,83 @@ class PromptBuilderQt(QMainWindow):
                 QMessageBox.critical(self, "Error", f"Failed to load image: {str(e)}")
 
     def generate_prompt(self):
-        """Generate prompt from uploaded image"""
+        """Generate prompt from uploaded image in the background"""
         if not self.uploaded_image:
             QMessageBox.warning(self, "Warning", "Please upload an image first!")
             return
 
+        self.caption_job += 1
+        self.caption_cancel = threading.Event()
+        self._set_captioning(True)
+        self.caption_executor.submit(self._caption_worker, self.caption_job, self.uploaded_image,
+                                     self.caption_cancel)
+
+    def _caption_worker(self, job, image_path, cancel):
+        """Runs on the caption thread: load the model if needed, stream the caption, emit signals."""
+        stream = stream_prompts_from_image(image_path)
         try:
-            display_text = self.analyze_image(self.uploaded_image)
-            self.prompt_text.setPlainText(display_text)
-            self.convert_prompt()
+            # The caption fills the prompt box token by token, then becomes the full prompt
+            for caption, prompts in stream:
+                if cancel.is_set():
+                    return
+                if prompts is None:
+                    self.caption_signals.progress.emit(job, caption)
+                else:
+                    self.caption_signals.result.emit(job, prompts)
         except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to generate prompt: {str(e)}")
-
-    def analyze_image(self, image_path):
-        """Analyze image using BLIP model"""
-        # Use BLIP-based generator; returns a list of strings
-        prompts = generate_prompts_from_image(image_path)
-        # Ensure no stray braces or extra spaces (defensive)
-        cleaned = [p.strip(" {}[]\"'").strip() for p in prompts if p and p.strip()]
-        if not cleaned:
-            return ""
-        # Build one longer prompt from the list
-        base = cleaned[0].rstrip(".")
-        extras = cleaned[1:]
-        if extras:
-            base += ". " + "; ".join(extras)
-        return base
+            if not cancel.is_set():
+                self.caption_signals.error.emit(job, str(e))
+        finally:
+            stream.close()  # stops generation if we left early
+
+    def cancel_generation(self):
+        """Stop the running caption; its late signals are ignored."""
+        if self.caption_cancel is not None:
+            self.caption_cancel.set()
+        self.caption_job += 1
+        self._set_captioning(False)
+
+    def _set_captioning(self, running):
+        """Lock the controls that would start or feed a second caption while one runs."""
+        self.upload_btn.setEnabled(not running)
+        self.generate_btn.setEnabled(not running)
+        self.generate_btn.setText("Generating..." if running else "Generate Prompt")
+        self.send_to_refiner_btn.setEnabled(not running)
+        self.prompt_text.setReadOnly(running)
+        self.cancel_btn.setVisible(running)
+        if not running:
+            self.caption_cancel = None
+
+    def _on_caption_progress(self, job, caption):
+        if job == self.caption_job:
+            self.prompt_text.setPlainText(caption)
+
+    def _on_caption_result(self, job, prompts):
+        if job != self.caption_job:
+            return
+        self._set_captioning(False)
+        self.prompt_text.setPlainText(self.format_display_prompt(prompts))
+        self.convert_prompt()
+
+    def _on_caption_error(self, job, message):
+        if job != self.caption_job:
+            return
+        self._set_captioning(False)
+        QMessageBox.critical(self, "Error", f"Failed to generate prompt: {message}")
+
+    def format_display_prompt(self, prompts):
+        """Join the prompt variations into the single prompt shown in the prompt box."""
+        with span("format", stage="display_prompt"):
+            # Ensure no stray braces or extra spaces (defensive)
+            cleaned = [p.strip(" {}[]\"'").strip() for p in prompts if p and p.strip()]
+            if not cleaned:
+                return ""
+            # Build one longer prompt from the list
+            base = cleaned[0].rstrip(".")
+            extras = cleaned[1:]
+            if extras:
+                base += ". " + "; ".join(extras)
+            return base
 
     def on_generator_changed(self, text):
         """Handle AI generator selection change"""
@@ -287,7 +443,8 @@ class PromptBuilderQt(QMainWindow):
             })
 
         # Format the prompt using the ai_generators module
-        result = format_prompt(selected_generator, prompt, **kwargs)
+        with span("format", stage="generator", generator=selected_generator):
+            result = format_prompt(selected_generator, prompt, **kwargs)
 
         # Always show both positive and negative in the converted field
         if supports_negative_prompt(selected_generator) and result.get("negative"):
@@ -311,82 +468,85 @@ class PromptBuilderQt(QMainWindow):
             QMessageBox.warning(self, "Warning", "Please enter a prompt to refine!")
             return
 
+        # Not preloaded: load now and refine once it's ready
+        if self.llm_state == "idle":
+            self.pending_refine = prompt
+            self.start_llm_load()
+            return
+
         # Check if local LLM is available
         if not self.local_llm:
-            QMessageBox.warning(
-                self,
-                "Warning",
-                "Local LLM is not available. Please check the model path and installation."
-            )
+            self._warn_llm_unavailable()
             return
 
-        # Disable the refine button during processing
-        self.refine_btn.setEnabled(False)
-        self.refine_btn.setText("Refining...")
-
-        # Use local LLM
-        future = self.executor.submit(self.improve_prompt_with_local, prompt)
+        self._start_refine(prompt)
 
-        # Set up callback for when refinement is done
-        future.add_done_callback(lambda f: QTimer.singleShot(0, partial(self._on_refine_done, f)))
+    def _warn_llm_unavailable(self):
+        QMessageBox.warning(
+            self,
+            "Warning",
+            "Local LLM is not available. Please check the model path and installation "
+            "(click \"diagnostics\" under the Refine button for details)."
+        )
 
-    def _on_refine_done(self, future):
-        """Handle completion of prompt refinement."""
+    def _start_refine(self, prompt):
+        self.refine_job += 1
+        self.refine_stop = threading.Event()
+        self.refiner_output.clear()
+        self._set_refining(True)
+        self.executor.submit(self._refine_worker, self.refine_job, prompt, self.refine_stop)
+
+    def _refine_worker(self, job, prompt, stop):
+        """Runs on the executor thread: stream the refinement, passing it on in batches."""
+        last_emit = 0.0
+        text = pending = None
         try:
-            result = future.result()
+            for text in stream_refinement(self.local_llm, prompt, stop_event=stop):
+                # Coalesce tokens so a fast model doesn't flood the GUI thread with repaints
+                now = time.monotonic()
+                if now - last_emit >= REFINE_UPDATE_INTERVAL_S:
+                    self.refine_signals.progress.emit(job, text)
+                    last_emit, pending = now, None
+                else:
+                    pending = text
         except Exception as e:
-            result = f"Error during refinement: {str(e)}"
-
-        # Update UI
-        self.refiner_output.setPlainText(str(result))
-
-        self.refine_btn.setEnabled(True)
-        self.refine_btn.setText("Refine Prompt")
+            if not stop.is_set():
+                self.refine_signals.error.emit(job, str(e))
+            return
+        if not stop.is_set():
+            self.refine_signals.result.emit(job, pending if pending is not None else text)
+
+    def stop_refinement(self):
+        """Abort the running refinement at its next token, keeping what has been shown."""
+        if self.refine_stop is not None:
+            self.refine_stop.set()
+        self.refine_job += 1
+        self._set_refining(False)
+
+    def _set_refining(self, running):
+        self.refine_btn.setEnabled(not running)
+        self.refine_btn.setText("Refining..." if running else "Refine Prompt")
+        self.stop_refine_btn.setVisible(running)
+        self.send_to_ai_btn.setEnabled(not running)
+        self.copy_btn.setEnabled(not running)
+        if not running:
+            self.refine_stop = None
+
+    def _on_refine_progress(self, job, text):
+        if job == self.refine_job:
+            self.refiner_output.setPlainText(text)
+
+    def _on_refine_result(self, job, text):
+        if job != self.refine_job:
+            return
+        self._set_refining(False)
+        self.refiner_output.setPlainText(text)
 
-    def improve_prompt_with_local(self, prompt):
-        """Improve prompt using local LLM"""
-        if not self.local_llm:
-            return "Local LLM not available. Please check model path and installation."
-        
-        instruction = (
-            "Improve and expand this image prompt for an image-generation model. "
-            "Make it more descriptive and detailed while keeping it concise. "
-            "Focus on visual elements, style, lighting, and composition. "
-            "Return only the improved prompt without any explanation.\n\n"
-            f"Original prompt: {prompt}\n\n"
-            "Improved prompt:"
-        )
-        
-        try:
-            response = self.local_llm(
-                instruction,
-                max_tokens=256,
-                temperature=0.7,
-                top_p=0.9,
-                stop=["Original prompt:", "Improved prompt:", "\n\n"],
-                echo=False
-            )
-            
-            # Extract the generated text
-            generated_text = response.get("choices", [{}])[0].get("text", "").strip()
-            
-            # Clean up the response
-            if generated_text:
-                # Remove any remaining instruction text
-                lines = generated_text.split('\n')
-                cleaned_lines = []
-                for line in lines:
-                    line = line.strip()
-                    if line and not line.startswith(("Original prompt:", "Improved prompt:", "Here's")):
-                        cleaned_lines.append(line)
-                
-                result = ' '.join(cleaned_lines).strip()
-                return result if result else prompt
-            else:
-                return prompt
-            
-        except Exception as e:
-            return f"Local LLM error: {str(e)}"
+    def _on_refine_error(self, job, message):
+        if job != self.refine_job:
+            return
+        self._set_refining(False)
+        self.refiner_output.setPlainText(f"Local LLM error: {message}")
 
     def send_to_ai_generator(self):
         """Send refined prompt back to AI generator"""
@@ -404,8 +564,21 @@ class PromptBuilderQt(QMainWindow):
         else:
             QMessageBox.warning(self, "Warning", "No prompt to copy!")
 
+    def closeEvent(self, event):
+        """Stop a running caption or refinement so the app doesn't wait for it on exit"""
+        for stop in (self.caption_cancel, self.refine_stop):
+            if stop is not None:
+                stop.set()
+        self.caption_executor.shutdown(wait=False, cancel_futures=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
+
 def main():
-    app = QApplication(sys.argv)
+    # Our own flags are picked out here; everything else is left for Qt
+    parser = argparse.ArgumentParser(description="Prompt Builder (local only)")
+    add_instrumentation_arguments(parser)
+    args, qt_args = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_args)
 
     # Get the directory where this script is located
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -416,10 +589,11 @@ def main():
         QMessageBox.critical(None, "Error", "layout_local_only.ui file not found! Please make sure it's in the same directory as this script.")
         sys.exit(1)
 
-    window = PromptBuilderQt()
-    window.show()
-
-    sys.exit(app.exec())
+    with instrument(args):
+        window = PromptBuilderQt()
+        window.show()
+        exit_code = app.exec()
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
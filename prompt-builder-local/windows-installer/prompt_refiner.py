@@ -0,0 +1,180 @@
+"""
+Prompt Refiner
+The local-LLM half of the app: the instruction that asks the model to
+expand a prompt, the call into llama.cpp, and the cleanup of what comes
+back. Kept free of Qt so the GUI, the async front-end and scripts share one
+implementation.
+
+Every refinement starts with the same long instruction. Its KV state is
+computed once when the model loads and restored before each refinement that
+would otherwise re-evaluate it, so a refinement only evaluates the user's
+prompt tokens. PROMPT_BUILDER_LLM_PREFIX_CACHE=0 turns this off.
+"""
+
+import os
+import weakref
+
+from instrumentation import span
+
+PREFIX_CACHE = os.environ.get("PROMPT_BUILDER_LLM_PREFIX_CACHE", "1") != "0"
+
+# Where the model tends to start echoing the template instead of answering
+STOP_SEQUENCES = ["Original prompt:", "Improved prompt:", "\n\n"]
+_ECHO_PREFIXES = ("Original prompt:", "Improved prompt:", "Here's")
+
+# The part of build_instruction() that never changes
+INSTRUCTION_PREFIX = (
+    "Improve and expand this image prompt for an image-generation model. "
+    "Make it more descriptive and detailed while keeping it concise. "
+    "Focus on visual elements, style, lighting, and composition. "
+    "Return only the improved prompt without any explanation.\n\n"
+    "Original prompt:"
+)
+
+_prefix_states = weakref.WeakKeyDictionary()  # Llama -> (prefix tokens, llama.cpp state after evaluating them)
+
+
+def load_llm(model_path, n_ctx=2048, n_threads=4):
+    """Load a GGUF model with llama-cpp-python (raises ImportError if it isn't installed)."""
+    from llama_cpp import Llama
+
+    with span("load", model="llm"):
+        llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+    if PREFIX_CACHE:
+        try:
+            prime_prefix_cache(llm)
+        except Exception as e:
+            print(f"⚠️  Instruction prefix cache unavailable: {e}")
+    return llm
+
+
+def build_instruction(prompt):
+    return f"{INSTRUCTION_PREFIX} {prompt}\n\nImproved prompt:"
+
+
+def _tokenize(llm, text):
+    # The same tokenization create_completion applies to a prompt
+    try:
+        return list(llm.tokenize(text.encode("utf-8"), special=True))
+    except TypeError:  # llama-cpp-python before special tokens were parsed
+        return list(llm.tokenize(text.encode("utf-8")))
+
+
+def prime_prefix_cache(llm):
+    """Evaluate the fixed instruction prefix once and keep llama.cpp's state; returns the cached token count."""
+    # Tokens at the end of the prefix can merge with the start of the prompt, so only keep the tokens two
+    # very different prompts agree on
+    probes = [_tokenize(llm, build_instruction(prompt)) for prompt in ("a", '"Zebra, 1920s" photo')]
+    tokens = []
+    for first, second in zip(*probes):
+        if first != second:
+            break
+        tokens.append(first)
+    if not tokens:
+        return 0
+    with span("llm_eval", stage="prefix", tokens=len(tokens)):
+        llm.reset()
+        llm.eval(tokens)
+        _prefix_states[llm] = (tokens, llm.save_state())
+    return len(tokens)
+
+
+def _restore_prefix(llm):
+    """Put the cached prefix back in the KV cache unless it is still there from the previous call."""
+    entry = _prefix_states.get(llm)
+    if entry is None:
+        return
+    tokens, state = entry
+    # llama.cpp already keeps whatever prefix the new prompt shares with the tokens it evaluated last, so a
+    # restore is only needed when the model was last used for something else
+    current = getattr(llm, "_input_ids", None)
+    if current is not None and len(current) >= len(tokens) and list(current[:len(tokens)]) == tokens:
+        return
+    with span("load", model="llm_prefix", tokens=len(tokens)):
+        llm.load_state(state)
+
+
+class RefinementCleaner:
+    """Cleans LLM output as it streams in: echoed instruction lines are dropped, the rest joined with spaces.
+
+    Finished lines are filtered once. The line still being written is shown
+    unless it could yet turn into an echoed line ("Orig..."), so an echo
+    never flashes up in the GUI.
+    """
+
+    def __init__(self):
+        self._kept = []
+        self._line = ""
+
+    def feed(self, piece):
+        """Add streamed text; returns the cleaned text so far."""
+        *finished, self._line = (self._line + piece).split('\n')
+        for line in finished:
+            line = line.strip()
+            if line and not line.startswith(_ECHO_PREFIXES):
+                self._kept.append(line)
+        return self.text()
+
+    def text(self, final=False):
+        """The cleaned text so far; final=True once the stream has ended and no line is still in progress."""
+        line = self._line.strip()
+        if not line or line.startswith(_ECHO_PREFIXES) or (
+                not final and any(prefix.startswith(line) for prefix in _ECHO_PREFIXES)):
+            return ' '.join(self._kept)
+        return ' '.join(self._kept + [line])
+
+
+def clean_refinement(text, prompt):
+    """Strip echoed instruction lines and join the rest; falls back to the original prompt."""
+    with span("format", stage="refine_cleanup"):
+        cleaner = RefinementCleaner()
+        cleaner.feed(text)
+        return cleaner.text(final=True) or prompt
+
+
+def _settings(max_tokens, temperature, top_p):
+    return dict(max_tokens=max_tokens, temperature=temperature, top_p=top_p, stop=STOP_SEQUENCES, echo=False)
+
+
+def stream_refinement(llm, prompt, stop_event=None, max_tokens=256, temperature=0.7, top_p=0.9):
+    """Yield the cleaned refinement so far each time the LLM's output changes it.
+
+    The last value is the finished prompt (the original one if nothing
+    usable came back). If stop_event (threading.Event) gets set, generation
+    stops at the next token and nothing more is yielded; closing the
+    generator stops it too. Errors from llama.cpp propagate.
+    """
+    cleaner = RefinementCleaner()
+    shown = ""
+    _restore_prefix(llm)
+    with span("llm_eval", prompt_chars=len(prompt), stream=True):
+        for chunk in llm(build_instruction(prompt), stream=True, **_settings(max_tokens, temperature, top_p)):
+            if stop_event is not None and stop_event.is_set():
+                return  # leaving the loop closes the stream, which stops llama.cpp
+            text = cleaner.feed(chunk.get("choices", [{}])[0].get("text", ""))
+            if text != shown:
+                shown = text
+                yield shown
+    final = cleaner.text(final=True) or prompt
+    if final != shown:
+        yield final
+
+
+def refine_prompt(llm, prompt, stop_event=None, max_tokens=256, temperature=0.7, top_p=0.9):
+    """Ask the local LLM for an improved version of prompt.
+
+    With a stop_event (threading.Event) the completion is streamed so it can
+    be abandoned between tokens; returns None if the event gets set. Errors
+    from llama.cpp propagate.
+    """
+    if stop_event is not None:
+        result = None
+        for result in stream_refinement(llm, prompt, stop_event, max_tokens, temperature, top_p):
+            pass
+        return None if stop_event.is_set() else result
+
+    _restore_prefix(llm)
+    with span("llm_eval", prompt_chars=len(prompt)):
+        response = llm(build_instruction(prompt), **_settings(max_tokens, temperature, top_p))
+        text = response.get("choices", [{}])[0].get("text", "")
+    return clean_refinement(text, prompt)